@@ -1,42 +1,263 @@
 # app.py
-from flask import Flask, request, redirect, url_for, flash, send_from_directory, session, g, render_template
+from flask import Flask, Response, request, redirect, url_for, flash, send_file, send_from_directory, session, g, render_template
+from markupsafe import Markup, escape
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.datastructures import FileStorage, Headers
+from werkzeug.http import parse_accept_header, parse_content_range_header
+import abc
 import sqlite3
 import os
+import re
 import qrcode
 import io
 import base64
 import jinja2
-from datetime import datetime # Import datetime for date handling
+import click
+import csv
+import zipfile
+import zlib
+import gzip
+import struct
+from contextlib import ExitStack
+import json
+import hashlib
+import tempfile
+import time
+import threading
+import bisect
+import hmac
+import math
+import mimetypes
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, namedtuple
+from itertools import islice
+from datetime import datetime, timedelta # Import datetime for date handling
+from urllib.parse import quote
+from PIL import Image, ImageOps
+
+try:
+    import brotli  # Optional: brotli-compressed copies of static assets
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import ImageCms  # Optional: colour-managed CMYK -> sRGB in image normalization
+except ImportError:
+    ImageCms = None
+
+try:
+    import boto3  # Optional: only needed for STORAGE_BACKEND = 's3'
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
 
 # --- Flask App Configuration ---
 app = Flask(__name__)
 app.secret_key = 'your_very_strong_and_random_secret_key_here_for_security' # !!! هام: قم بتغيير هذا إلى مفتاح سري قوي !!!
 
+# --- Metrics ---
+# Process-wide counters and histograms, exposed in the Prometheus text format
+# at /metrics. Recording is a dict update under a lock, cheap enough to leave
+# on permanently. Every worker process keeps its own numbers; scrape each one
+# (or sum them) when running several.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 2_000_000, 5_000_000, 10_000_000)
+
+class Metrics:
+    """Thread-safe counters and histograms rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = {}  # name -> (type, help, buckets)
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+
+    def counter(self, name, help_text):
+        self._families[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets):
+        self._families[name] = ('histogram', help_text, buckets)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        buckets = self._families[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(buckets, value)] += 1  # Per bucket; made cumulative by render()
+            series[1] += value
+            series[2] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = [*labels, *extra]
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: [list(series[0]), series[1], series[2]] for key, series in self._histograms.items()}
+        lines = []
+        for name, (kind, help_text, buckets) in self._families.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                for (series_name, labels), value in sorted(counters.items()):
+                    if series_name == name:
+                        lines.append(f"{name}{self._labels(labels)} {value}")
+                continue
+            for (series_name, labels), (counts, total, count) in sorted(histograms.items()):
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip((*buckets, '+Inf'), counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.histogram('http_request_duration_seconds', 'Time spent in the view and its hooks, by endpoint.', LATENCY_BUCKETS)
+metrics.counter('http_requests_total', 'Requests by endpoint and status code.')
+metrics.counter('sqlite_statements_total', 'SQL statements executed, by statement kind.')
+metrics.counter('sqlite_statement_seconds_total', 'Time spent executing SQL statements, by statement kind.')
+metrics.counter('stored_file_bytes_sent_total', 'Bytes of stored files sent by /uploads and /download.')
+metrics.counter('stored_file_redirects_total', 'Stored files answered with a redirect to a presigned storage URL.')
+metrics.histogram('upload_size_bytes', 'Size of uploaded files.', SIZE_BUCKETS)
+metrics.histogram('qr_render_seconds', 'Time spent rendering QR codes that were not cached.', LATENCY_BUCKETS)
+metrics.counter('image_normalization_input_bytes_total', 'Bytes of uploaded images before normalization.')
+metrics.counter('image_normalization_output_bytes_total', 'Bytes of the same images as stored.')
+metrics.counter('dashboard_cache_requests_total', 'Dashboard pages by result: hit, miss or not_modified.')
+
+class InstrumentedConnection(sqlite3.Connection):
+    """sqlite3 connection that counts and times the statements run through it.
+
+    Statements are labelled by their first keyword (SELECT, INSERT, ...). Time
+    spent fetching rows after the first one is not included.
+    """
+
+    def _record(self, sql, started):
+        kind = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else 'EMPTY'
+        metrics.inc('sqlite_statements_total', kind=kind)
+        metrics.inc('sqlite_statement_seconds_total', time.perf_counter() - started, kind=kind)
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._record(sql, started)
+
+    def executemany(self, sql, parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            self._record(sql, started)
+
 # --- Database Setup ---
 DATABASE = 'documents.db'
+app.config['DATABASE'] = DATABASE
+# Applied to every connection. WAL lets readers run while a writer commits.
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',     # Durable across application crashes; WAL keeps it consistent
+    'cache_size': -16000,        # 16 MB page cache per connection
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 5000,        # Milliseconds to wait for the write lock
+    'temp_store': 'MEMORY',
+}
+app.config['SQLITE_STATEMENT_CACHE'] = 256  # Prepared statements cached per connection
+
+class ConnectionManager:
+    """Keeps tuned SQLite connections open across requests.
+
+    Each worker thread gets one writer connection and one read-only
+    (query_only) connection, opened on first use and reused by every later
+    request on that thread. Connections are reopened after a fork or when
+    app.config['DATABASE'] changes.
+
+    Writers are not funnelled through one process-wide connection: SQLite's
+    own write lock already serializes them across threads *and* worker
+    processes, which a Python lock could not, and busy_timeout queues them on
+    it. The document and blob write paths (create_document(),
+    update_document(), remove_document(), import_batch(), the job queue) take
+    that lock late and briefly: files are staged beforehand, and BEGIN
+    IMMEDIATE wraps the statements together with the reads they depend on. A
+    shared connection would only add a second queue in front of the same lock.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _connect(self, readonly):
+        db = sqlite3.connect(app.config['DATABASE'], factory=InstrumentedConnection,
+                             cached_statements=app.config['SQLITE_STATEMENT_CACHE'])
+        db.row_factory = sqlite3.Row  # يسمح بالوصول إلى الأعمدة بالاسم
+        for pragma, value in app.config['SQLITE_PRAGMAS'].items():
+            db.execute(f"PRAGMA {pragma} = {value}")
+        if readonly:
+            db.execute("PRAGMA query_only = ON")
+        return db
+
+    def get(self, readonly=False):
+        local = self._local
+        owner = (os.getpid(), app.config['DATABASE'])
+        if getattr(local, 'owner', None) != owner:
+            local.owner = owner
+            local.connections = {}
+        db = local.connections.get(readonly)
+        if db is None:
+            db = local.connections[readonly] = self._connect(readonly)
+        return db
+
+    def close(self):
+        """Closes the current thread's connections."""
+        for db in getattr(self._local, 'connections', {}).values():
+            db.close()
+        self._local.connections = {}
+
+connections = ConnectionManager()
 
 def get_db():
-    """يتصل بقاعدة البيانات SQLite ويعيد كائن اتصال.
-    يستخدم g لضمان وجود اتصال واحد لكل طلب.
+    """يعيد اتصال الكتابة بقاعدة البيانات SQLite الخاص بهذا العامل.
+    يبقى الاتصال مفتوحاً بين الطلبات ويستخدم g لتتبع استخدامه في الطلب الحالي.
     """
     if 'db' not in g:
-        g.db = sqlite3.connect(DATABASE)
-        g.db.row_factory = sqlite3.Row  # يسمح بالوصول إلى الأعمدة بالاسم
+        g.db = connections.get()
     return g.db
 
+def get_read_db():
+    """يعيد اتصال قراءة فقط، لا يحجبه الكاتب بفضل وضع WAL."""
+    if 'read_db' not in g:
+        g.read_db = connections.get(readonly=True)
+    return g.read_db
+
 def close_db(e=None):
-    """يغلق اتصال قاعدة البيانات في نهاية الطلب."""
-    db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    """ينهي أي معاملة مفتوحة في نهاية الطلب دون إغلاق الاتصال."""
+    for key in ('db', 'read_db'):
+        db = g.pop(key, None)
+        if db is not None and db.in_transaction:
+            db.rollback()
 
 # Register the close_db function to run after each request
 app.teardown_appcontext(close_db)
 
-def init_db():
-    """يهيئ جداول قاعدة البيانات إذا لم تكن موجودة."""
+def init_db(target=None):
+    """يهيئ جداول قاعدة البيانات إذا لم تكن موجودة ثم يطبق الترحيلات المعلقة."""
     with app.app_context():
         db = get_db()
         cursor = db.cursor()
@@ -65,14 +286,290 @@ def init_db():
             )
         ''')
         db.commit()
+        applied = apply_migrations(db, target=target)
+        for version, description in applied:
+            print(f"Applied migration {version}: {description}")
         print("Database initialized.")
 
+# --- Schema Migrations ---
+# Each migration is (version, description, steps). A step is either an SQL
+# statement or a callable taking the connection. Migrations are applied in
+# version order, each in its own BEGIN IMMEDIATE transaction together with its
+# schema_version row, so concurrent workers never apply the same one twice and
+# a failed step leaves the database at the previous version.
+MIGRATIONS = [
+    (1, 'Index documents for the dashboard listing and file lookups', [
+        # dashboard(): WHERE user_id = ? ORDER BY upload_date DESC, id DESC
+        'CREATE INDEX IF NOT EXISTS idx_documents_user_upload ON documents (user_id, upload_date DESC, id DESC)',
+        # download_file() / uploaded_file(): the index alone answers the ownership check
+        'CREATE INDEX IF NOT EXISTS idx_documents_filename ON documents (filename, user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_documents_filename_back ON documents (filename_back, user_id) WHERE filename_back IS NOT NULL',
+    ]),
+    (2, 'Content-addressed, reference-counted blob storage', [
+        '''
+            CREATE TABLE IF NOT EXISTS blobs (
+                name TEXT PRIMARY KEY,          -- <sha256>.<ext>, or the filename for pre-existing uploads
+                size INTEGER,
+                refcount INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''',
+        'ALTER TABLE documents ADD COLUMN blob TEXT',
+        'ALTER TABLE documents ADD COLUMN blob_back TEXT',
+        # Existing uploads become blobs named after their current file
+        'UPDATE documents SET blob = filename, blob_back = filename_back',
+        '''
+            INSERT INTO blobs (name, refcount)
+            SELECT name, COUNT(*) FROM (
+                SELECT blob AS name FROM documents
+                UNION ALL
+                SELECT blob_back FROM documents WHERE blob_back IS NOT NULL
+            ) GROUP BY name
+        ''',
+        # Keep the ownership lookup answerable from the index alone
+        'DROP INDEX IF EXISTS idx_documents_filename',
+        'DROP INDEX IF EXISTS idx_documents_filename_back',
+        'CREATE INDEX idx_documents_filename ON documents (filename, user_id, blob)',
+        'CREATE INDEX idx_documents_filename_back ON documents (filename_back, user_id, blob_back) WHERE filename_back IS NOT NULL',
+    ]),
+    (3, 'Durable background job queue', [
+        '''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,              -- JSON keyword arguments for the handler
+                status TEXT NOT NULL DEFAULT 'queued',  -- queued, running or failed
+                attempts INTEGER NOT NULL DEFAULT 0,
+                run_after REAL NOT NULL,            -- Unix time
+                locked_at REAL,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_runnable ON jobs (status, run_after)',
+    ]),
+    (4, 'Full-text search index over documents', [
+        lambda db: create_search_index(db),
+    ]),
+    (5, 'Normalized, indexed expiry dates and expiry reminders', [
+        'ALTER TABLE documents ADD COLUMN expires_on TEXT',  # ISO YYYY-MM-DD parsed from expiry_date
+        lambda db: backfill_expires_on(db),
+        # scan-expiring: one ordered pass over every expiring document
+        'CREATE INDEX idx_documents_expiry ON documents (expires_on, id) WHERE expires_on IS NOT NULL',
+        # expiring(): one user's documents in a date range
+        'CREATE INDEX idx_documents_user_expiry ON documents (user_id, expires_on) WHERE expires_on IS NOT NULL',
+        '''
+            CREATE TABLE IF NOT EXISTS expiry_reminders (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                document_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                expires_on TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (document_id, expires_on),
+                FOREIGN KEY (document_id) REFERENCES documents(id),
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_expiry_reminders_user ON expiry_reminders (user_id, expires_on)',
+    ]),
+    (6, 'CRC-32 of stored blobs for streamed ZIP exports', [
+        'ALTER TABLE blobs ADD COLUMN crc32 INTEGER',  # Filled at upload, or lazily by export_documents()
+    ]),
+    (7, 'Resumable chunked uploads', [
+        '''
+            CREATE TABLE IF NOT EXISTS uploads (
+                id TEXT PRIMARY KEY,            -- Random token, also naming the .part file
+                user_id INTEGER NOT NULL,
+                filename TEXT NOT NULL,
+                size INTEGER NOT NULL,          -- Announced by the client
+                sha256 TEXT,                    -- Optional digest of the whole file, checked on finalize
+                received INTEGER NOT NULL DEFAULT 0,
+                lock TEXT,                      -- Token of the request writing a chunk...
+                locked_until REAL,              -- ...and when its lease ends (Unix time)
+                blob TEXT,                      -- <sha256>.<ext> once finalized
+                blob_size INTEGER,
+                crc32 INTEGER,
+                expires_at REAL NOT NULL,       -- Unix time
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_uploads_user ON uploads (user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_uploads_expiry ON uploads (expires_at)',
+    ]),
+    (8, 'Progress of `flask reconcile`', [
+        '''
+            CREATE TABLE IF NOT EXISTS reconcile_progress (
+                walk TEXT PRIMARY KEY,          -- A key of RECONCILE_WALKS
+                cursor TEXT NOT NULL,           -- Last name (or document id) compared
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''',
+    ]),
+    (9, 'Per-user revision of the document list', [
+        'ALTER TABLE users ADD COLUMN revision INTEGER NOT NULL DEFAULT 0',  # Bumped by the triggers below
+        'CREATE TRIGGER IF NOT EXISTS documents_revision_insert AFTER INSERT ON documents BEGIN '
+        'UPDATE users SET revision = revision + 1 WHERE id = new.user_id; END',
+        'CREATE TRIGGER IF NOT EXISTS documents_revision_update AFTER UPDATE ON documents BEGIN '
+        'UPDATE users SET revision = revision + 1 WHERE id IN (old.user_id, new.user_id); END',
+        'CREATE TRIGGER IF NOT EXISTS documents_revision_delete AFTER DELETE ON documents BEGIN '
+        'UPDATE users SET revision = revision + 1 WHERE id = old.user_id; END',
+    ]),
+    (10, 'Blob files being deleted outside the write lock', [
+        '''
+            CREATE TABLE IF NOT EXISTS blob_deletions (
+                name TEXT PRIMARY KEY,
+                started_at REAL NOT NULL        -- Unix time; older than JOB_LEASE_SECONDS means the deleter died
+            )
+        ''',
+    ]),
+    (11, 'Pixel width of image blobs', [
+        'ALTER TABLE blobs ADD COLUMN width INTEGER',  # Upright width, recorded by generate_derivatives()
+    ]),
+]
+
+def ensure_schema_version_table(db):
+    """Creates the schema_version bookkeeping table if needed."""
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    db.commit()
+
+def get_schema_version(db):
+    """Returns the highest applied migration version (0 for a fresh database)."""
+    ensure_schema_version_table(db)
+    row = db.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+def pending_migrations(db):
+    """Returns the migrations that have not been applied yet, in order."""
+    current = get_schema_version(db)
+    return [m for m in sorted(MIGRATIONS, key=lambda m: m[0]) if m[0] > current]
+
+def apply_migrations(db, target=None):
+    """Applies pending migrations up to target (all by default).
+
+    Returns a list of (version, description) for the migrations applied.
+    """
+    applied = []
+    for version, description, steps in pending_migrations(db):
+        if target is not None and version > target:
+            break
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # Another worker may have applied it while we waited for the lock.
+            if db.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone():
+                db.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(db)
+                else:
+                    db.execute(step)
+            db.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                       (version, description))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        applied.append((version, description))
+    return applied
+
+@app.cli.group('db')
+def db_cli():
+    """Database schema management commands."""
+
+@db_cli.command('status')
+def db_status_command():
+    """Shows the current schema version and pending migrations."""
+    db = get_db()
+    print(f"Current schema version: {get_schema_version(db)}")
+    pending = pending_migrations(db)
+    if not pending:
+        print("No pending migrations.")
+    for version, description, _ in pending:
+        print(f"  pending {version}: {description}")
+
+@db_cli.command('upgrade')
+@click.option('--target', type=int, default=None, help='Stop after this migration version.')
+def db_upgrade_command(target):
+    """Creates missing tables and applies pending migrations."""
+    init_db(target=target)
+
 # Ensure the upload folder exists
 UPLOAD_FOLDER = 'uploads'
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # 5 Megabytes limit
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Request size limit; larger files are sent as chunked uploads
+app.config['UPLOAD_SIZE_LIMITS'] = {  # Largest file per document type...
+    'عقد إيجار': 50 * 1024 * 1024,
+    'بيان بنكي': 50 * 1024 * 1024,
+    'شهادة دراسية': 20 * 1024 * 1024,
+    'أخرى': 50 * 1024 * 1024,
+}
+app.config['UPLOAD_DEFAULT_SIZE_LIMIT'] = 5 * 1024 * 1024  # ...and for all other types
+app.config['UPLOAD_CHUNK_SIZE'] = 4 * 1024 * 1024  # Chunk size of the pages' uploader; larger files are chunked
+app.config['UPLOAD_MAX_CHUNK_SIZE'] = 16 * 1024 * 1024  # Request size limit of one chunk
+app.config['UPLOAD_CHUNK_TIMEOUT'] = 300  # Seconds a chunk may take before another request can take over
+app.config['UPLOAD_SESSION_TTL'] = 24 * 3600  # Seconds a chunked upload is kept after its last activity
+app.config['UPLOAD_MAX_SESSIONS'] = 10  # Chunked uploads per user not yet attached to a document
+app.config['DASHBOARD_PAGE_SIZE'] = 20  # Documents per dashboard page
+app.config['DASHBOARD_MAX_PAGE_SIZE'] = 100  # Upper bound for ?per_page=
+app.config['DASHBOARD_CACHE'] = 'memory'  # Rendered dashboard pages: 'memory' (per process), 'sqlite' (shared by the workers of a host) or None
+app.config['DASHBOARD_CACHE_SIZE'] = 2000  # Pages kept
+app.config['DASHBOARD_CACHE_PATH'] = 'render_cache.db'  # 'sqlite': cache database, on a local disk
+app.config['IMPORT_MAX_CONTENT_LENGTH'] = 200 * 1024 * 1024  # Request size limit for /import
+app.config['IMPORT_MAX_FILES'] = 200  # Documents per import
+app.config['EXPORT_CHUNK_SIZE'] = 256 * 1024  # Bytes per chunk of a streamed export
+app.config['EXPIRY_WARNING_DAYS'] = 30  # Default look-ahead for /expiring and scan-expiring
+app.config['SEARCH_RESULTS_LIMIT'] = 50  # Results shown by /search
+app.config['FILE_OWNER_CACHE_SIZE'] = 10000  # Entries in the filename -> owner cache
+app.config['QR_CACHE_SIZE'] = 512  # QR images kept in memory
+app.config['QR_CACHE_DIR'] = None  # Optional directory for the on-disk QR tier, e.g. 'qr_cache'
+app.config['BLOB_CHUNK_SIZE'] = 64 * 1024  # Read size when hashing uploads
+app.config['IMAGE_NORMALIZATION'] = 'preserve'  # 'preserve' stores uploads as sent, 'optimize' re-encodes images
+app.config['IMAGE_MAX_DPI'] = 300  # 'optimize': resolution cap, at...
+app.config['IMAGE_PAGE_INCHES'] = 11.69  # ...this long page side (A4), i.e. at most 3507 px
+app.config['IMAGE_JPEG_QUALITY'] = 85  # 'optimize': JPEG quality of re-encoded photos
+app.config['STORED_FILE_MAX_AGE'] = 365 * 24 * 3600  # Browser cache lifetime of /uploads and /download responses
+app.config['ASSET_FOLDER'] = 'assets'  # Fingerprinted CSS/JS written at startup
+app.config['ASSET_MAX_AGE'] = 365 * 24 * 3600  # Browser cache lifetime of /assets responses
+app.config['PASSWORD_HASH_WORKERS'] = 2  # Processes hashing passwords (0: hash in the request thread)
+app.config['PASSWORD_HASH_QUEUE'] = 8  # Hash operations allowed to wait for a worker before answering 429
+app.config['AUTH_IP_BURST'] = 20  # Login/register attempts per client IP at once...
+app.config['AUTH_IP_PER_MINUTE'] = 10  # ...and regained per minute
+app.config['AUTH_USERNAME_BURST'] = 10  # Login attempts per username at once...
+app.config['AUTH_USERNAME_PER_MINUTE'] = 5  # ...and regained per minute
+app.config['AUTH_RATE_LIMIT_KEYS'] = 100000  # IPs and usernames tracked by the rate limiter
+app.config['METRICS_TOKEN'] = None  # Bearer token required by /metrics; None disables the endpoint
+app.config['COMPRESS_LEVEL'] = 6  # gzip level, 1 (fastest) to 9 (smallest)
+app.config['COMPRESS_BROTLI_QUALITY'] = 5  # brotli quality, 0 to 11
+app.config['COMPRESS_MIN_SIZE'] = 500  # Bytes; smaller bodies are sent as they are
+app.config['COMPRESS_BUFFER_SIZE'] = 256 * 1024  # Larger or unsized bodies are compressed while streaming
+app.config['COMPRESS_CACHE_SIZE'] = 256  # Compressed bodies kept in memory
+app.config['COMPRESS_MIMETYPES'] = {'application/json', 'application/javascript', 'application/xml', 'image/svg+xml'}  # Besides text/*
+app.config['DERIVATIVE_FOLDER'] = os.path.join(UPLOAD_FOLDER, '_derivatives')  # Resized image variants
+app.config['DERIVATIVE_WIDTHS'] = (320, 640, 1280)  # Variant widths in pixels
+app.config['DERIVATIVE_QUALITY'] = {320: 70, 640: 78, 1280: 85}  # JPEG quality per width
+app.config['QUARANTINE_FOLDER'] = os.path.join(UPLOAD_FOLDER, '_quarantine')  # Orphan files moved aside by `flask reconcile`
+app.config['RECONCILE_GRACE_SECONDS'] = 3600  # `flask reconcile` ignores rows and scratch files younger than this
+app.config['STORAGE_BACKEND'] = 'local'  # Where stored files live: 'local' (UPLOAD_FOLDER, DERIVATIVE_FOLDER) or 's3'
+app.config['STORAGE_PRESIGN_EXPIRES'] = 3600  # Seconds a presigned download URL stays valid
+app.config['S3_BUCKET'] = None  # 's3': bucket holding uploads and derivatives
+app.config['S3_PREFIX'] = ''  # 's3': key prefix, e.g. 'vault/'
+app.config['S3_ENDPOINT_URL'] = None  # 's3': S3-compatible server, e.g. 'http://localhost:9000' for MinIO
+app.config['S3_REGION'] = None  # 's3': None uses the boto3 default (AWS_DEFAULT_REGION, ~/.aws/config)
+app.config['S3_MAX_POOL_CONNECTIONS'] = 20  # 's3': keep-alive connections shared by all threads of a process
+app.config['S3_PART_SIZE'] = 8 * 1024 * 1024  # 's3': multipart upload part size (S3 minimum: 5 MiB)
+app.config['JOB_WORKERS'] = 2  # Background job threads per process (0: only `flask jobs drain`)
+app.config['JOB_POLL_INTERVAL'] = 5  # Seconds between polls when the queue is idle
+app.config['JOB_MAX_ATTEMPTS'] = 5
+app.config['JOB_RETRY_DELAY'] = 2  # Seconds before the first retry, doubled on each attempt
+app.config['JOB_LEASE_SECONDS'] = 600  # A running job older than this is assumed dead and re-run
 
 ALLOWED_EXTENSIONS_IMAGES = {'png', 'jpg', 'jpeg'}
 ALLOWED_EXTENSIONS_DOCS = {'pdf'}
@@ -94,6 +591,1424 @@ def is_image(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS_IMAGES
 
+def upload_size_limit(document_type=None):
+    """Returns the largest file accepted for a document type; the largest of all types for None."""
+    limits = app.config['UPLOAD_SIZE_LIMITS']
+    if document_type is None:
+        return max(app.config['UPLOAD_DEFAULT_SIZE_LIMIT'], *limits.values())
+    return limits.get(document_type, app.config['UPLOAD_DEFAULT_SIZE_LIMIT'])
+
+def size_limit_message(limit):
+    return f'حجم الملف يتجاوز الحد المسموح به لهذا النوع من المستندات ({limit // (1024 * 1024)} ميجابايت).'
+
+# --- In-Process Caches ---
+class LRUCache:
+    """A thread-safe mapping that keeps at most `capacity` recently used entries."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+
+    def discard(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+# --- File Ownership Lookup ---
+# Every image on view_document.html is fetched through uploaded_file(), so the
+# filename -> owner mapping is cached in-process. Entries only change when a
+# document is added, edited or deleted; those routes call invalidate_file_owners().
+# Other workers learn of a change through users.revision, which every change to
+# a user's documents bumps: a cache hit is only used while the owner's revision
+# is still the one the entry was read with.
+FileOwner = namedtuple('FileOwner', ['user_id', 'side', 'blob', 'revision'])
+file_owner_cache = LRUCache(app.config['FILE_OWNER_CACHE_SIZE'])
+
+def lookup_file_owner(filename):
+    """Resolves a document filename to FileOwner(user_id, side, blob, revision), or None if unknown."""
+    db = get_read_db()
+    owner = file_owner_cache.get(filename)
+    if owner is not None:
+        user = db.execute("SELECT revision FROM users WHERE id = ?", (owner.user_id,)).fetchone()
+        if user is not None and user['revision'] == owner.revision:
+            return owner
+    row = db.execute(
+        "SELECT d.user_id, 'front' AS side, d.blob, u.revision FROM documents d "
+        "JOIN users u ON u.id = d.user_id WHERE d.filename = ? "
+        "UNION ALL "
+        "SELECT d.user_id, 'back' AS side, d.blob_back, u.revision FROM documents d "
+        "JOIN users u ON u.id = d.user_id WHERE d.filename_back = ? "
+        "LIMIT 1", (filename, filename)).fetchone()
+    if row is None:
+        file_owner_cache.discard(filename)
+        return None
+    owner = FileOwner(row['user_id'], row['side'], row['blob'], row['revision'])
+    file_owner_cache.set(filename, owner)
+    return owner
+
+def invalidate_file_owners(*filenames):
+    """Drops cached ownership entries for the given stored filenames."""
+    file_owner_cache.discard(*(name for name in filenames if name))
+
+# --- Content-Addressed Blob Store ---
+# Uploads are hashed while they stream to a temporary file and stored once under
+# <sha256>.<ext>. documents.blob / blob_back reference them and the blobs table
+# counts references, so identical scans are kept on disk only once.
+#
+# Writers stage the file, then retain_blob()/release_blob() inside the same
+# transaction as the documents change, and only after it commits publish the
+# staged file. Blobs whose last reference went away are unlinked by a
+# background job (see Background Jobs).
+StagedBlob = namedtuple('StagedBlob', ['name', 'tmp_path', 'size', 'crc32'])
+
+class UploadTooLarge(ValueError):
+    """Raised while staging a file once it exceeds its size limit."""
+
+    def __init__(self, limit):
+        super().__init__(f"File exceeds {limit} bytes")
+        self.limit = limit
+
+# Stored files are fanned out over two levels of hex prefix directories
+# (uploads/ab/cd/<name>) so no single directory grows to millions of entries.
+# Files from the old flat layout are still found until `flask relayout-uploads`
+# has moved them.
+_HEX_DIGITS = set('0123456789abcdef')
+
+def shard_prefix(name):
+    """Returns the two shard directory names for a stored name."""
+    prefix = name[:4]
+    if len(prefix) < 4 or not set(prefix) <= _HEX_DIGITS:
+        prefix = hashlib.md5(name.encode('utf-8')).hexdigest()[:4]
+    return prefix[:2], prefix[2:4]
+
+def sharded_path(folder, name):
+    return os.path.join(folder, *shard_prefix(name), name)
+
+def resolve_sharded(folder, name):
+    """Returns the path of `name` in folder, in either layout.
+
+    Falls back to the sharded path when the file exists in neither layout. The
+    sharded location is checked first and is also the fallback, so a file moved
+    by a concurrent relayout is never missed.
+    """
+    path = sharded_path(folder, name)
+    if os.path.exists(path):
+        return path
+    flat_path = os.path.join(folder, name)
+    if os.path.exists(flat_path):
+        return flat_path
+    return path
+
+def send_stored_file(storage, name, cache_control='no-cache', **kwargs):
+    """Sends a stored file, or redirects to a presigned URL of the backend.
+
+    Backends that presign (S3) serve the bytes themselves with `cache_control`;
+    the redirect is cached for half the URL lifetime at most. Otherwise the
+    file goes through storage.send(), i.e. send_file() with `kwargs`.
+    """
+    expires_in = app.config['STORAGE_PRESIGN_EXPIRES']
+    url = storage.presign(name, expires_in, cache_control=cache_control,
+                          download_name=kwargs.get('download_name') if kwargs.get('as_attachment') else None)
+    if url is not None:
+        metrics.inc('stored_file_redirects_total')
+        response = redirect(url)
+        response.cache_control.private = True
+        response.cache_control.max_age = expires_in // 2
+        return response
+    response = storage.send(name, **kwargs)
+    if response.status_code in (200, 206):
+        metrics.inc('stored_file_bytes_sent_total', response.content_length or 0)
+    return response
+
+def blob_etag(name):
+    """Returns a strong ETag for a stored blob: its SHA-256, or a hash of a legacy name."""
+    stem = name.rsplit('.', 1)[0]
+    if len(stem) == 64 and set(stem) <= _HEX_DIGITS:
+        return stem
+    return hashlib.sha256(name.encode('utf-8')).hexdigest()
+
+def send_immutable_file(storage, name, etag, **kwargs):
+    """Sends a stored file that is cached privately for STORED_FILE_MAX_AGE.
+
+    A document side gets a new random filename whenever its file is replaced,
+    so /uploads and /download URLs never change content and browsers need not
+    revalidate them. send_file() still answers If-None-Match /
+    If-Modified-Since with 304 and serves byte ranges, which lets PDF viewers
+    load large files piece by piece.
+    """
+    max_age = app.config['STORED_FILE_MAX_AGE']
+    response = send_stored_file(storage, name, f"private, max-age={max_age}, immutable",
+                                etag=etag, max_age=max_age, **kwargs)
+    if response.status_code == 302:
+        return response  # Presigned redirect, see send_stored_file()
+    response.cache_control.public = False  # send_file() marks any max_age public
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+def stage_upload(file, limit=None):
+    """Streams an uploaded file to a temporary file while hashing it.
+
+    Raises UploadTooLarge, without keeping the temporary file, as soon as more
+    than `limit` bytes arrived. Images are normalized afterwards when
+    IMAGE_NORMALIZATION is 'optimize'.
+    """
+    extension = file.filename.rsplit('.', 1)[1].lower()
+    fd, tmp_path = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'], prefix='.upload-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            staged = copy_and_hash(file.stream, out, extension, tmp_path, limit)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    metrics.observe('upload_size_bytes', staged.size)
+    if app.config['IMAGE_NORMALIZATION'] == 'optimize' and extension in ALLOWED_EXTENSIONS_IMAGES:
+        staged = normalize_staged_image(staged)
+    return staged
+
+def copy_and_hash(source, out, extension, tmp_path, limit=None):
+    """Copies stream `source` to `out` (if not None), returning the StagedBlob for tmp_path.
+
+    Raises UploadTooLarge once more than `limit` bytes were read.
+    """
+    digest = hashlib.sha256()
+    crc = 0
+    size = 0
+    while True:
+        chunk = source.read(app.config['BLOB_CHUNK_SIZE'])
+        if not chunk:
+            break
+        size += len(chunk)
+        if limit is not None and size > limit:
+            raise UploadTooLarge(limit)
+        digest.update(chunk)
+        crc = zlib.crc32(chunk, crc)
+        if out is not None:
+            out.write(chunk)
+    return StagedBlob(f"{digest.hexdigest()}.{extension}", tmp_path, size, crc)
+
+def unique_filename(original_filename, staged):
+    """Returns a new random URL name for a stored document side.
+
+    The extension follows the stored blob, which differs from the upload's
+    when image normalization converted it.
+    """
+    stem = original_filename.rsplit('.', 1)[0]
+    return f"{os.urandom(8).hex()}_{stem}.{staged.name.rsplit('.', 1)[1]}"
+
+def discard_staged(*staged):
+    """Removes the temporary files of staged uploads that will not be stored."""
+    for blob in staged:
+        if blob and os.path.exists(blob.tmp_path):
+            os.remove(blob.tmp_path)
+
+def publish_staged(*staged):
+    """Moves committed staged uploads into place.
+
+    The file is stored even if the blob already exists: the content is identical,
+    and it restores a file unlinked concurrently by unlink_unreferenced_blobs().
+    """
+    storage = blob_storage()
+    for blob in staged:
+        wait_for_blob_deletion(get_db(), blob.name)
+        storage.put_file(blob.name, blob.tmp_path)
+
+def wait_for_blob_deletion(db, name):
+    """Waits while unlink_unreferenced_blobs() is deleting the file of `name`, so
+    a file stored now cannot be removed by a delete that started earlier."""
+    while True:
+        row = db.execute("SELECT started_at FROM blob_deletions WHERE name = ?", (name,)).fetchone()
+        if row is None or row['started_at'] < time.time() - app.config['JOB_LEASE_SECONDS']:
+            return
+        time.sleep(0.05)
+
+def retain_blob(db, staged):
+    """Adds a reference to a staged blob. Must run inside the caller's transaction."""
+    db.execute("INSERT INTO blobs (name, size, crc32, refcount) VALUES (?, ?, ?, 1) "
+               "ON CONFLICT(name) DO UPDATE SET refcount = refcount + 1, crc32 = excluded.crc32",
+               (staged.name, staged.size, staged.crc32))
+
+def release_blob(db, name):
+    """Drops a reference to a blob inside the caller's transaction.
+
+    Returns True when that was the last reference; the caller then passes the
+    name to an 'unlink_blobs' job enqueued in the same transaction.
+    """
+    db.execute("UPDATE blobs SET refcount = refcount - 1 WHERE name = ?", (name,))
+    row = db.execute("SELECT refcount FROM blobs WHERE name = ?", (name,)).fetchone()
+    if row is not None and row['refcount'] > 0:
+        return False
+    db.execute("DELETE FROM blobs WHERE name = ?", (name,))
+    return True
+
+def unlink_unreferenced_blobs(db, names):
+    """Deletes blob files (and their derivatives) that are still unreferenced.
+
+    Which names to delete is decided under the database write lock, and they are
+    marked in blob_deletions in the same transaction. The deletes themselves,
+    network calls with S3, run after the commit. A concurrent upload of the same
+    content has either committed its reference first, and the file is kept, or
+    commits later and publish_staged() waits for the mark to go before storing
+    the file again.
+    """
+    if not names:
+        return
+    storage = blob_storage()
+    for name in mark_blob_deletions(db, names):
+        try:
+            storage.delete(name)
+            remove_derivatives(name)
+        finally:
+            db.execute("DELETE FROM blob_deletions WHERE name = ?", (name,))
+            db.commit()
+
+def mark_blob_deletions(db, names):
+    """Marks the names without a blobs row as being deleted. Returns them."""
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        unreferenced = [name for name in names
+                        if not db.execute("SELECT 1 FROM blobs WHERE name = ?", (name,)).fetchone()]
+        db.executemany("INSERT OR REPLACE INTO blob_deletions (name, started_at) VALUES (?, ?)",
+                       [(name, time.time()) for name in unreferenced])
+    except BaseException:
+        db.rollback()
+        raise
+    db.commit()
+    return unreferenced
+
+def relayout_folder(folder, batch_size, pause):
+    """Moves files from the flat layout of folder into their shard directories.
+
+    Each move is a single atomic rename and readers resolve both layouts, so this
+    can run while the application serves traffic. It only touches files still in
+    the flat layout, so an interrupted run simply continues where it stopped.
+    Returns the number of files moved.
+    """
+    moved = 0
+    while True:
+        # Reads only as many directory entries as the batch needs; the files
+        # moved by earlier batches are no longer listed.
+        with os.scandir(folder) as entries:
+            files = (entry.name for entry in entries
+                     if entry.is_file(follow_symlinks=False) and not entry.name.startswith('.'))
+            batch = list(islice(files, batch_size))
+        if not batch:
+            return moved
+        for name in batch:
+            target = sharded_path(folder, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                os.replace(os.path.join(folder, name), target)
+            except FileNotFoundError:
+                continue  # Deleted meanwhile
+            moved += 1
+        print(f"  {folder}: moved {moved} files")
+        time.sleep(pause)
+
+@app.cli.command('relayout-uploads')
+@click.option('--batch-size', default=1000, show_default=True, help='Files moved between pauses.')
+@click.option('--pause', default=0.1, show_default=True, help='Seconds to sleep between batches.')
+def relayout_uploads_command(batch_size, pause):
+    """Moves uploads and derivatives from the flat layout into shard directories."""
+    if app.config['STORAGE_BACKEND'] != 'local':
+        print("Only the local storage backend has a flat layout to migrate.")
+        return
+    for folder in (app.config['UPLOAD_FOLDER'], app.config['DERIVATIVE_FOLDER']):
+        if os.path.isdir(folder):
+            print(f"Moved {relayout_folder(folder, batch_size, pause)} files in {folder}.")
+
+# --- Storage Backends ---
+# Stored files (blobs and their image derivatives) are only read and written
+# through a storage backend, so several application nodes can share one S3
+# bucket instead of a local folder. Backends address files by stored name and
+# all keep the two-level shard layout. Uploads are still staged, hashed and
+# normalized in UPLOAD_FOLDER on the local disk; with the S3 backend that
+# folder is scratch space only.
+STORAGE_AREAS = {  # area -> (folder config key of LocalStorage, key prefix in S3)
+    'uploads': ('UPLOAD_FOLDER', ''),
+    'derivatives': ('DERIVATIVE_FOLDER', '_derivatives/'),
+    'quarantine': ('QUARANTINE_FOLDER', '_quarantine/'),
+}
+_SHARD_DIR = re.compile(r'[0-9a-f]{2}')
+
+class Storage(abc.ABC):
+    """Interface of the storage backends. Missing files raise FileNotFoundError."""
+
+    @abc.abstractmethod
+    def put(self, name, source):
+        """Stores binary stream `source` under name, replacing any file atomically."""
+
+    def put_file(self, name, tmp_path):
+        """Stores the local file tmp_path under name and removes tmp_path."""
+        with open(tmp_path, 'rb') as f:
+            self.put(name, f)
+        os.remove(tmp_path)
+
+    @abc.abstractmethod
+    def open(self, name):
+        """Returns a readable, seekable binary file object with the contents of name."""
+
+    @abc.abstractmethod
+    def get_range(self, name, start, stop, chunk_size):
+        """Yields bytes [start, stop) of name in chunks of at most chunk_size bytes."""
+
+    @abc.abstractmethod
+    def delete(self, name):
+        """Deletes name; deleting a missing file is not an error."""
+
+    @abc.abstractmethod
+    def exists(self, name):
+        """Whether name is stored."""
+
+    @abc.abstractmethod
+    def iter_names(self, start_after=None):
+        """Yields the stored names in shard order, (shard_prefix(name), name), after start_after.
+
+        For names starting with four hex digits (all blobs and derivatives) this
+        is plain name order.
+        """
+
+    def presign(self, name, expires_in, cache_control=None, download_name=None):
+        """Returns a URL clients can fetch name from directly, or None."""
+        return None
+
+    def send(self, name, **kwargs):
+        """Returns a response with the file, for backends that do not presign."""
+        kwargs.setdefault('download_name', name)
+        return send_file(self.open(name), **kwargs)
+
+class LocalStorage(Storage):
+    """Files under the folder named by an app.config key, e.g. uploads/ab/cd/<name>."""
+
+    def __init__(self, folder_key):
+        self.folder_key = folder_key
+
+    @property
+    def folder(self):
+        return app.config[self.folder_key]
+
+    def path(self, name):
+        return resolve_sharded(self.folder, name)
+
+    def put(self, name, source):
+        path = sharded_path(self.folder, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.put-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for chunk in iter(lambda: source.read(app.config['BLOB_CHUNK_SIZE']), b''):
+                    out.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def put_file(self, name, tmp_path):
+        # A rename: staged uploads live in UPLOAD_FOLDER, on the same file system.
+        path = sharded_path(self.folder, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+
+    def open(self, name):
+        return open(self.path(name), 'rb')
+
+    def get_range(self, name, start, stop, chunk_size):
+        with self.open(name) as f:
+            f.seek(start)
+            remaining = stop - start
+            while remaining:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def iter_names(self, start_after=None):
+        # Only the sharded layout is listed; `flask relayout-uploads` moves the rest.
+        start = (*shard_prefix(start_after), start_after) if start_after else ('', '', '')
+        for first in self._shard_dirs(self.folder, start[0]):
+            parent = os.path.join(self.folder, first)
+            for second in self._shard_dirs(parent, start[1] if first == start[0] else ''):
+                try:
+                    with os.scandir(os.path.join(parent, second)) as entries:
+                        names = sorted(entry.name for entry in entries
+                                       if entry.is_file(follow_symlinks=False) and not entry.name.startswith('.'))
+                except FileNotFoundError:
+                    continue
+                for name in names:
+                    if (first, second, name) > start:
+                        yield name
+
+    @staticmethod
+    def _shard_dirs(folder, minimum):
+        """Returns the sorted shard directory names in folder, from minimum on."""
+        try:
+            with os.scandir(folder) as entries:
+                return sorted(entry.name for entry in entries
+                              if entry.is_dir(follow_symlinks=False) and _SHARD_DIR.fullmatch(entry.name)
+                              and entry.name >= minimum)
+        except FileNotFoundError:
+            return []
+
+    def send(self, name, **kwargs):
+        path = self.path(name)
+        return send_from_directory(os.path.dirname(path), os.path.basename(path), **kwargs)
+
+class S3Storage(Storage):
+    """Objects in an S3 bucket or on an S3-compatible server (MinIO, Ceph RGW, ...).
+
+    Uploads larger than one part are sent as multipart uploads holding a single
+    part in memory at a time. Downloads are served by the bucket itself through
+    presigned URLs.
+    """
+
+    MIN_PART_SIZE = 5 * 1024 * 1024  # S3 rejects smaller parts, except the last one
+    MISSING = ('404', 'NoSuchKey', 'NotFound')
+
+    def __init__(self, client, bucket, prefix, part_size):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = max(part_size, self.MIN_PART_SIZE)
+
+    def key(self, name):
+        return self.prefix + '/'.join((*shard_prefix(name), name))
+
+    def put(self, name, source):
+        key = self.key(name)
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        part = source.read(self.part_size)
+        if len(part) < self.part_size:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=part, ContentType=content_type)
+            return
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key,
+                                                        ContentType=content_type)['UploadId']
+        try:
+            parts = []
+            while part:
+                number = len(parts) + 1
+                response = self.client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                                   PartNumber=number, Body=part)
+                parts.append({'PartNumber': number, 'ETag': response['ETag']})
+                part = source.read(self.part_size)
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                                  MultipartUpload={'Parts': parts})
+        except BaseException:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+
+    def get_object(self, name, **kwargs):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.key(name), **kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] in self.MISSING:
+                raise FileNotFoundError(name) from e
+            raise
+
+    def open(self, name):
+        # Pillow and zipfile need to seek, which a response body cannot.
+        body = self.get_object(name)['Body']
+        spooled = tempfile.SpooledTemporaryFile(max_size=self.part_size)
+        try:
+            for chunk in body.iter_chunks(app.config['BLOB_CHUNK_SIZE']):
+                spooled.write(chunk)
+        finally:
+            body.close()
+        spooled.seek(0)
+        return spooled
+
+    def get_range(self, name, start, stop, chunk_size):
+        if start >= stop:
+            return
+        body = self.get_object(name, Range=f"bytes={start}-{stop - 1}")['Body']
+        try:
+            yield from body.iter_chunks(chunk_size)
+        finally:
+            body.close()
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as e:
+            if e.response['Error']['Code'] in self.MISSING:
+                return False
+            raise
+        return True
+
+    def iter_names(self, start_after=None):
+        # Keys are listed in UTF-8 byte order, which is the shard order of the names.
+        params = {'Bucket': self.bucket, 'Prefix': self.prefix}
+        if start_after:
+            params['StartAfter'] = self.key(start_after)
+        for page in self.client.get_paginator('list_objects_v2').paginate(**params):
+            for item in page.get('Contents', ()):
+                parts = item['Key'][len(self.prefix):].split('/')
+                # Skips the keys of other areas nested in this prefix (_derivatives/...).
+                if len(parts) == 3 and _SHARD_DIR.fullmatch(parts[0]) and _SHARD_DIR.fullmatch(parts[1]):
+                    yield parts[2]
+
+    def presign(self, name, expires_in, cache_control=None, download_name=None):
+        params = {'Bucket': self.bucket, 'Key': self.key(name)}
+        if cache_control:
+            params['ResponseCacheControl'] = cache_control
+        if download_name:
+            params['ResponseContentDisposition'] = f"attachment; filename*=UTF-8''{quote(download_name, safe='')}"
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=expires_in)
+
+_storages = {}  # (backend, area) -> Storage
+_storages_lock = threading.Lock()
+_s3_client = None
+
+def create_s3_client():
+    """Returns a boto3 S3 client; credentials come from the usual boto3 sources
+    (AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY, ~/.aws, instance roles)."""
+    if boto3 is None:
+        raise RuntimeError("STORAGE_BACKEND 's3' requires the boto3 package.")
+    if not app.config['S3_BUCKET']:
+        raise RuntimeError("STORAGE_BACKEND 's3' requires S3_BUCKET.")
+    # A client is thread-safe, so one per process shares its connection pool
+    # between all request and job threads.
+    return boto3.client('s3', endpoint_url=app.config['S3_ENDPOINT_URL'], region_name=app.config['S3_REGION'],
+                        config=BotoConfig(max_pool_connections=app.config['S3_MAX_POOL_CONNECTIONS'],
+                                          retries={'mode': 'standard'}))
+
+def get_storage(area):
+    """Returns the backend configured by STORAGE_BACKEND for a STORAGE_AREAS area."""
+    global _s3_client
+    backend = app.config['STORAGE_BACKEND']
+    with _storages_lock:
+        storage = _storages.get((backend, area))
+        if storage is None:
+            folder_key, key_prefix = STORAGE_AREAS[area]
+            if backend == 'local':
+                storage = LocalStorage(folder_key)
+            elif backend == 's3':
+                if _s3_client is None:
+                    _s3_client = create_s3_client()
+                storage = S3Storage(_s3_client, app.config['S3_BUCKET'], app.config['S3_PREFIX'] + key_prefix,
+                                    app.config['S3_PART_SIZE'])
+            else:
+                raise ValueError(f"Unknown STORAGE_BACKEND {backend!r}")
+            _storages[(backend, area)] = storage
+    return storage
+
+def blob_storage():
+    return get_storage('uploads')
+
+def derivative_storage():
+    return get_storage('derivatives')
+
+@app.cli.command('copy-storage')
+def copy_storage_command():
+    """Copies the stored files from the local folders into the configured backend."""
+    if app.config['STORAGE_BACKEND'] == 'local':
+        print("STORAGE_BACKEND is 'local'; set it to the target backend first.")
+        return
+    for area, (folder_key, _) in STORAGE_AREAS.items():
+        source, target = LocalStorage(folder_key), get_storage(area)
+        copied = 0
+        skipped = {os.path.abspath(app.config[key]) for key, _ in STORAGE_AREAS.values() if key != folder_key}
+        for directory, subdirectories, files in os.walk(source.folder):
+            # Areas nested in this folder (uploads/_derivatives) are copied on their own.
+            subdirectories[:] = [d for d in subdirectories if os.path.abspath(os.path.join(directory, d)) not in skipped]
+            for name in files:
+                if name.startswith('.') or target.exists(name):
+                    continue
+                with source.open(name) as f:
+                    target.put(name, f)
+                copied += 1
+        print(f"Copied {copied} files from {source.folder}.")
+
+# --- Reconciliation ---
+# `flask reconcile` finds stored files and database rows that disagree, e.g.
+# after a crash between a commit and publishing its staged file, or a restore
+# of only the database or only the files:
+#   orphan_file        a blob file without a blobs row
+#   missing_file       a blobs row whose file is gone
+#   orphan_derivative  an image variant whose blob has no blobs row
+#   dangling_document  a document referencing a blob without a blobs row
+#   stale_temp         a staged upload or chunked-upload part left behind in UPLOAD_FOLDER
+# The blob files and the blobs rows are walked side by side in name order, a
+# batch at a time, and compared by an ordered merge, so memory use is bounded
+# by the batch size however many files there are. The position of every walk
+# is saved in reconcile_progress; an interrupted run continues from there.
+# Orphan files can be moved to the quarantine area or deleted; the other
+# findings need a person (or a backup) and are only reported.
+Discrepancy = namedtuple('Discrepancy', ['kind', 'name', 'detail'])
+
+def in_shard_order(name):
+    """Whether a name sorts among stored names as it does among rows: it starts with its shard prefix."""
+    return len(name) >= 4 and set(name[:4]) <= _HEX_DIGITS
+
+def blob_row_exists(db, name):
+    return db.execute("SELECT 1 FROM blobs WHERE name = ?", (name,)).fetchone() is not None
+
+def derivative_source_exists(db, name):
+    """Whether a blobs row exists for the blob a derivative name was made from."""
+    stem = name.rsplit('_', 1)[0]
+    # Blob names are <stem>.<ext>, and '/' is the character after '.'.
+    return db.execute("SELECT 1 FROM blobs WHERE name >= ? AND name < ? LIMIT 1",
+                      (stem + '.', stem + '/')).fetchone() is not None
+
+SHARD_ORDERED_GLOB = '[0-9a-f][0-9a-f][0-9a-f][0-9a-f]*'  # SQL for in_shard_order()
+
+def missing_blob_files(storage, rows):
+    """Returns missing_file findings for blobs rows whose file does not exist.
+
+    Rows younger than RECONCILE_GRACE_SECONDS may belong to a file still being
+    published, and exists() also finds files of the old flat layout.
+    """
+    return [Discrepancy('missing_file', row['name'], 'blobs row without a file') for row in rows
+            if row['settled'] and not storage.exists(row['name'])]
+
+def reconcile_blobs_batch(db, after, batch_size):
+    """Compares the next batch of blob files with the blobs rows after name `after`.
+
+    Returns (discrepancies, cursor); the cursor is None once both walks are done.
+    """
+    storage = blob_storage()
+    # Names without a hex prefix are listed out of name order; they are checked
+    # one by one instead of merged.
+    strays = []
+    def ordered_names():
+        for name in storage.iter_names(after):
+            if in_shard_order(name):
+                yield name
+            else:
+                strays.append(name)
+    # Files are listed before rows are read: a row is committed before its file
+    # is published, so any listed file whose row exists has its row seen below.
+    files = list(islice(ordered_names(), batch_size))
+    rows = db.execute("""
+        SELECT name, created_at <= datetime('now', ?) AS settled FROM blobs
+        WHERE name > ? AND name GLOB ? ORDER BY name LIMIT ?
+    """, (f"-{app.config['RECONCILE_GRACE_SECONDS']} seconds", after or '', SHARD_ORDERED_GLOB,
+          batch_size)).fetchall()
+    # Only names up to the end of a full batch are known on both sides; the rest
+    # is compared in the next batch.
+    bounds = [side[-1] for side in (files, [row['name'] for row in rows]) if len(side) == batch_size]
+    cursor = min(bounds) if bounds else None
+    if cursor is not None:
+        end = (*shard_prefix(cursor), cursor)
+        files = [name for name in files if name <= cursor]
+        strays = [name for name in strays if (*shard_prefix(name), name) <= end]
+        rows = [row for row in rows if row['name'] <= cursor]
+
+    orphans = [name for name in strays if not blob_row_exists(db, name)]
+    missing = []
+    i = j = 0
+    while i < len(files) or j < len(rows):
+        if j == len(rows) or (i < len(files) and files[i] < rows[j]['name']):
+            orphans.append(files[i])
+            i += 1
+        elif i == len(files) or rows[j]['name'] < files[i]:
+            missing.append(rows[j])
+            j += 1
+        else:
+            i += 1
+            j += 1
+    findings = [Discrepancy('orphan_file', name, 'no blobs row') for name in orphans]
+    findings.extend(missing_blob_files(storage, missing))
+    return findings, cursor
+
+def reconcile_unordered_blobs_batch(db, after, batch_size):
+    """Checks the files of the next batch of blobs rows left out of the merge (no hex prefix)."""
+    rows = db.execute("""
+        SELECT name, created_at <= datetime('now', ?) AS settled FROM blobs
+        WHERE name > ? AND NOT name GLOB ? ORDER BY name LIMIT ?
+    """, (f"-{app.config['RECONCILE_GRACE_SECONDS']} seconds", after or '', SHARD_ORDERED_GLOB,
+          batch_size)).fetchall()
+    return missing_blob_files(blob_storage(), rows), (rows[-1]['name'] if len(rows) == batch_size else None)
+
+def reconcile_derivatives_batch(db, after, batch_size):
+    """Checks the next batch of derivative files after `after` for a source blob."""
+    names = list(islice(derivative_storage().iter_names(after), batch_size))
+    findings = [Discrepancy('orphan_derivative', name, 'no blobs row for its blob') for name in names
+                if not derivative_source_exists(db, name)]
+    return findings, (names[-1] if len(names) == batch_size else None)
+
+def reconcile_documents_batch(db, after, batch_size):
+    """Checks the blobs referenced by the next batch of documents after id `after`."""
+    rows = db.execute("""
+        SELECT d.id, d.blob, d.blob_back, front.name AS front_row, back.name AS back_row
+        FROM documents d
+        LEFT JOIN blobs front ON front.name = d.blob
+        LEFT JOIN blobs back ON back.name = d.blob_back
+        WHERE d.id > ? ORDER BY d.id LIMIT ?
+    """, (int(after or 0), batch_size)).fetchall()
+    findings = []
+    for row in rows:
+        for blob, found in ((row['blob'], row['front_row']), (row['blob_back'], row['back_row'])):
+            if blob and found is None:
+                findings.append(Discrepancy('dangling_document', blob, f"document {row['id']}"))
+    return findings, (str(rows[-1]['id']) if len(rows) == batch_size else None)
+
+RECONCILE_WALKS = {
+    'blobs': reconcile_blobs_batch,
+    'unordered_blobs': reconcile_unordered_blobs_batch,
+    'derivatives': reconcile_derivatives_batch,
+    'documents': reconcile_documents_batch,
+}
+
+def reconcile_scratch(db):
+    """Finds staging files in UPLOAD_FOLDER older than the grace period that no request will finish.
+
+    Files of the flat layout lying next to them are checked for a blobs row too.
+    """
+    cutoff = time.time() - app.config['RECONCILE_GRACE_SECONDS']
+    findings = []
+    try:
+        entries = list(os.scandir(app.config['UPLOAD_FOLDER']))
+    except FileNotFoundError:
+        return findings
+    for entry in entries:
+        if not entry.is_file(follow_symlinks=False):
+            continue
+        name = entry.name
+        if not name.startswith('.'):
+            if app.config['STORAGE_BACKEND'] == 'local' and not blob_row_exists(db, name):
+                findings.append(Discrepancy('orphan_file', name, 'no blobs row (flat layout)'))
+        elif name.startswith('.upload-') and entry.stat().st_mtime < cutoff:
+            findings.append(Discrepancy('stale_temp', name, 'staged upload'))
+        elif name.startswith('.chunked-') and entry.stat().st_mtime < cutoff:
+            upload_id = name[len('.chunked-'):].rsplit('.', 1)[0]
+            if not db.execute("SELECT 1 FROM uploads WHERE id = ?", (upload_id,)).fetchone():
+                findings.append(Discrepancy('stale_temp', name, 'part of a deleted chunked upload'))
+    return findings
+
+def dispose_orphans(db, area, names, action):
+    """Quarantines or deletes files of an area that are still orphaned. Returns the number handled.
+
+    Orphan blobs are claimed like in unlink_unreferenced_blobs(): rechecked and
+    marked in blob_deletions under the write lock, then copied and deleted after
+    the commit. Derivatives are only rechecked; one regenerated meanwhile for a
+    new upload of its blob may be lost, and the page falls back to the original.
+    """
+    if not names:
+        return 0
+    storage, quarantine = get_storage(area), get_storage('quarantine')
+    if area == 'uploads':
+        names = mark_blob_deletions(db, names)
+    else:
+        names = [name for name in names if not derivative_source_exists(db, name)]
+    handled = 0
+    for name in names:
+        try:
+            if action == 'quarantine':
+                try:
+                    with storage.open(name) as f:
+                        quarantine.put(name, f)
+                except FileNotFoundError:
+                    continue
+            storage.delete(name)
+            if area == 'uploads':
+                remove_derivatives(name)
+            handled += 1
+        finally:
+            if area == 'uploads':
+                db.execute("DELETE FROM blob_deletions WHERE name = ?", (name,))
+                db.commit()
+    return handled
+
+def dispose_temp_files(names, action):
+    """Quarantines or deletes stale scratch files of UPLOAD_FOLDER."""
+    for name in names:
+        path = os.path.join(app.config['UPLOAD_FOLDER'], name)
+        try:
+            if action == 'quarantine':
+                with open(path, 'rb') as f:
+                    get_storage('quarantine').put(name.lstrip('.'), f)
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def apply_reconcile_action(db, findings, action):
+    """Quarantines or deletes the orphan files among findings; 'report' leaves them."""
+    if action == 'report':
+        return
+    dispose_orphans(db, 'uploads', [f.name for f in findings if f.kind == 'orphan_file'], action)
+    dispose_orphans(db, 'derivatives', [f.name for f in findings if f.kind == 'orphan_derivative'], action)
+    dispose_temp_files([f.name for f in findings if f.kind == 'stale_temp'], action)
+
+def reconcile_cursor(db, walk):
+    row = db.execute("SELECT cursor FROM reconcile_progress WHERE walk = ?", (walk,)).fetchone()
+    return row['cursor'] if row else None
+
+def save_reconcile_cursor(db, walk, cursor):
+    """Saves the position of a walk; None marks it finished, so the next pass starts over."""
+    if cursor is None:
+        db.execute("DELETE FROM reconcile_progress WHERE walk = ?", (walk,))
+    else:
+        db.execute("""
+            INSERT INTO reconcile_progress (walk, cursor) VALUES (?, ?)
+            ON CONFLICT (walk) DO UPDATE SET cursor = excluded.cursor, updated_at = CURRENT_TIMESTAMP
+        """, (walk, cursor))
+    db.commit()
+
+def reconcile_pass(db, action, batch_size, pause):
+    """Runs one pass over all walks, from their saved positions. Returns the findings count."""
+    found = 0
+    for walk, compare_batch in RECONCILE_WALKS.items():
+        cursor = reconcile_cursor(db, walk)
+        while True:
+            findings, cursor = compare_batch(db, cursor, batch_size)
+            for finding in findings:
+                print(f"  {finding.kind}: {finding.name} ({finding.detail})")
+            apply_reconcile_action(db, findings, action)
+            save_reconcile_cursor(db, walk, cursor)
+            found += len(findings)
+            if cursor is None:
+                break
+            time.sleep(pause)
+    findings = reconcile_scratch(db)
+    for finding in findings:
+        print(f"  {finding.kind}: {finding.name} ({finding.detail})")
+    apply_reconcile_action(db, findings, action)
+    return found + len(findings)
+
+def lower_io_priority():
+    """Makes this process the last in line for CPU time and, following it, disk I/O.
+
+    Linux derives the I/O priority of a process that has none set from its nice
+    value, so nice 19 is the lowest best-effort I/O level.
+    """
+    if hasattr(os, 'nice'):
+        os.nice(19)
+
+@app.cli.command('reconcile')
+@click.option('--action', type=click.Choice(['report', 'quarantine', 'purge']), default='report', show_default=True,
+              help='What to do with orphan files; the other findings are only reported.')
+@click.option('--batch-size', default=500, show_default=True, help='Files or rows compared per batch.')
+@click.option('--pause', default=0.5, show_default=True, help='Seconds to sleep between batches.')
+@click.option('--continuous', is_flag=True, help='Start another pass --interval seconds after each one.')
+@click.option('--interval', default=3600, show_default=True, help='Seconds between passes with --continuous.')
+@click.option('--restart', is_flag=True, help='Start from the beginning instead of the saved position.')
+@click.option('--low-priority/--normal-priority', default=True, show_default=True,
+              help='Run at the lowest CPU and I/O priority.')
+def reconcile_command(action, batch_size, pause, continuous, interval, restart, low_priority):
+    """Reports files without rows and rows without files, and optionally quarantines or purges the files."""
+    if low_priority:
+        lower_io_priority()
+    db = get_db()
+    if restart:
+        db.execute("DELETE FROM reconcile_progress")
+        db.commit()
+    while True:
+        print(f"Reconciliation pass done: {reconcile_pass(db, action, batch_size, pause)} discrepancies.")
+        if not continuous:
+            return
+        time.sleep(interval)
+
+# --- Image Normalization ---
+# Opt-in (IMAGE_NORMALIZATION = 'optimize'): phone photos arrive as 4-5 MB
+# JPEGs with large EXIF blocks and an orientation flag. Each staged image is
+# turned upright, stripped of metadata (the ICC colour profile is kept; CMYK
+# is converted through it to sRGB), scaled down to at most IMAGE_MAX_DPI
+# across a page of IMAGE_PAGE_INCHES and re-encoded: as progressive JPEG for
+# photographs, as optimized lossless PNG for PNGs with transparency or few
+# colours (line art, screenshots). An upright, small enough image without
+# metadata whose re-encoding is not smaller is kept as uploaded. The default
+# 'preserve' stores uploads byte for byte.
+def normalized_format(image, source_format):
+    """Returns 'PNG' or 'JPEG' for a decoded image."""
+    if source_format != 'PNG':
+        return 'JPEG'
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        return 'PNG'
+    return 'PNG' if image.getcolors(256) is not None else 'JPEG'
+
+# Image.info keys of metadata a re-encode drops (EXIF with GPS tags, XMP,
+# comments, Photoshop/IPTC blocks)
+METADATA_INFO_KEYS = ('exif', 'xmp', 'XML:com.adobe.xmp', 'comment', 'photoshop')
+
+def carries_metadata(image):
+    """Returns True when a decoded image carries metadata beyond its ICC profile."""
+    if len(image.getexif()) or any(key in image.info for key in METADATA_INFO_KEYS):
+        return True
+    return bool(getattr(image, 'text', None))  # PNG tEXt / iTXt / zTXt chunks
+
+def rgb_image(image, icc_profile):
+    """Converts an image for a JPEG to RGB. Returns (image, ICC profile to embed).
+
+    Modes that already are RGB (alpha, palette) keep their profile. Others, CMYK
+    above all, are converted through their profile to sRGB when ImageCms is
+    available, and their profile is dropped: it describes the source colour
+    space, not the RGB result.
+    """
+    if image.mode in ('RGBA', 'RGBX', 'P', 'PA'):
+        return image.convert('RGB'), icc_profile
+    if icc_profile and ImageCms is not None:
+        try:
+            source = ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+            return ImageCms.profileToProfile(image, source, ImageCms.createProfile('sRGB'), outputMode='RGB'), None
+        except (ImageCms.PyCMSError, OSError, ValueError):
+            pass
+    return image.convert('RGB'), None
+
+def normalize_staged_image(staged):
+    """Re-encodes a staged image and returns the StagedBlob of the result.
+
+    Returns `staged` unchanged when Pillow cannot decode it, or when the image
+    carries no metadata, needs no downscaling and re-encoding would not make it
+    smaller. Logs the bytes saved and adds them to the image_normalization_*
+    metrics.
+    """
+    try:
+        with Image.open(staged.tmp_path) as original:
+            source_format = original.format
+            icc_profile = original.info.get('icc_profile')
+            # Only an image without metadata may be kept as uploaded; it is also
+            # upright, as the orientation flag is EXIF.
+            keepable = not carries_metadata(original)
+            image = ImageOps.exif_transpose(original)
+            limit = round(app.config['IMAGE_MAX_DPI'] * app.config['IMAGE_PAGE_INCHES'])
+            if max(image.size) > limit:
+                image.thumbnail((limit, limit), Image.LANCZOS)
+                keepable = False
+            output_format = normalized_format(image, source_format)
+            buffered = io.BytesIO()
+            if output_format == 'JPEG':
+                if image.mode not in ('RGB', 'L'):
+                    image, icc_profile = rgb_image(image, icc_profile)
+                image.save(buffered, 'JPEG', quality=app.config['IMAGE_JPEG_QUALITY'],
+                           optimize=True, progressive=True, icc_profile=icc_profile)
+            else:
+                image.save(buffered, 'PNG', optimize=True, icc_profile=icc_profile)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        app.logger.warning("Image normalization skipped for %s: %s", staged.name, e)
+        return staged
+
+    if keepable and buffered.tell() >= staged.size:
+        # Only generation loss to gain, e.g. an already optimized JPEG. Images
+        # with metadata are always re-encoded, so it cannot survive.
+        metrics.inc('image_normalization_input_bytes_total', staged.size)
+        metrics.inc('image_normalization_output_bytes_total', staged.size)
+        app.logger.info("Image %s kept as uploaded: re-encoding gave %d bytes, not fewer than %d",
+                        staged.name, buffered.tell(), staged.size)
+        return staged
+    buffered.seek(0)
+    extension = 'jpg' if output_format == 'JPEG' else 'png'
+    with open(staged.tmp_path, 'wb') as out:
+        normalized = copy_and_hash(buffered, out, extension, staged.tmp_path)
+    metrics.inc('image_normalization_input_bytes_total', staged.size)
+    metrics.inc('image_normalization_output_bytes_total', normalized.size)
+    app.logger.info("Normalized image %s -> %s: %d -> %d bytes (%d saved)", staged.name, normalized.name,
+                    staged.size, normalized.size, staged.size - normalized.size)
+    return normalized
+
+# --- QR Codes ---
+# QR images depend only on their payload, so they are memoized by payload hash:
+# an in-process LRU tier plus an optional on-disk tier (QR_CACHE_DIR) shared by
+# all workers. A QR is rendered once per document revision, not once per view.
+qr_cache = LRUCache(app.config['QR_CACHE_SIZE'])
+
+def qr_payload(document):
+    """Returns the text encoded in a document's QR code."""
+    return f"Document Name: {document['name']}, Type: {document['document_type']}, ID: {document['id']}"
+
+def qr_etag(payload):
+    """Returns the cache key / ETag for a QR payload."""
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+def render_qr_png(payload):
+    """Returns (etag, png_bytes) for payload, rendering it only on a cache miss."""
+    key = qr_etag(payload)
+    png = qr_cache.get(key)
+    if png is not None:
+        return key, png
+
+    cache_dir = app.config['QR_CACHE_DIR']
+    path = os.path.join(cache_dir, key[:2], f"{key}.png") if cache_dir else None
+    if path and os.path.exists(path):
+        with open(path, 'rb') as f:
+            png = f.read()
+    else:
+        started = time.perf_counter()
+        buffered = io.BytesIO()
+        qrcode.make(payload).save(buffered, format="PNG")
+        png = buffered.getvalue()
+        metrics.observe('qr_render_seconds', time.perf_counter() - started)
+        if path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # A temporary file per call: threads rendering the same payload must not share one.
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=f".{key}.", suffix='.tmp',
+                                             delete=False) as f:
+                f.write(png)
+            os.replace(f.name, path)
+    qr_cache.set(key, png)
+    return key, png
+
+# --- Image Derivatives ---
+# Every stored image gets resized JPEG variants (DERIVATIVE_WIDTHS) generated by
+# the background job workers once the document is committed. Pages reference
+# them through `srcset`; uploaded_derivative() falls back to the original until
+# they exist.
+
+def derivative_name(blob, width):
+    """Returns the stored name of the `width` pixels wide variant of a blob."""
+    return f"{blob.rsplit('.', 1)[0]}_{width}w.jpg"
+
+def generate_derivatives(blob):
+    """Writes the resized variants of a stored image blob, skipping up-scaling.
+
+    Records the width of the image in blobs.width: variants as wide or wider
+    are never made, and pages link the original for those widths instead.
+    """
+    storage = derivative_storage()
+    with blob_storage().open(blob) as source, Image.open(source) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'L'):
+            # JPEG has no alpha channel: flatten transparent PNG scans onto white.
+            background = Image.new('RGB', img.size, 'white')
+            background.paste(img, mask=img.convert('RGBA'))
+            img = background
+        for width in app.config['DERIVATIVE_WIDTHS']:
+            if width >= img.width:
+                continue
+            variant = img.copy()
+            variant.thumbnail((width, img.height), Image.LANCZOS)
+            buffered = io.BytesIO()
+            variant.save(buffered, format='JPEG', optimize=True, progressive=True,
+                         quality=app.config['DERIVATIVE_QUALITY'].get(width, 80))
+            buffered.seek(0)
+            storage.put(derivative_name(blob, width), buffered)
+    db = get_db()
+    db.execute("UPDATE blobs SET width = ? WHERE name = ?", (img.width, blob))
+    db.commit()
+    if not blob_storage().exists(blob):
+        # The blob was unlinked while we were resizing it.
+        remove_derivatives(blob)
+
+def schedule_derivatives(db, *blobs):
+    """Enqueues derivative generation for the given image blobs in the caller's transaction."""
+    for blob in blobs:
+        if blob and is_image(blob):
+            enqueue_job(db, 'generate_derivatives', blob=blob)
+
+def remove_derivatives(*blobs):
+    """Deletes the variants of the given blobs, ignoring missing ones."""
+    storage = derivative_storage()
+    for blob in blobs:
+        if not blob:
+            continue
+        for width in app.config['DERIVATIVE_WIDTHS']:
+            storage.delete(derivative_name(blob, width))
+
+def derivative_widths(source_width):
+    """Returns the DERIVATIVE_WIDTHS generated for an image, all of them while its width is unknown."""
+    return [width for width in app.config['DERIVATIVE_WIDTHS'] if source_width is None or width < source_width]
+
+@app.template_global()
+def image_srcset(filename, source_width=None):
+    """Builds the srcset attribute value listing the variants of an uploaded image.
+
+    Once the width of the image is known (blobs.width), only the variants that
+    exist are listed, followed by the original at its own width.
+    """
+    candidates = [f"{url_for('uploaded_derivative', filename=filename, width=width)} {width}w"
+                  for width in derivative_widths(source_width)]
+    if source_width is not None:
+        candidates.append(f"{url_for('uploaded_file', filename=filename)} {source_width}w")
+    return ', '.join(candidates)
+
+@app.cli.command('generate-derivatives')
+def generate_derivatives_command():
+    """Generates missing image variants for all stored blobs."""
+    db = get_db()
+    storage = derivative_storage()
+    count = 0
+    for blob, width in db.execute("SELECT name, width FROM blobs").fetchall():
+        if is_image(blob) and (width is None or
+                               not all(storage.exists(derivative_name(blob, w)) for w in derivative_widths(width))):
+            try:
+                generate_derivatives(blob)
+            except Exception:
+                app.logger.exception("Could not generate derivatives for %s", blob)
+            count += 1
+    print(f"Generated derivatives for {count} images.")
+
+# --- Background Jobs ---
+# Disk work that follows a database change (unlinking blobs, generating image
+# variants) is queued in the jobs table inside the same transaction as the
+# change, so it is neither lost on a crash nor started before the commit.
+# Worker threads in each process claim jobs, retry failures with exponential
+# backoff and mark a job failed after JOB_MAX_ATTEMPTS.
+JOB_HANDLERS = {}
+
+def job_handler(kind):
+    """Registers the decorated function as the handler for jobs of `kind`."""
+    def decorator(func):
+        JOB_HANDLERS[kind] = func
+        return func
+    return decorator
+
+def enqueue_job(db, kind, **payload):
+    """Queues a job inside the caller's transaction; it becomes visible on commit."""
+    db.execute("INSERT INTO jobs (kind, payload, run_after) VALUES (?, ?, ?)",
+               (kind, json.dumps(payload), time.time()))
+
+def claim_job(db, ignore_backoff=False):
+    """Marks the next runnable job as running and returns it, or None."""
+    now = time.time()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        job = db.execute(
+            "SELECT * FROM jobs WHERE (status = 'queued' AND run_after <= ?) "
+            "OR (status = 'running' AND locked_at < ?) ORDER BY run_after LIMIT 1",
+            (float('inf') if ignore_backoff else now, now - app.config['JOB_LEASE_SECONDS'])).fetchone()
+        if job is not None:
+            db.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_at = ? WHERE id = ?",
+                       (now, job['id']))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return job
+
+def run_job(db, job):
+    """Runs a claimed job; deletes it on success, reschedules or fails it otherwise."""
+    try:
+        JOB_HANDLERS[job['kind']](**json.loads(job['payload']))
+    except Exception as e:
+        attempts = job['attempts'] + 1
+        app.logger.warning("Job %s (%s) failed on attempt %s: %s", job['id'], job['kind'], attempts, e)
+        if attempts >= app.config['JOB_MAX_ATTEMPTS']:
+            db.execute("UPDATE jobs SET status = 'failed', last_error = ? WHERE id = ?", (repr(e), job['id']))
+        else:
+            delay = app.config['JOB_RETRY_DELAY'] * 2 ** (attempts - 1)
+            db.execute("UPDATE jobs SET status = 'queued', run_after = ?, last_error = ? WHERE id = ?",
+                       (time.time() + delay, repr(e), job['id']))
+        db.commit()
+        return False
+    db.execute("DELETE FROM jobs WHERE id = ?", (job['id'],))
+    db.commit()
+    return True
+
+def run_pending_jobs(db, limit=None, ignore_backoff=False):
+    """Runs runnable jobs until none are left (or `limit` ran). Returns the count."""
+    count = 0
+    while limit is None or count < limit:
+        job = claim_job(db, ignore_backoff)
+        if job is None:
+            break
+        run_job(db, job)
+        count += 1
+    return count
+
+class JobWorkers:
+    """JOB_WORKERS daemon threads per process polling the jobs table."""
+
+    def __init__(self):
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def ensure_started(self):
+        if self._pid == os.getpid() or app.config['JOB_WORKERS'] <= 0:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for i in range(app.config['JOB_WORKERS']):
+                threading.Thread(target=self._run, name=f'jobs-{i}', daemon=True).start()
+
+    def notify(self):
+        """Wakes the workers after a transaction that enqueued jobs has committed."""
+        self.ensure_started()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            try:
+                with app.app_context():
+                    ran = run_pending_jobs(get_db(), limit=100)
+            except Exception:
+                app.logger.exception("Job worker error")
+                ran = 0
+            if not ran:
+                self._wakeup.wait(app.config['JOB_POLL_INTERVAL'])
+                self._wakeup.clear()
+
+job_workers = JobWorkers()
+
+@app.before_request
+def start_job_workers():
+    job_workers.ensure_started()
+
+@job_handler('unlink_blobs')
+def unlink_blobs_job(names):
+    unlink_unreferenced_blobs(get_db(), names)
+
+@job_handler('generate_derivatives')
+def generate_derivatives_job(blob):
+    # The job can run between the commit and publish_staged(): if the blob is
+    # still referenced, a missing file raises and the job is retried later.
+    if get_db().execute("SELECT 1 FROM blobs WHERE name = ?", (blob,)).fetchone():
+        generate_derivatives(blob)
+
+@app.cli.group('jobs')
+def jobs_cli():
+    """Background job queue commands."""
+
+@jobs_cli.command('list')
+@click.option('--status', type=click.Choice(['queued', 'running', 'failed']), default=None)
+@click.option('--limit', default=50, show_default=True)
+def jobs_list_command(status, limit):
+    """Shows queue totals and the oldest jobs."""
+    db = get_db()
+    for row in db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"):
+        print(f"{row[0]}: {row[1]}")
+    query = "SELECT * FROM jobs" + (" WHERE status = ?" if status else "") + " ORDER BY run_after LIMIT ?"
+    for job in db.execute(query, ((status,) if status else ()) + (limit,)):
+        run_after = datetime.fromtimestamp(job['run_after']).isoformat(' ', 'seconds')
+        print(f"  #{job['id']} {job['kind']} {job['status']} attempts={job['attempts']} "
+              f"run_after={run_after} {job['payload']}" + (f" error={job['last_error']}" if job['last_error'] else ''))
+
+@jobs_cli.command('drain')
+@click.option('--ignore-backoff', is_flag=True, help='Also run jobs still waiting for a retry.')
+def jobs_drain_command(ignore_backoff):
+    """Runs all runnable jobs in the foreground."""
+    print(f"Ran {run_pending_jobs(get_db(), ignore_backoff=ignore_backoff)} jobs.")
+
+@jobs_cli.command('retry-failed')
+def jobs_retry_failed_command():
+    """Requeues failed jobs with a fresh attempt budget."""
+    db = get_db()
+    cursor = db.execute("UPDATE jobs SET status = 'queued', attempts = 0, run_after = ? WHERE status = 'failed'",
+                        (time.time(),))
+    db.commit()
+    print(f"Requeued {cursor.rowcount} jobs.")
+
+# --- Password Hashing ---
+# PBKDF2 is deliberately slow. Hashes are computed in a small process pool so
+# a burst of logins cannot occupy every request thread (or the GIL), and only
+# PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE hash operations are admitted at
+# a time: beyond that, and beyond the per-IP and per-username token buckets,
+# /login and /register answer 429 at once instead of queueing.
+class HashingBusy(Exception):
+    """Raised when the password hashing pool has no free slot."""
+
+class PasswordHasher:
+    """Bounded process pool for generate_password_hash() / check_password_hash()."""
+
+    def __init__(self):
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            workers = app.config['PASSWORD_HASH_WORKERS']
+            # spawn: forking a process that runs request and job threads can deadlock the child
+            self._executor = (ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+                              if workers > 0 else None)
+            self._slots = threading.BoundedSemaphore(max(workers, 1) + app.config['PASSWORD_HASH_QUEUE'])
+            self._pid = os.getpid()
+
+    def _run(self, func, *args):
+        self._start()
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            if self._executor is None:
+                return func(*args)
+            return self._executor.submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def generate(self, password):
+        return self._run(generate_password_hash, password, 'pbkdf2:sha256')
+
+    def check(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+password_hasher = PasswordHasher()
+
+class TokenBuckets:
+    """Token buckets keyed by client, e.g. an IP address or a username.
+
+    Each key may spend `burst` tokens at once and regains `per_minute` tokens a
+    minute. Only the `capacity` most recently used keys are tracked.
+    """
+
+    def __init__(self, capacity):
+        self._buckets = LRUCache(capacity)
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, per_minute):
+        """Spends a token. Returns 0, or the seconds until a token is available."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * per_minute / 60)
+            if tokens >= 1:
+                self._buckets.set(key, (tokens - 1, now))
+                return 0
+            self._buckets.set(key, (tokens, now))
+            return (1 - tokens) * 60 / per_minute
+
+auth_buckets = TokenBuckets(app.config['AUTH_RATE_LIMIT_KEYS'])
+
+def auth_retry_after(username):
+    """Charges an authentication attempt to the client IP and the username.
+
+    Returns 0 when it may proceed, otherwise the seconds the client should wait.
+    """
+    retry_after = auth_buckets.take(('ip', request.remote_addr), app.config['AUTH_IP_BURST'],
+                                    app.config['AUTH_IP_PER_MINUTE'])
+    if not retry_after and username:
+        retry_after = auth_buckets.take(('user', username.lower()), app.config['AUTH_USERNAME_BURST'],
+                                        app.config['AUTH_USERNAME_PER_MINUTE'])
+    return retry_after
+
+def too_many_attempts(template, retry_after):
+    """Renders `template` as a 429 response with a Retry-After header."""
+    flash('محاولات كثيرة جدًا. يرجى المحاولة مرة أخرى بعد قليل.', 'danger')
+    response = app.make_response((render_template(template,
+                                                  document_types_with_expiry=DOCUMENT_TYPES_WITH_EXPIRY,
+                                                  document_types_with_back_side=DOCUMENT_TYPES_WITH_BACK_SIDE), 429))
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
 # --- User Authentication Routes ---
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -101,7 +2016,13 @@ def register():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
+        retry_after = auth_retry_after(None)
+        if retry_after:
+            return too_many_attempts('register.html', retry_after)
+        try:
+            hashed_password = password_hasher.generate(password)
+        except HashingBusy:
+            return too_many_attempts('register.html', 1)
 
         db = get_db()
         try:
@@ -124,10 +2045,18 @@ def login():
         username = request.form['username']
         password = request.form['password']
 
-        db = get_db()
+        retry_after = auth_retry_after(username)
+        if retry_after:
+            return too_many_attempts('login.html', retry_after)
+
+        db = get_read_db()
         user = db.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+        try:
+            valid = user is not None and password_hasher.check(user['password'], password)
+        except HashingBusy:
+            return too_many_attempts('login.html', 1)
 
-        if user and check_password_hash(user['password'], password):
+        if valid:
             session['user_id'] = user['id']
             session['username'] = user['username']
             flash('تم تسجيل الدخول بنجاح!', 'success')
@@ -148,7 +2077,167 @@ def logout():
     flash('تم تسجيل خروجك بنجاح.', 'info')
     return redirect(url_for('login'))
 
+# --- Dashboard Cache ---
+# Rendered dashboard pages are cached per user and page. Triggers on documents
+# bump users.revision in the same transaction as every change to a user's
+# documents, so a cached page is valid exactly as long as the revision it was
+# rendered at is current: nothing is ever invalidated, and worker processes
+# never have to tell each other about a change. The ETag is derived from the
+# revision as well, so an unchanged dashboard is answered with 304 before any
+# document is read.
+RenderedPage = namedtuple('RenderedPage', ['revision', 'body'])
+
+class MemoryRenderCache:
+    """Rendered pages kept in this process."""
+
+    def __init__(self, capacity):
+        self._pages = LRUCache(capacity)
+
+    def get(self, key):
+        return self._pages.get(key)
+
+    def set(self, key, page):
+        self._pages.set(key, page)
+
+class SQLiteRenderCache:
+    """Rendered pages in an SQLite file shared by all worker processes of a host.
+
+    It only holds copies, so it skips fsync and treats any SQLite error as a miss.
+    """
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self._local = threading.local()
+
+    def _connection(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, isolation_level=None)
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = OFF')
+            db.execute('PRAGMA busy_timeout = 100')
+            db.execute('CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, revision INTEGER NOT NULL, '
+                       'body BLOB NOT NULL)')
+            self._local.db, self._local.pid = db, os.getpid()
+        return self._local.db
+
+    def get(self, key):
+        try:
+            row = self._connection().execute("SELECT revision, body FROM pages WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error:
+            app.logger.warning("Dashboard cache read failed", exc_info=True)
+            return None
+        return RenderedPage(*row) if row else None
+
+    def set(self, key, page):
+        try:
+            db = self._connection()
+            cursor = db.execute("INSERT OR REPLACE INTO pages (key, revision, body) VALUES (?, ?, ?)",
+                                (key, page.revision, page.body))
+            # A replaced row gets a new rowid, so the lowest rowids were stored longest ago.
+            db.execute("DELETE FROM pages WHERE rowid <= ?", (cursor.lastrowid - self.capacity,))
+        except sqlite3.Error:
+            app.logger.warning("Dashboard cache write failed", exc_info=True)
+
+_dashboard_caches = {}  # (backend, size, path) -> cache
+_dashboard_caches_lock = threading.Lock()
+_dashboard_render_version = None
+
+def dashboard_cache():
+    """Returns the cache configured by DASHBOARD_CACHE, or None when caching is off."""
+    backend = app.config['DASHBOARD_CACHE']
+    if not backend:
+        return None
+    config = (backend, app.config['DASHBOARD_CACHE_SIZE'], app.config['DASHBOARD_CACHE_PATH'])
+    with _dashboard_caches_lock:
+        cache = _dashboard_caches.get(config)
+        if cache is None:
+            if backend == 'memory':
+                cache = MemoryRenderCache(config[1])
+            elif backend == 'sqlite':
+                cache = SQLiteRenderCache(config[2], config[1])
+            else:
+                raise ValueError(f"Unknown DASHBOARD_CACHE {backend!r}")
+            _dashboard_caches[config] = cache
+    return cache
+
+def dashboard_render_version():
+    """Identifies the templates and assets the dashboard is rendered with.
+
+    It is part of every cache key and ETag, so a deploy never serves a page
+    rendered by the previous release.
+    """
+    global _dashboard_render_version
+    if _dashboard_render_version is None:
+        digest = hashlib.sha256()
+        for name in ('base.html', 'dashboard.html'):
+            digest.update(TEMPLATES[name].encode('utf-8'))
+        for name, fingerprinted in sorted(fingerprinted_assets().items()):
+            digest.update(fingerprinted.encode('utf-8'))
+        _dashboard_render_version = digest.hexdigest()[:16]
+    return _dashboard_render_version
+
 # --- Dashboard ---
+# Columns used by the document cards in dashboard.html
+DASHBOARD_COLUMNS = 'id, name, document_type, issue_date, expiry_date, upload_date, filename, filename_back'
+
+def encode_cursor(document):
+    """Encodes a document's (upload_date, id) sort key as an opaque URL-safe cursor."""
+    key = f"{document['upload_date']}|{document['id']}"
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """Decodes a cursor produced by encode_cursor. Returns None if it is malformed."""
+    if not cursor:
+        return None
+    try:
+        key = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        upload_date, doc_id = key.rsplit('|', 1)
+        return upload_date, int(doc_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def fetch_documents_page(db, user_id, page_size, after=None, before=None, columns=DASHBOARD_COLUMNS):
+    """Fetches one page of a user's documents, newest first, using keyset pagination.
+
+    `after` continues towards older documents and `before` goes back towards newer
+    ones. Returns (documents, next_cursor, prev_cursor); a cursor is None when
+    there is no page in that direction. Each page is a single index range scan on
+    idx_documents_user_upload, so its cost does not grow with the account size.
+    `columns` must include id and upload_date, which make up the cursors.
+    """
+    before_key = decode_cursor(before)
+    after_key = None if before_key else decode_cursor(after)
+
+    if before_key:
+        rows = db.execute(f"SELECT {columns} FROM documents "
+                          "WHERE user_id = ? AND (upload_date, id) > (?, ?) "
+                          "ORDER BY upload_date ASC, id ASC LIMIT ?",
+                          (user_id, before_key[0], before_key[1], page_size + 1)).fetchall()
+        if not rows:
+            # Nothing newer than the cursor any more: show the first page.
+            return fetch_documents_page(db, user_id, page_size, columns=columns)
+        has_newer = len(rows) > page_size
+        documents = rows[:page_size][::-1]
+        next_cursor = encode_cursor(documents[-1]) if documents else None
+        prev_cursor = encode_cursor(documents[0]) if has_newer else None
+        return documents, next_cursor, prev_cursor
+
+    if after_key:
+        rows = db.execute(f"SELECT {columns} FROM documents "
+                          "WHERE user_id = ? AND (upload_date, id) < (?, ?) "
+                          "ORDER BY upload_date DESC, id DESC LIMIT ?",
+                          (user_id, after_key[0], after_key[1], page_size + 1)).fetchall()
+    else:
+        rows = db.execute(f"SELECT {columns} FROM documents "
+                          "WHERE user_id = ? ORDER BY upload_date DESC, id DESC LIMIT ?",
+                          (user_id, page_size + 1)).fetchall()
+    has_older = len(rows) > page_size
+    documents = rows[:page_size]
+    next_cursor = encode_cursor(documents[-1]) if has_older else None
+    prev_cursor = encode_cursor(documents[0]) if after_key and documents else None
+    return documents, next_cursor, prev_cursor
+
 @app.route('/')
 @app.route('/dashboard')
 def dashboard():
@@ -158,15 +2247,223 @@ def dashboard():
         return redirect(url_for('login'))
 
     user_id = session['user_id']
-    db = get_db()
-    documents = db.execute("SELECT * FROM documents WHERE user_id = ? ORDER BY upload_date DESC", (user_id,)).fetchall()
+    # Read before the documents: a change committed in between only makes the
+    # page newer than the revision it is stored under, never older.
+    user = get_read_db().execute("SELECT revision FROM users WHERE id = ?", (user_id,)).fetchone()
+    if user is None:
+        # The account is gone; the session outlived it
+        session.pop('user_id', None)
+        session.pop('username', None)
+        flash('يرجى تسجيل الدخول للوصول إلى لوحة التحكم.', 'warning')
+        return redirect(url_for('login'))
+
+    cache = dashboard_cache()
+    if cache is None or '_flashes' in session:
+        # Flashed messages are part of the page, so it is rendered fresh.
+        return render_dashboard(user_id)
+
+    revision = user['revision']
+    key = '|'.join([dashboard_render_version(), str(user_id)]
+                   + [request.args.get(arg, '') for arg in ('per_page', 'after', 'before')])
+    etag = hashlib.blake2b(f"{key}|{revision}".encode('utf-8'), digest_size=16).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        metrics.inc('dashboard_cache_requests_total', result='not_modified')
+        response = app.response_class(status=304)
+    else:
+        page = cache.get(key)
+        if page is not None and page.revision == revision:
+            metrics.inc('dashboard_cache_requests_total', result='hit')
+        else:
+            metrics.inc('dashboard_cache_requests_total', result='miss')
+            page = RenderedPage(revision, render_dashboard(user_id).encode('utf-8'))
+            cache.set(key, page)
+        response = app.response_class(page.body, mimetype='text/html')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def render_dashboard(user_id):
+    """Renders the dashboard page selected by the query string."""
+    page_size = request.args.get('per_page', app.config['DASHBOARD_PAGE_SIZE'], type=int)
+    page_size = max(1, min(page_size, app.config['DASHBOARD_MAX_PAGE_SIZE']))
+    db = get_read_db()
+    documents, next_cursor, prev_cursor = fetch_documents_page(db, user_id, page_size,
+                                                               after=request.args.get('after'),
+                                                               before=request.args.get('before'))
     return render_template('dashboard.html', 
                            documents=documents,
+                           next_cursor=next_cursor,
+                           prev_cursor=prev_cursor,
                            document_types_with_expiry=DOCUMENT_TYPES_WITH_EXPIRY, # These are needed for base.html JS
                            document_types_with_back_side=DOCUMENT_TYPES_WITH_BACK_SIDE) # These are needed for base.html JS
 
 
 # --- Document Management Routes ---
+# create_document() / update_document() / remove_document() hold the validation
+# and storage steps shared by the HTML forms and the JSON API.
+class DocumentError(ValueError):
+    """Raised when a document cannot be saved; the message is shown to the user."""
+
+def create_document(user_id, fields, file_front, file_back=None):
+    """Validates and stores a new document. Returns its id.
+
+    `fields` maps name, document_type, description, issue_date and expiry_date
+    to strings. Raises DocumentError.
+    """
+    name = fields.get('name')
+    document_type = fields.get('document_type')
+    description = fields.get('description', '')
+    issue_date = fields.get('issue_date') or None
+    expiry_date = fields.get('expiry_date') or None
+
+    if not name or not document_type:
+        raise DocumentError('اسم المستند ونوع المستند مطلوبان.')
+    if not file_front or file_front.filename == '':
+        raise DocumentError('يرجى رفع ملف للمستند (الوجه الأمامي).')
+    if not allowed_file(file_front.filename):
+        raise DocumentError('نوع ملف الوجه الأمامي غير مسموح به. الأنواع المدعومة: صور (png, jpg, jpeg) أو pdf.')
+    # A back file is only kept for document types that have a back side
+    if document_type not in DOCUMENT_TYPES_WITH_BACK_SIDE or not file_back or file_back.filename == '':
+        file_back = None
+    if file_back and not allowed_file(file_back.filename):
+        raise DocumentError('نوع ملف الوجه الخلفي غير مسموح به. الأنواع المدعومة: صور (png, jpg, jpeg) أو pdf.')
+
+    staged_front, staged_back = stage_document_files(upload_size_limit(document_type), file_front, file_back)
+    original_filename_front = secure_filename(file_front.filename)
+    unique_filename_front = unique_filename(original_filename_front, staged_front)
+    unique_filename_back = None
+    original_filename_back = None
+    if staged_back:
+        original_filename_back = secure_filename(file_back.filename)
+        unique_filename_back = unique_filename(original_filename_back, staged_back)
+    staged = [blob for blob in (staged_front, staged_back) if blob]
+
+    db = get_db()
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        claim_uploads(db, file_front, file_back)
+        for blob in staged:
+            retain_blob(db, blob)
+        cursor = db.execute("INSERT INTO documents (user_id, name, document_type, filename, original_filename, filename_back, original_filename_back, blob, blob_back, description, issue_date, expiry_date, expires_on) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (user_id, name, document_type, unique_filename_front, original_filename_front, unique_filename_back, original_filename_back,
+                             staged_front.name, staged_back.name if staged_back else None, description, issue_date, expiry_date, parse_expiry_date(expiry_date)))
+        schedule_derivatives(db, *(blob.name for blob in staged))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        # Clean up uploaded files if database insertion fails
+        discard_staged(*staged)
+        raise DocumentError(f'حدث خطأ أثناء حفظ المستند: {e}') from e
+
+    publish_staged(*staged)
+    job_workers.notify()
+    invalidate_file_owners(unique_filename_front, unique_filename_back)
+    return cursor.lastrowid
+
+def update_document(document, fields, file_front=None, file_back=None, clear_back=False):
+    """Applies an edit to a document row. Raises DocumentError.
+
+    Fields missing from `fields` keep their current values. A new file replaces
+    a side; `clear_back` drops the back side.
+    """
+    def field(key):
+        return fields[key] if key in fields else document[key]
+
+    name = field('name')
+    document_type = field('document_type')
+    description = field('description')
+    issue_date = field('issue_date') or None
+    expiry_date = field('expiry_date') or None
+
+    if not name or not document_type:
+        raise DocumentError('اسم المستند ونوع المستند مطلوبان.')
+    if not file_front or file_front.filename == '':
+        file_front = None
+    if document_type not in DOCUMENT_TYPES_WITH_BACK_SIDE or not file_back or file_back.filename == '':
+        file_back = None
+    if file_front and not allowed_file(file_front.filename):
+        raise DocumentError('نوع ملف الوجه الأمامي الجديد غير مسموح به. الأنواع المدعومة: صور (png, jpg, jpeg) أو pdf.')
+    if file_back and not allowed_file(file_back.filename):
+        raise DocumentError('نوع ملف الوجه الخلفي الجديد غير مسموح به. الأنواع المدعومة: صور (png, jpg, jpeg) أو pdf.')
+
+    # Stage the new files before taking the write lock
+    staged_front, staged_back = stage_document_files(upload_size_limit(document_type), file_front, file_back)
+    if staged_front:
+        original_filename_front = secure_filename(file_front.filename)
+        unique_filename_front = unique_filename(original_filename_front, staged_front)
+    if staged_back:
+        original_filename_back = secure_filename(file_back.filename)
+        unique_filename_back = unique_filename(original_filename_back, staged_back)
+    staged = [blob for blob in (staged_front, staged_back) if blob]  # Published once the UPDATE commits
+
+    db = get_db()
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        # The file columns are re-read under the write lock: a concurrent edit
+        # may have replaced a side since `document` was read, and its blob must
+        # be released exactly once.
+        current = db.execute("SELECT filename, original_filename, blob, filename_back, original_filename_back, blob_back "
+                             "FROM documents WHERE id = ?", (document['id'],)).fetchone()
+        if current is None:
+            raise DocumentError('المستند غير موجود.')
+        front = current['filename'], current['original_filename'], current['blob']
+        back = current['filename_back'], current['original_filename_back'], current['blob_back']
+        replaced_blobs = []  # Blobs this document stops referencing
+        if staged_front:
+            replaced_blobs.append(current['blob'])
+            front = unique_filename_front, original_filename_front, staged_front.name
+        if staged_back:
+            replaced_blobs.append(current['blob_back'])
+            back = unique_filename_back, original_filename_back, staged_back.name
+        elif current['filename_back'] and (clear_back or document_type not in DOCUMENT_TYPES_WITH_BACK_SIDE):
+            # Cleared, or the document type no longer supports a back side
+            replaced_blobs.append(current['blob_back'])
+            back = None, None, None
+
+        claim_uploads(db, file_front, file_back)
+        # Retain the new blobs before releasing the old ones, so re-uploading
+        # identical content never drops its reference count to zero.
+        for blob in staged:
+            retain_blob(db, blob)
+        unreferenced = [name for name in replaced_blobs if name and release_blob(db, name)]
+        if unreferenced:
+            enqueue_job(db, 'unlink_blobs', names=unreferenced)
+        schedule_derivatives(db, *(blob.name for blob in staged))
+        db.execute("UPDATE documents SET name = ?, document_type = ?, description = ?, filename = ?, original_filename = ?, blob = ?, filename_back = ?, original_filename_back = ?, blob_back = ?, issue_date = ?, expiry_date = ?, expires_on = ? WHERE id = ?",
+                   (name, document_type, description, *front, *back, issue_date, expiry_date, parse_expiry_date(expiry_date), document['id']))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        discard_staged(*staged)
+        raise DocumentError(f'حدث خطأ أثناء تحديث المستند: {e}') from e
+
+    publish_staged(*staged)
+    job_workers.notify()
+    invalidate_file_owners(current['filename'], current['filename_back'], front[0], back[0])
+
+def remove_document(document):
+    """Deletes a document row; its files go once no other document uses them.
+
+    The blob columns are re-read under the write lock, so a repeated delete (a
+    double-submitted form, a retried API DELETE) releases nothing twice.
+    """
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        row = db.execute("SELECT blob, blob_back FROM documents WHERE id = ?", (document['id'],)).fetchone()
+        if row is not None:
+            unreferenced = [name for name in (row['blob'], row['blob_back']) if name and release_blob(db, name)]
+            if unreferenced:
+                enqueue_job(db, 'unlink_blobs', names=unreferenced)
+            db.execute("DELETE FROM documents WHERE id = ?", (document['id'],))
+    except BaseException:
+        db.rollback()
+        raise
+    db.commit()
+    job_workers.notify()
+    invalidate_file_owners(document['filename'], document['filename_back'])
+
 @app.route('/add_document', methods=['GET', 'POST'])
 def add_document():
     """إضافة مستند جديد."""
@@ -175,65 +2472,15 @@ def add_document():
         return redirect(url_for('login'))
 
     if request.method == 'POST':
-        name = request.form['name']
-        document_type = request.form['document_type']
-        description = request.form['description']
-        issue_date = request.form.get('issue_date') if request.form.get('issue_date') else None
-        expiry_date = request.form.get('expiry_date') if request.form.get('expiry_date') else None
-        
-        file_front = request.files.get('document_file_front')
-        file_back = request.files.get('document_file_back') # Optional back file
-
-        if not name or not document_type:
-            flash('اسم المستند ونوع المستند مطلوبان.', 'danger')
-            return redirect(request.url)
-
-        if not file_front or file_front.filename == '':
-            flash('يرجى رفع ملف للمستند (الوجه الأمامي).', 'danger')
-            return redirect(request.url)
-
-        # Handle front file
-        if file_front and allowed_file(file_front.filename):
-            original_filename_front = secure_filename(file_front.filename)
-            unique_filename_front = f"{os.urandom(8).hex()}_{original_filename_front}"
-            filepath_front = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename_front)
-            file_front.save(filepath_front)
-        else:
-            flash('نوع ملف الوجه الأمامي غير مسموح به. الأنواع المدعومة: صور (png, jpg, jpeg) أو pdf.', 'danger')
-            return redirect(request.url)
-
-        # Handle back file if provided and document type allows it
-        unique_filename_back = None
-        original_filename_back = None
-        if document_type in DOCUMENT_TYPES_WITH_BACK_SIDE and file_back and file_back.filename != '':
-            if allowed_file(file_back.filename):
-                original_filename_back = secure_filename(file_back.filename)
-                unique_filename_back = f"{os.urandom(8).hex()}_{original_filename_back}"
-                filepath_back = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename_back)
-                file_back.save(filepath_back)
-            else:
-                flash('نوع ملف الوجه الخلفي غير مسموح به. الأنواع المدعومة: صور (png, jpg, jpeg) أو pdf.', 'danger')
-                # Clean up the front file if back file is invalid
-                if os.path.exists(filepath_front):
-                    os.remove(filepath_front)
-                return redirect(request.url)
-        
-        db = get_db()
-        user_id = session['user_id']
         try:
-            db.execute("INSERT INTO documents (user_id, name, document_type, filename, original_filename, filename_back, original_filename_back, description, issue_date, expiry_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                       (user_id, name, document_type, unique_filename_front, original_filename_front, unique_filename_back, original_filename_back, description, issue_date, expiry_date))
-            db.commit()
-            flash('تمت إضافة المستند بنجاح!', 'success')
-            return redirect(url_for('dashboard'))
-        except Exception as e:
-            flash(f'حدث خطأ أثناء حفظ المستند: {e}', 'danger')
-            # Clean up uploaded files if database insertion fails
-            if os.path.exists(filepath_front):
-                os.remove(filepath_front)
-            if unique_filename_back and os.path.exists(filepath_back):
-                os.remove(filepath_back)
+            create_document(session['user_id'], request.form,
+                            submitted_file('front'),
+                            submitted_file('back'))  # Optional back file
+        except DocumentError as e:
+            flash(str(e), 'danger')
             return redirect(request.url)
+        flash('تمت إضافة المستند بنجاح!', 'success')
+        return redirect(url_for('dashboard'))
 
     document_types = ['جواز سفر', 'فيزا', 'رقم وطني / بطاقة هوية', 'شهادة ميلاد', 'رخصة قيادة', 'عقد إيجار', 'فاتورة كهرباء', 'فاتورة مياه', 'بيان بنكي', 'شهادة دراسية', 'أخرى']
     return render_template('add_document.html', 
@@ -248,20 +2495,19 @@ def view_document(doc_id):
         flash('يرجى تسجيل الدخول لعرض المستندات.', 'warning')
         return redirect(url_for('login'))
 
-    db = get_db()
-    document = db.execute("SELECT * FROM documents WHERE id = ? AND user_id = ?",
+    db = get_read_db()
+    document = db.execute("SELECT d.*, front.width AS width_front, back.width AS width_back FROM documents d "
+                          "LEFT JOIN blobs front ON front.name = d.blob "
+                          "LEFT JOIN blobs back ON back.name = d.blob_back "
+                          "WHERE d.id = ? AND d.user_id = ?",
                           (doc_id, session['user_id'])).fetchone()
 
     if not document:
         flash('المستند غير موجود أو ليس لديك إذن لعرضه.', 'danger')
         return redirect(url_for('dashboard'))
 
-    # Generate QR Code
-    qr_data = f"Document Name: {document['name']}, Type: {document['document_type']}, ID: {document['id']}"
-    qr_img = qrcode.make(qr_data)
-    buffered = io.BytesIO()
-    qr_img.save(buffered, format="PNG")
-    qr_img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
+    # The QR image is served separately by document_qr(); the version changes with its payload
+    qr_version = qr_etag(qr_payload(document))
 
     # Check if files are images for preview
     is_front_image = is_image(document['filename'])
@@ -272,13 +2518,37 @@ def view_document(doc_id):
 
     return render_template('view_document.html', 
                            document=document, 
-                           qr_img_str=qr_img_str,
+                           qr_version=qr_version,
                            is_front_image=is_front_image,
                            is_back_image=is_back_image,
                            show_back_side=show_back_side,
                            document_types_with_expiry=DOCUMENT_TYPES_WITH_EXPIRY, # These are needed for base.html JS
                            document_types_with_back_side=DOCUMENT_TYPES_WITH_BACK_SIDE) # These are needed for base.html JS
 
+@app.route('/document/<int:doc_id>/qr.png')
+def document_qr(doc_id):
+    """يعرض صورة رمز QR للمستند مع ترويسات التخزين المؤقت."""
+    if 'user_id' not in session:
+        return "Unauthorized", 401
+
+    db = get_read_db()
+    document = db.execute("SELECT id, name, document_type FROM documents WHERE id = ? AND user_id = ?",
+                          (doc_id, session['user_id'])).fetchone()
+    if not document:
+        return "File not found or unauthorized", 404
+
+    etag, png = render_qr_png(qr_payload(document))
+    response = app.response_class(png, mimetype='image/png')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    if request.args.get('v') == etag:
+        # Versioned URL from view_document.html: the image can never change.
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 @app.route('/edit_document/<int:doc_id>', methods=['GET', 'POST'])
 def edit_document(doc_id):
     """تعديل معلومات المستند."""
@@ -295,78 +2565,16 @@ def edit_document(doc_id):
         return redirect(url_for('dashboard'))
 
     if request.method == 'POST':
-        name = request.form['name']
-        document_type = request.form['document_type']
-        description = request.form['description']
-        issue_date = request.form.get('issue_date') if request.form.get('issue_date') else None
-        expiry_date = request.form.get('expiry_date') if request.form.get('expiry_date') else None
-        
-        file_front = request.files.get('document_file_front')
-        file_back = request.files.get('document_file_back')
-
-        # Variables to hold new filenames, default to existing ones
-        unique_filename_front = document['filename']
-        original_filename_front = document['original_filename']
-        unique_filename_back = document['filename_back']
-        original_filename_back = document['original_filename_back']
-
-        # Handle new front file upload
-        if file_front and file_front.filename != '':
-            if allowed_file(file_front.filename):
-                # Delete old front file
-                old_filepath_front = os.path.join(app.config['UPLOAD_FOLDER'], document['filename'])
-                if os.path.exists(old_filepath_front):
-                    os.remove(old_filepath_front)
-                
-                original_filename_front = secure_filename(file_front.filename)
-                unique_filename_front = f"{os.urandom(8).hex()}_{original_filename_front}"
-                filepath_front = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename_front)
-                file_front.save(filepath_front)
-            else:
-                flash('نوع ملف الوجه الأمامي الجديد غير مسموح به. الأنواع المدعومة: صور (png, jpg, jpeg) أو pdf.', 'danger')
-                return redirect(request.url)
-
-        # Handle new back file upload or clear it
-        if document_type in DOCUMENT_TYPES_WITH_BACK_SIDE:
-            if file_back and file_back.filename != '':
-                if allowed_file(file_back.filename):
-                    # Delete old back file if exists
-                    if document['filename_back']:
-                        old_filepath_back = os.path.join(app.config['UPLOAD_FOLDER'], document['filename_back'])
-                        if os.path.exists(old_filepath_back):
-                            os.remove(old_filepath_back)
-                    
-                    original_filename_back = secure_filename(file_back.filename)
-                    unique_filename_back = f"{os.urandom(8).hex()}_{original_filename_back}"
-                    filepath_back = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename_back)
-                    file_back.save(filepath_back)
-                else:
-                    flash('نوع ملف الوجه الخلفي الجديد غير مسموح به. الأنواع المدعومة: صور (png, jpg, jpeg) أو pdf.', 'danger')
-                    return redirect(request.url)
-            elif 'clear_back_file' in request.form: # Option to clear back file
-                if document['filename_back']:
-                    old_filepath_back = os.path.join(app.config['UPLOAD_FOLDER'], document['filename_back'])
-                    if os.path.exists(old_filepath_back):
-                        os.remove(old_filepath_back)
-                    unique_filename_back = None
-                    original_filename_back = None
-        else: # If document type no longer supports back side, clear it
-            if document['filename_back']:
-                old_filepath_back = os.path.join(app.config['UPLOAD_FOLDER'], document['filename_back'])
-                if os.path.exists(old_filepath_back):
-                    os.remove(old_filepath_back)
-                unique_filename_back = None
-                original_filename_back = None
-
         try:
-            db.execute("UPDATE documents SET name = ?, document_type = ?, description = ?, filename = ?, original_filename = ?, filename_back = ?, original_filename_back = ?, issue_date = ?, expiry_date = ? WHERE id = ?",
-                       (name, document_type, description, unique_filename_front, original_filename_front, unique_filename_back, original_filename_back, issue_date, expiry_date, doc_id))
-            db.commit()
-            flash('تم تحديث المستند بنجاح!', 'success')
-            return redirect(url_for('view_document', doc_id=doc_id))
-        except Exception as e:
-            flash(f'حدث خطأ أثناء تحديث المستند: {e}', 'danger')
+            update_document(document, request.form,
+                            submitted_file('front'),
+                            submitted_file('back'),
+                            clear_back='clear_back_file' in request.form)  # Option to clear back file
+        except DocumentError as e:
+            flash(str(e), 'danger')
             return redirect(request.url)
+        flash('تم تحديث المستند بنجاح!', 'success')
+        return redirect(url_for('view_document', doc_id=doc_id))
 
     document_types = ['جواز سفر', 'فيزا', 'رقم وطني / بطاقة هوية', 'شهادة ميلاد', 'رخصة قيادة', 'عقد إيجار', 'فاتورة كهرباء', 'فاتورة مياه', 'بيان بنكي', 'شهادة دراسية', 'أخرى']
     return render_template('edit_document.html', 
@@ -390,62 +2598,1124 @@ def delete_document(doc_id):
         flash('المستند غير موجود أو ليس لديك إذن لحذفه.', 'danger')
         return redirect(url_for('dashboard'))
 
-    # Delete the physical files
-    if document['filename']:
-        filepath_front = os.path.join(app.config['UPLOAD_FOLDER'], document['filename'])
-        if os.path.exists(filepath_front):
-            os.remove(filepath_front)
-    
-    if document['filename_back']:
-        filepath_back = os.path.join(app.config['UPLOAD_FOLDER'], document['filename_back'])
-        if os.path.exists(filepath_back):
-            os.remove(filepath_back)
-    
-    db.execute("DELETE FROM documents WHERE id = ?", (doc_id,))
-    db.commit()
+    remove_document(document)
     flash('تم حذف المستند بنجاح!', 'success')
     return redirect(url_for('dashboard'))
 
+# --- JSON API ---
+# /api/v1/documents offers list, get, create, update and delete for mobile
+# clients, authenticated by the same session cookie as the pages. Creation and
+# updates go through create_document() / update_document(), so the rules are
+# those of the forms. `fields=` selects the returned fields, and only their
+# columns are read. GET responses carry an ETag of the payload and answer
+# If-None-Match with 304.
+API_DOCUMENT_FIELDS = {  # API field -> column it is read from
+    'id': 'id',
+    'name': 'name',
+    'document_type': 'document_type',
+    'description': 'description',
+    'issue_date': 'issue_date',
+    'expiry_date': 'expiry_date',
+    'expires_on': 'expires_on',
+    'upload_date': 'upload_date',
+    'original_filename': 'original_filename',
+    'original_filename_back': 'original_filename_back',
+    'file_url': 'filename',
+    'file_back_url': 'filename_back',
+}
+API_WRITABLE_FIELDS = ('name', 'document_type', 'description', 'issue_date', 'expiry_date')
+
+def api_error(message, status):
+    return api_json({'error': message}, status)
+
+def api_json(payload, status=200):
+    """Compact UTF-8 JSON response (Arabic text stays two bytes per letter)."""
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+    return app.response_class(body, status=status, mimetype='application/json')
+
+def api_cacheable_json(payload):
+    """JSON response for a GET, with an ETag of its body and 304 handling."""
+    response = api_json(payload)
+    response.set_etag(hashlib.sha256(response.get_data()).hexdigest()[:32])
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def api_requested_fields():
+    """Returns (fields, error) for ?fields=; all fields when it is absent."""
+    requested = [name.strip() for name in request.args.get('fields', '').split(',') if name.strip()]
+    unknown = [name for name in requested if name not in API_DOCUMENT_FIELDS]
+    if unknown:
+        return None, f"Unknown fields: {', '.join(unknown)}"
+    return requested or list(API_DOCUMENT_FIELDS), None
+
+def api_columns(fields, *required):
+    """The SQL column list needed for `fields` plus `required`."""
+    columns = dict.fromkeys([*required, *(API_DOCUMENT_FIELDS[name] for name in fields)])
+    return ', '.join(columns)
+
+def api_document(row, fields):
+    """Serializes a documents row to the requested API fields."""
+    data = {}
+    for name in fields:
+        value = row[API_DOCUMENT_FIELDS[name]]
+        if name in ('file_url', 'file_back_url') and value:
+            value = url_for('uploaded_file', filename=value)
+        data[name] = value
+    return data
+
+def api_payload():
+    """Returns (fields, clear_back, error) from a JSON object or multipart form body.
+
+    Field values are converted to strings like form values; clear_back asks
+    update_document() to drop the back side.
+    """
+    source = request.get_json(silent=True) if request.is_json else request.form
+    if not isinstance(source, dict) and not hasattr(source, 'getlist'):
+        return None, False, 'Request body must be a JSON object or a form.'
+    fields = {key: '' if source[key] is None else str(source[key])
+              for key in API_WRITABLE_FIELDS if key in source}
+    return fields, source.get('clear_back') in (True, '1', 'true'), None
+
+def api_owned_document(doc_id, columns='*'):
+    return get_db().execute(f"SELECT {columns} FROM documents WHERE id = ? AND user_id = ?",
+                            (doc_id, session['user_id'])).fetchone()
+
+@app.route('/api/v1/documents', methods=['GET', 'POST'])
+def api_documents():
+    """واجهة JSON: سرد المستندات بترقيم المؤشر، أو إنشاء مستند جديد."""
+    if 'user_id' not in session:
+        return api_error('Authentication required.', 401)
+
+    fields, error = api_requested_fields()
+    if error:
+        return api_error(error, 400)
+
+    if request.method == 'POST':
+        payload, _, error = api_payload()
+        if error:
+            return api_error(error, 400)
+        try:
+            doc_id = create_document(session['user_id'], payload,
+                                     submitted_file('front'),
+                                     submitted_file('back'))
+        except DocumentError as e:
+            return api_error(str(e), 400)
+        response = api_json(api_document(api_owned_document(doc_id), fields), 201)
+        response.headers['Location'] = url_for('api_document_detail', doc_id=doc_id)
+        return response
+
+    page_size = request.args.get('limit', app.config['DASHBOARD_PAGE_SIZE'], type=int)
+    page_size = max(1, min(page_size, app.config['DASHBOARD_MAX_PAGE_SIZE']))
+    documents, next_cursor, prev_cursor = fetch_documents_page(
+        get_read_db(), session['user_id'], page_size,
+        after=request.args.get('after'), before=request.args.get('before'),
+        columns=api_columns(fields, 'id', 'upload_date'))
+    return api_cacheable_json({
+        'documents': [api_document(row, fields) for row in documents],
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor,
+    })
+
+@app.route('/api/v1/documents/<int:doc_id>', methods=['GET', 'PATCH', 'DELETE'])
+def api_document_detail(doc_id):
+    """واجهة JSON: عرض مستند أو تعديله أو حذفه."""
+    if 'user_id' not in session:
+        return api_error('Authentication required.', 401)
+    fields, error = api_requested_fields()
+    if error:
+        return api_error(error, 400)
+
+    if request.method == 'GET':
+        row = get_read_db().execute(f"SELECT {api_columns(fields)} FROM documents WHERE id = ? AND user_id = ?",
+                                    (doc_id, session['user_id'])).fetchone()
+        if row is None:
+            return api_error('Document not found.', 404)
+        return api_cacheable_json(api_document(row, fields))
+
+    document = api_owned_document(doc_id)
+    if document is None:
+        return api_error('Document not found.', 404)
+    if request.method == 'DELETE':
+        remove_document(document)
+        return '', 204
+
+    payload, clear_back, error = api_payload()
+    if error:
+        return api_error(error, 400)
+    try:
+        update_document(document, payload,
+                        submitted_file('front'),
+                        submitted_file('back'),
+                        clear_back=clear_back)
+    except DocumentError as e:
+        return api_error(str(e), 400)
+    return api_json(api_document(api_owned_document(doc_id), fields))
+
+# --- Resumable Uploads ---
+# Large scans (multi-page contracts, bank statements) are sent in chunks, so a
+# dropped mobile connection only costs the chunk in flight:
+#
+#   POST   /api/v1/uploads                 {"filename", "size", "document_type"?, "sha256"?}
+#   PUT    /api/v1/uploads/<id>            one chunk, with Content-Range: bytes <first>-<last>/<size>
+#                                          and Content-Digest: sha-256=:<base64>:
+#   GET    /api/v1/uploads/<id>            progress; "offset" is where the next chunk starts
+#   POST   /api/v1/uploads/<id>/finalize   checks (and normalizes) the whole file
+#   DELETE /api/v1/uploads/<id>            cancels
+#
+# Chunks are written in order straight into UPLOAD_FOLDER/.chunked-<id>.part
+# under a lease in the uploads row, and a chunk that does not match its digest
+# is cut off again. A finalized upload is attached by sending its id as
+# upload_front / upload_back to the add and edit forms or the documents API
+# instead of a file. Uploads are dropped UPLOAD_SESSION_TTL after their last
+# activity unless attached.
+ChunkedUpload = namedtuple('ChunkedUpload', ['id', 'filename', 'blob', 'size', 'crc32'])
+_CONTENT_DIGEST = re.compile(r'(?:^|,)\s*sha-256=:([A-Za-z0-9+/]+={0,2}):')
+_SHA256_HEX = re.compile(r'[0-9a-f]{64}')
+
+class UploadError(ValueError):
+    """Raised for a rejected chunked-upload request; carries the HTTP status."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def chunked_upload_path(upload_id):
+    return os.path.join(app.config['UPLOAD_FOLDER'], f".chunked-{upload_id}.part")
+
+def remove_chunked_upload_file(upload_id):
+    try:
+        os.remove(chunked_upload_path(upload_id))
+    except FileNotFoundError:
+        pass
+
+def owned_upload(db, upload_id):
+    return db.execute("SELECT * FROM uploads WHERE id = ? AND user_id = ? AND expires_at >= ?",
+                      (upload_id, session['user_id'], time.time())).fetchone()
+
+def upload_state(upload):
+    """Serializes an uploads row for the API."""
+    return {
+        'id': upload['id'],
+        'filename': upload['filename'],
+        'size': upload['size'],
+        'offset': upload['received'],
+        'complete': upload['blob'] is not None,
+        'expires_in': max(0, int(upload['expires_at'] - time.time())),
+        'chunk_size': app.config['UPLOAD_CHUNK_SIZE'],
+    }
+
+def lease_upload(db, upload, offset):
+    """Reserves an unfinished upload whose offset is `offset` for one request. Returns the lease token."""
+    token = os.urandom(8).hex()
+    now = time.time()
+    cursor = db.execute("UPDATE uploads SET lock = ?, locked_until = ? WHERE id = ? AND received = ? AND blob IS NULL "
+                        "AND (locked_until IS NULL OR locked_until < ?)",
+                        (token, now + app.config['UPLOAD_CHUNK_TIMEOUT'], upload['id'], offset, now))
+    db.commit()
+    if cursor.rowcount != 1:
+        raise UploadError('Another request is writing this upload, or its offset has moved on.', 409)
+    return token
+
+def release_upload(db, upload, token):
+    db.execute("UPDATE uploads SET lock = NULL, locked_until = NULL WHERE id = ? AND lock = ?", (upload['id'], token))
+    db.commit()
+
+def receive_chunk(db, upload, start, stop, digest):
+    """Writes the request body to bytes [start, stop) of the part file and advances the offset.
+
+    `digest` is the base64 SHA-256 the chunk must have.
+    """
+    token = lease_upload(db, upload, start)
+    path = chunked_upload_path(upload['id'])
+    sha = hashlib.sha256()
+    position = start
+    try:
+        with open(path, 'r+b') as f:
+            f.seek(start)
+            f.truncate()  # Leftovers of an interrupted chunk
+            while True:
+                chunk = request.stream.read(app.config['BLOB_CHUNK_SIZE'])
+                if not chunk:
+                    break
+                position += len(chunk)
+                if position > stop:
+                    raise UploadError('The body is longer than its Content-Range.')
+                sha.update(chunk)
+                f.write(chunk)
+        if position < stop:
+            raise UploadError('The body is shorter than its Content-Range.')
+        if base64.b64encode(sha.digest()).decode('ascii') != digest:
+            raise UploadError('The chunk does not match its Content-Digest; send it again.', 422)
+    except BaseException:
+        with open(path, 'r+b') as f:
+            f.truncate(start)
+        release_upload(db, upload, token)
+        raise
+    cursor = db.execute("UPDATE uploads SET received = ?, lock = NULL, locked_until = NULL, expires_at = ? "
+                        "WHERE id = ? AND lock = ?",
+                        (stop, time.time() + app.config['UPLOAD_SESSION_TTL'], upload['id'], token))
+    db.commit()
+    if cursor.rowcount != 1:
+        raise UploadError('The chunk took too long and was taken over by another request.', 409)
+
+def finalize_upload(db, upload):
+    """Hashes a completely received upload, checks it and normalizes images as stage_upload() does."""
+    if upload['received'] != upload['size']:
+        raise UploadError('The upload is not complete yet.', 409)
+    token = lease_upload(db, upload, upload['size'])
+    path = chunked_upload_path(upload['id'])
+    extension = upload['filename'].rsplit('.', 1)[1].lower()
+    try:
+        with open(path, 'rb') as f:
+            staged = copy_and_hash(f, None, extension, path)
+        if upload['sha256'] and staged.name.rsplit('.', 1)[0] != upload['sha256']:
+            db.execute("DELETE FROM uploads WHERE id = ?", (upload['id'],))
+            db.commit()
+            remove_chunked_upload_file(upload['id'])
+            raise UploadError('The file does not match its sha256; upload it again.', 422)
+        metrics.observe('upload_size_bytes', staged.size)
+        if app.config['IMAGE_NORMALIZATION'] == 'optimize' and extension in ALLOWED_EXTENSIONS_IMAGES:
+            staged = normalize_staged_image(staged)
+    except BaseException:
+        release_upload(db, upload, token)
+        raise
+    db.execute("UPDATE uploads SET blob = ?, blob_size = ?, crc32 = ?, lock = NULL, locked_until = NULL, expires_at = ? "
+               "WHERE id = ? AND lock = ?",
+               (staged.name, staged.size, staged.crc32, time.time() + app.config['UPLOAD_SESSION_TTL'],
+                upload['id'], token))
+    db.commit()
+
+def purge_expired_uploads(db, user_id=None):
+    """Deletes expired uploads and their part files. Returns how many were deleted."""
+    now = time.time()
+    query = "SELECT id FROM uploads WHERE expires_at < ?" + (" AND user_id = ?" if user_id is not None else "")
+    expired = [row['id'] for row in db.execute(query, (now,) + ((user_id,) if user_id is not None else ()))]
+    purged = 0
+    for upload_id in expired:
+        # Re-checked per row: a chunk may have renewed the upload since the SELECT
+        cursor = db.execute("DELETE FROM uploads WHERE id = ? AND expires_at < ? "
+                            "AND (locked_until IS NULL OR locked_until < ?)", (upload_id, now, now))
+        db.commit()
+        if cursor.rowcount:
+            remove_chunked_upload_file(upload_id)
+            purged += 1
+    return purged
+
+def submitted_file(side):
+    """Returns the file sent for one side ('front' / 'back') of a document.
+
+    That is the finalized chunked upload named by upload_<side> in the form or
+    JSON body, else the multipart file document_file_<side>. Raises
+    DocumentError for an unknown or unfinished upload.
+    """
+    source = request.get_json(silent=True) if request.is_json else request.form
+    upload_id = source.get(f'upload_{side}') if isinstance(source, dict) else None
+    if not upload_id:
+        return request.files.get(f'document_file_{side}')
+    row = get_db().execute("SELECT id, filename, blob, blob_size, crc32 FROM uploads "
+                           "WHERE id = ? AND user_id = ? AND blob IS NOT NULL",
+                           (str(upload_id), session['user_id'])).fetchone()
+    if row is None:
+        raise DocumentError('الملف المرفوع غير موجود أو لم يكتمل رفعه.')
+    return ChunkedUpload(row['id'], row['filename'], row['blob'], row['blob_size'], row['crc32'])
+
+def stage_document_files(limit, *files):
+    """Stages each of `files` (None stays None) with stage_document_file().
+
+    Raises DocumentError, keeping none of them, when a file exceeds `limit`.
+    """
+    staged = []
+    try:
+        for file in files:
+            staged.append(stage_document_file(file, limit) if file else None)
+    except UploadTooLarge:
+        discard_staged(*staged)
+        raise DocumentError(size_limit_message(limit)) from None
+    except BaseException:
+        discard_staged(*staged)
+        raise
+    return staged
+
+def stage_document_file(file, limit=None):
+    """stage_upload() for a request file; for a ChunkedUpload, a hard link to its part file.
+
+    The link leaves the part file in place, so the upload can be attached again
+    if saving the document fails. Raises UploadTooLarge for a file of more than
+    `limit` bytes.
+    """
+    if not isinstance(file, ChunkedUpload):
+        return stage_upload(file, limit)
+    if limit is not None and file.size > limit:
+        raise UploadTooLarge(limit)
+    tmp_path = os.path.join(app.config['UPLOAD_FOLDER'], f".upload-{os.urandom(8).hex()}.tmp")
+    os.link(chunked_upload_path(file.id), tmp_path)
+    return StagedBlob(file.blob, tmp_path, file.size, file.crc32)
+
+def claim_uploads(db, *files):
+    """Consumes the chunked uploads among `files` inside the caller's transaction."""
+    ids = [file.id for file in files if isinstance(file, ChunkedUpload)]
+    for upload_id in ids:
+        if db.execute("DELETE FROM uploads WHERE id = ?", (upload_id,)).rowcount != 1:
+            raise DocumentError('الملف المرفوع مستخدم بالفعل.')
+    if ids:
+        enqueue_job(db, 'remove_chunked_uploads', ids=ids)
+
+@job_handler('remove_chunked_uploads')
+def remove_chunked_uploads_job(ids):
+    for upload_id in ids:
+        remove_chunked_upload_file(upload_id)
+
+@app.cli.command('purge-uploads')
+def purge_uploads_command():
+    """Deletes expired chunked uploads."""
+    print(f"Purged {purge_expired_uploads(get_db())} expired uploads.")
+
+@app.route('/api/v1/uploads', methods=['POST'])
+def api_uploads():
+    """واجهة JSON: بدء رفع ملف كبير على أجزاء قابلة للاستئناف."""
+    if 'user_id' not in session:
+        return api_error('Authentication required.', 401)
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return api_error('Request body must be a JSON object.', 400)
+
+    filename = str(data.get('filename') or '')[:255]
+    size = data.get('size')
+    sha256 = str(data.get('sha256') or '').lower() or None
+    if not allowed_file(filename):
+        return api_error('نوع الملف غير مسموح به. الأنواع المدعومة: صور (png, jpg, jpeg) أو pdf.', 400)
+    if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+        return api_error('size must be a positive integer.', 400)
+    if sha256 and not _SHA256_HEX.fullmatch(sha256):
+        return api_error('sha256 must be 64 hex digits.', 400)
+    limit = upload_size_limit(data.get('document_type') or None)
+    if size > limit:
+        return api_error(size_limit_message(limit), 413)
+
+    db = get_db()
+    purge_expired_uploads(db, session['user_id'])
+    pending = db.execute("SELECT COUNT(*) FROM uploads WHERE user_id = ?", (session['user_id'],)).fetchone()[0]
+    if pending >= app.config['UPLOAD_MAX_SESSIONS']:
+        return api_error('Too many unfinished uploads; finish or cancel one first.', 429)
+
+    upload_id = os.urandom(16).hex()
+    open(chunked_upload_path(upload_id), 'xb').close()
+    db.execute("INSERT INTO uploads (id, user_id, filename, size, sha256, expires_at) VALUES (?, ?, ?, ?, ?, ?)",
+               (upload_id, session['user_id'], filename, size, sha256,
+                time.time() + app.config['UPLOAD_SESSION_TTL']))
+    db.commit()
+    response = api_json(upload_state(owned_upload(db, upload_id)), 201)
+    response.headers['Location'] = url_for('api_upload_detail', upload_id=upload_id)
+    return response
+
+@app.route('/api/v1/uploads/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+def api_upload_detail(upload_id):
+    """واجهة JSON: حالة رفع مجزأ، أو إرسال جزء منه، أو إلغاؤه."""
+    if 'user_id' not in session:
+        return api_error('Authentication required.', 401)
+    db = get_db()
+    upload = owned_upload(db, upload_id)
+    if upload is None:
+        return api_error('Upload not found.', 404)
+
+    if request.method == 'DELETE':
+        db.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+        db.commit()
+        remove_chunked_upload_file(upload_id)
+        return '', 204
+
+    if request.method == 'PUT':
+        request.max_content_length = app.config['UPLOAD_MAX_CHUNK_SIZE']
+        content_range = parse_content_range_header(request.headers.get('Content-Range'))
+        digest = _CONTENT_DIGEST.search(request.headers.get('Content-Digest', ''))
+        if content_range is None or content_range.units != 'bytes' or content_range.length != upload['size']:
+            return api_error('Content-Range must be "bytes <first>-<last>/<size>".', 400)
+        if digest is None:
+            return api_error('Content-Digest must carry a sha-256 digest of the chunk.', 400)
+        if upload['blob'] is not None:
+            return api_error('The upload is already finalized.', 409)
+        if content_range.start != upload['received']:
+            return api_error(f"The next chunk starts at offset {upload['received']}.", 409)
+        try:
+            receive_chunk(db, upload, content_range.start, content_range.stop, digest.group(1))
+        except UploadError as e:
+            return api_error(str(e), e.status)
+        upload = owned_upload(db, upload_id)
+
+    response = api_json(upload_state(upload))
+    response.cache_control.no_store = True
+    return response
+
+@app.route('/api/v1/uploads/<upload_id>/finalize', methods=['POST'])
+def api_upload_finalize(upload_id):
+    """واجهة JSON: إنهاء رفع مجزأ والتحقق من الملف كاملاً."""
+    if 'user_id' not in session:
+        return api_error('Authentication required.', 401)
+    db = get_db()
+    upload = owned_upload(db, upload_id)
+    if upload is None:
+        return api_error('Upload not found.', 404)
+    if upload['blob'] is None:
+        try:
+            finalize_upload(db, upload)
+        except UploadError as e:
+            return api_error(str(e), e.status)
+        upload = owned_upload(db, upload_id)
+    return api_json(upload_state(upload))
+
+# --- Bulk Import ---
+# /import takes either a ZIP archive or several files in one multipart POST,
+# plus an optional manifest (CSV or JSON, uploaded separately or stored in the
+# archive as manifest.csv / manifest.json) with one row per document:
+#   file, name, document_type, description, issue_date, expiry_date, file_back
+# Without a manifest every file becomes a document named after the file.
+# Archive entries are streamed straight into the blob store, items are checked
+# with the same rules as add_document(), and all valid rows are inserted in a
+# single transaction.
+IMPORT_MANIFEST_NAMES = ('manifest.csv', 'manifest.json')
+IMPORT_DEFAULT_DOCUMENT_TYPE = 'أخرى'
+
+class ManifestError(ValueError):
+    """Raised when an import manifest cannot be read."""
+
+ImportSource = namedtuple('ImportSource', ['size', 'open'])
+
+def zip_import_sources(archive):
+    """Maps each file entry of an open ZipFile to an ImportSource."""
+    return {info.filename: ImportSource(info.file_size,
+                                        lambda info=info: FileStorage(archive.open(info), filename=info.filename))
+            for info in archive.infolist() if not info.is_dir()}
+
+def multipart_import_sources(files):
+    """Maps uploaded files by filename to ImportSources (size known only after staging)."""
+    return {file.filename: ImportSource(None, lambda file=file: rewound(file)) for file in files if file.filename}
+
+def rewound(file):
+    """Returns an uploaded file positioned at its start, so several rows can stage it."""
+    file.stream.seek(0)
+    return file
+
+def load_import_manifest(manifest_file, sources):
+    """Returns the manifest rows as dicts, reading the uploaded or archived manifest.
+
+    A manifest found among `sources` is removed from them. Without any manifest
+    one default row is returned per source file.
+    """
+    if manifest_file is None or not manifest_file.filename:
+        archived = next((name for name in sources if os.path.basename(name).lower() in IMPORT_MANIFEST_NAMES), None)
+        if archived is None:
+            return [{'file': name, 'name': os.path.splitext(os.path.basename(name))[0],
+                     'document_type': IMPORT_DEFAULT_DOCUMENT_TYPE} for name in sorted(sources)]
+        manifest_file = sources.pop(archived).open()
+
+    try:
+        if manifest_file.filename.lower().endswith('.json'):
+            rows = json.load(io.TextIOWrapper(manifest_file.stream, encoding='utf-8-sig'))
+        else:
+            rows = list(csv.DictReader(io.TextIOWrapper(manifest_file.stream, encoding='utf-8-sig')))
+    except (ValueError, csv.Error) as e:
+        raise ManifestError(str(e))
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        raise ManifestError('manifest must be a list of objects')
+    return [{key: str(value).strip() for key, value in row.items() if key and value is not None} for row in rows]
+
+def stage_import_source(source, limit):
+    """Stages one import file of at most `limit` bytes. Returns (staged, error)."""
+    if source.size is not None and source.size > limit:
+        return None, size_limit_message(limit)
+    try:
+        return stage_upload(source.open(), limit), None
+    except UploadTooLarge:
+        return None, size_limit_message(limit)
+
+def import_batch(user_id, rows, sources):
+    """Validates, stages and inserts the manifest rows. Returns one result dict per row."""
+    results = []
+    pending = []  # (result, row values, staged blobs) for valid rows
+    try:
+        for index, row in enumerate(rows, 1):
+            result = {'row': index, 'file': row.get('file', ''), 'name': row.get('name', ''), 'status': 'error'}
+            results.append(result)
+            if index > app.config['IMPORT_MAX_FILES']:
+                result['message'] = 'تم تجاوز الحد الأقصى لعدد المستندات في الدفعة.'
+                continue
+
+            name, document_type = row.get('name'), row.get('document_type')
+            front_name, back_name = row.get('file'), row.get('file_back')
+            if not name or not document_type:
+                result['message'] = 'اسم المستند ونوع المستند مطلوبان.'
+                continue
+            if not front_name or front_name not in sources:
+                result['message'] = 'ملف الوجه الأمامي غير موجود في الدفعة.'
+                continue
+            if not allowed_file(front_name):
+                result['message'] = 'نوع ملف الوجه الأمامي غير مسموح به. الأنواع المدعومة: صور (png, jpg, jpeg) أو pdf.'
+                continue
+            if back_name and document_type not in DOCUMENT_TYPES_WITH_BACK_SIDE:
+                back_name = None  # Same as add_document(): ignored for types without a back side
+            if back_name and (back_name not in sources or not allowed_file(back_name)):
+                result['message'] = 'ملف الوجه الخلفي غير موجود أو نوعه غير مسموح به.'
+                continue
+
+            limit = upload_size_limit(document_type)
+            staged_front, error = stage_import_source(sources[front_name], limit)
+            staged_back = None
+            if staged_front and back_name:
+                try:
+                    staged_back, error = stage_import_source(sources[back_name], limit)
+                except Exception:
+                    discard_staged(staged_front)
+                    raise
+                if error:
+                    discard_staged(staged_front)
+            if error:
+                result['message'] = error
+                continue
+
+            original_front = secure_filename(os.path.basename(front_name))
+            original_back = secure_filename(os.path.basename(back_name)) if back_name else None
+            values = (user_id, name, document_type,
+                      unique_filename(original_front, staged_front), original_front,
+                      unique_filename(original_back, staged_back) if back_name else None, original_back,
+                      staged_front.name, staged_back.name if staged_back else None,
+                      row.get('description', ''), row.get('issue_date') or None, row.get('expiry_date') or None,
+                      parse_expiry_date(row.get('expiry_date')))
+            pending.append((result, values, [blob for blob in (staged_front, staged_back) if blob]))
+    except Exception:
+        for _, _, staged in pending:
+            discard_staged(*staged)
+        raise
+
+    db = get_db()
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        for result, values, staged in pending:
+            for blob in staged:
+                retain_blob(db, blob)
+            cursor = db.execute("INSERT INTO documents (user_id, name, document_type, filename, original_filename, filename_back, original_filename_back, blob, blob_back, description, issue_date, expiry_date, expires_on) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                values)
+            schedule_derivatives(db, *(blob.name for blob in staged))
+            result['id'] = cursor.lastrowid
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        for result, _, staged in pending:
+            discard_staged(*staged)
+            result.pop('id', None)
+            result['message'] = f'حدث خطأ أثناء حفظ المستندات: {e}'
+        return results
+
+    for result, _, staged in pending:
+        publish_staged(*staged)
+        result['status'] = 'ok'
+    job_workers.notify()
+    return results
+
+@app.route('/import', methods=['GET', 'POST'])
+def import_documents():
+    """استيراد عدة مستندات دفعة واحدة من أرشيف ZIP أو مجموعة ملفات."""
+    if 'user_id' not in session:
+        flash('يرجى تسجيل الدخول لإضافة المستندات.', 'warning')
+        return redirect(url_for('login'))
+
+    results = None
+    if request.method == 'POST':
+        # Batches are larger than single uploads; must be set before the body is parsed.
+        request.max_content_length = app.config['IMPORT_MAX_CONTENT_LENGTH']
+        archive = request.files.get('archive')
+        try:
+            with ExitStack() as stack:
+                if archive and archive.filename:
+                    sources = zip_import_sources(stack.enter_context(zipfile.ZipFile(archive.stream)))
+                else:
+                    sources = multipart_import_sources(request.files.getlist('files'))
+                if not sources:
+                    flash('يرجى رفع أرشيف ZIP أو ملفات المستندات.', 'danger')
+                    return redirect(request.url)
+                rows = load_import_manifest(request.files.get('manifest'), sources)
+                results = import_batch(session['user_id'], rows, sources)
+        except zipfile.BadZipFile:
+            flash('ملف الأرشيف غير صالح. يرجى رفع ملف ZIP.', 'danger')
+            return redirect(request.url)
+        except ManifestError as e:
+            flash(f'تعذرت قراءة ملف البيانات: {e}', 'danger')
+            return redirect(request.url)
+
+        if request.accept_mimetypes.accept_json and not request.accept_mimetypes.accept_html:
+            return {'results': results}
+        imported = sum(1 for result in results if result['status'] == 'ok')
+        flash(f'تم استيراد {imported} من {len(results)} مستند.', 'success' if imported == len(results) else 'warning')
+
+    return render_template('import_documents.html',
+                           results=results,
+                           document_types_with_expiry=DOCUMENT_TYPES_WITH_EXPIRY, # These are needed for base.html JS
+                           document_types_with_back_side=DOCUMENT_TYPES_WITH_BACK_SIDE) # These are needed for base.html JS
+
 @app.route('/download/<filename>')
 def download_file(filename):
     """تنزيل ملف مستند."""
     if 'user_id' not in session:
-        flash('يرجى تسجيل الدخول لتنزيل المستندات.', 'warning')
+        flash('يرجى تسجيل الدخول لتنزيل المستندات.', 'warning')
+        return redirect(url_for('login'))
+    
+    owner = lookup_file_owner(filename)
+    if owner is None or owner.user_id != session['user_id']:
+        flash('الملف غير موجود أو ليس لديك إذن لتنزيله.', 'danger')
+        return redirect(url_for('dashboard'))
+
+    return send_immutable_file(blob_storage(), owner.blob, blob_etag(owner.blob),
+                               as_attachment=True, download_name=filename)
+
+@app.route('/uploads/<filename>/w<int:width>')
+def uploaded_derivative(filename, width):
+    """يعرض نسخة مصغرة من صورة مرفوعة، أو الأصل إذا لم تجهز النسخة بعد."""
+    if 'user_id' not in session:
+        return "Unauthorized", 401
+
+    owner = lookup_file_owner(filename)
+    if owner is None or owner.user_id != session['user_id']:
+        return "File not found or unauthorized", 404
+
+    if width in app.config['DERIVATIVE_WIDTHS']:
+        storage, name = derivative_storage(), derivative_name(owner.blob, width)
+        if storage.exists(name):
+            return send_immutable_file(storage, name, f"{blob_etag(owner.blob)}-{width}w")
+        row = get_read_db().execute("SELECT width FROM blobs WHERE name = ?", (owner.blob,)).fetchone()
+        if row is not None and row['width'] is not None and width >= row['width']:
+            # Never generated, the image is not wider: send to the original, which is cached for good.
+            response = redirect(url_for('uploaded_file', filename=filename), 301)
+            response.cache_control.private = True
+            response.cache_control.max_age = app.config['STORED_FILE_MAX_AGE']
+            return response
+
+    # Variant not generated (yet): serve the original but make the browser ask again next time.
+    response = send_stored_file(blob_storage(), owner.blob)
+    response.cache_control.no_cache = True
+    return response
+
+# Static files (for displaying images in browser)
+@app.route('/uploads/<filename>')
+def uploaded_file(filename):
+    """يعرض الملفات المرفوعة مباشرة في المتصفح."""
+    # This route is for displaying, not downloading directly.
+    # It still needs a security check to ensure only owned files are shown.
+    if 'user_id' not in session:
+        return "Unauthorized", 401 # Or redirect to login
+
+    owner = lookup_file_owner(filename)
+    if owner is None or owner.user_id != session['user_id']:
+        return "File not found or unauthorized", 404
+
+    return send_immutable_file(blob_storage(), owner.blob, blob_etag(owner.blob))
+
+# --- Export ---
+# /export streams every file of the user plus manifest.json and manifest.csv
+# (in the format /import reads, so an export can be imported again) as one ZIP
+# archive. Files are stored as-is, since JPEG, PNG and PDF data is already
+# compressed, and their sizes and CRC-32s come from the blobs table. The whole
+# layout, and so the length of the archive, is known before the first byte is
+# sent: the response is produced piece by piece in constant memory, and the
+# same vault always yields the same bytes, so an interrupted download resumes
+# with a Range request. The ETag changes whenever the vault does.
+#
+# ZIP64 is not written; vaults above 4 GiB or 65535 entries are refused.
+EXPORT_MANIFEST_FIELDS = ['id', 'name', 'document_type', 'description', 'issue_date', 'expiry_date',
+                          'upload_date', 'file', 'original_filename', 'file_back', 'original_filename_back']
+ZIP_UTF8_FLAG = 0x0800  # Entry names are UTF-8
+ZIP_MAX_OFFSET = 0xFFFFFFFF
+ZIP_MAX_ENTRIES = 0xFFFF
+_UNSAFE_ARCHIVE_CHARS = re.compile(r'[\x00-\x1f/\\:*?"<>|]+')
+
+class ExportTooLarge(ValueError):
+    """Raised when a vault does not fit in a ZIP archive without ZIP64."""
+
+# source is (storage area, stored name) for files and bytes for generated entries.
+ZipEntry = namedtuple('ZipEntry', ['name', 'method', 'crc32', 'compressed_size', 'size', 'modified', 'source'])
+
+def dos_datetime(timestamp):
+    """Returns (time, date) in MS-DOS format for an SQLite TIMESTAMP string."""
+    try:
+        value = max(datetime.strptime(timestamp or '', '%Y-%m-%d %H:%M:%S'), datetime(1980, 1, 1))
+    except ValueError:
+        value = datetime(1980, 1, 1)
+    return ((value.hour << 11) | (value.minute << 5) | (value.second // 2),
+            ((value.year - 1980) << 9) | (value.month << 5) | value.day)
+
+def export_entry_name(document, side, blob):
+    """Returns the archive path of one side of a document: '<id>-<name>/<side>.<ext>'."""
+    label = _UNSAFE_ARCHIVE_CHARS.sub('_', document['name']).strip(' .')[:80] or 'document'
+    return f"{document['id']}-{label}/{side}.{blob.rsplit('.', 1)[-1].lower()}"
+
+def blob_checksum(name):
+    """Returns (size, crc32) of a stored blob, recording them for blobs stored
+    before CRCs were tracked. Returns None when the file is missing."""
+    size, crc = 0, 0
+    try:
+        with blob_storage().open(name) as f:
+            for chunk in iter(lambda: f.read(app.config['BLOB_CHUNK_SIZE']), b''):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+    except FileNotFoundError:
+        return None
+    db = get_db()
+    db.execute("UPDATE blobs SET size = ?, crc32 = ? WHERE name = ?", (size, crc, name))
+    db.commit()
+    return size, crc
+
+def deflated_entry(name, data, modified):
+    """Returns a ZipEntry holding `data` deflated."""
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)  # Raw deflate stream, as ZIP expects
+    compressed = compressor.compress(data) + compressor.flush()
+    return ZipEntry(name, zipfile.ZIP_DEFLATED, zlib.crc32(data), len(compressed), len(data), modified, compressed)
+
+def export_entries(user_id):
+    """Returns the ZipEntries of a user's vault in their fixed archive order."""
+    documents = get_read_db().execute('''
+        SELECT d.*, f.size AS blob_size, f.crc32 AS blob_crc32, b.size AS back_size, b.crc32 AS back_crc32
+        FROM documents d
+        LEFT JOIN blobs f ON f.name = d.blob
+        LEFT JOIN blobs b ON b.name = d.blob_back
+        WHERE d.user_id = ?
+        ORDER BY d.id
+    ''', (user_id,)).fetchall()
+
+    entries, rows = [], []
+    for document in documents:
+        row = {field: document[field] if field not in ('file', 'file_back') else None
+               for field in EXPORT_MANIFEST_FIELDS}
+        modified = dos_datetime(document['upload_date'])
+        for side, blob, size, crc, field in (('front', document['blob'], document['blob_size'], document['blob_crc32'], 'file'),
+                                             ('back', document['blob_back'], document['back_size'], document['back_crc32'], 'file_back')):
+            if not blob:
+                continue
+            if size is None or crc is None:
+                checksum = blob_checksum(blob)
+                if checksum is None:
+                    continue  # Missing on disk; the manifest shows no file
+                size, crc = checksum
+            row[field] = export_entry_name(document, side, blob)
+            entries.append(ZipEntry(row[field], zipfile.ZIP_STORED, crc, size, size, modified,
+                                    ('uploads', blob)))
+        rows.append(row)
+
+    modified = max((dos_datetime(document['upload_date']) for document in documents),
+                   key=lambda value: (value[1], value[0]), default=dos_datetime(None))
+    csv_buffer = io.StringIO()
+    writer = csv.DictWriter(csv_buffer, fieldnames=EXPORT_MANIFEST_FIELDS, lineterminator='\n')
+    writer.writeheader()
+    writer.writerows(rows)
+    entries.append(deflated_entry('manifest.json', json.dumps(rows, ensure_ascii=False, indent=2).encode('utf-8'), modified))
+    entries.append(deflated_entry('manifest.csv', csv_buffer.getvalue().encode('utf-8-sig'), modified))
+    return entries
+
+def build_zip_layout(entries):
+    """Lays out a ZIP archive without reading any file.
+
+    Returns (segments, total_size, etag) where segments is a list of
+    (length, bytes or (area, name)) pieces that concatenate to the archive.
+    """
+    if len(entries) > ZIP_MAX_ENTRIES:
+        raise ExportTooLarge(f"{len(entries)} entries")
+    segments, directory = [], []
+    etag = hashlib.sha256()
+    offset = 0
+    for entry in entries:
+        name = entry.name.encode('utf-8')
+        if offset + entry.compressed_size > ZIP_MAX_OFFSET:
+            raise ExportTooLarge(f"more than {ZIP_MAX_OFFSET} bytes")
+        fields = (ZIP_UTF8_FLAG, entry.method, *entry.modified, entry.crc32, entry.compressed_size, entry.size, len(name))
+        header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, *fields, 0) + name
+        directory.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, *fields, 0, 0, 0, 0, 0, offset) + name)
+        segments.append((len(header), header))
+        segments.append((entry.compressed_size, entry.source))
+        etag.update(header)
+        etag.update(entry.source if isinstance(entry.source, bytes) else entry.source[1].encode('utf-8'))
+        offset += len(header) + entry.compressed_size
+
+    directory = b''.join(directory)
+    if offset + len(directory) > ZIP_MAX_OFFSET:
+        raise ExportTooLarge(f"more than {ZIP_MAX_OFFSET} bytes")
+    end = struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(entries), len(entries), len(directory), offset, 0)
+    segments.append((len(directory) + len(end), directory + end))
+    etag.update(directory)
+    return segments, offset + len(directory) + len(end), etag.hexdigest()[:32]
+
+def stream_zip_range(segments, start, stop, chunk_size):
+    """Yields bytes [start, stop) of the archive described by segments."""
+    position = 0
+    for length, source in segments:
+        begin, end = max(start, position), min(stop, position + length)
+        if begin < end:
+            if isinstance(source, bytes):
+                yield source[begin - position:end - position]
+            else:
+                area, name = source
+                remaining = end - begin
+                for chunk in get_storage(area).get_range(name, begin - position, end - position, chunk_size):
+                    remaining -= len(chunk)
+                    yield chunk
+                if remaining:
+                    raise IOError(f"{name} is shorter than its recorded size")
+        position += length
+        if position >= stop:
+            break
+
+@app.route('/export')
+def export_documents():
+    """تصدير جميع مستندات المستخدم في أرشيف ZIP واحد."""
+    if 'user_id' not in session:
+        flash('يرجى تسجيل الدخول لتصدير المستندات.', 'warning')
+        return redirect(url_for('login'))
+
+    try:
+        segments, total, etag = build_zip_layout(export_entries(session['user_id']))
+    except ExportTooLarge:
+        flash('حجم مستنداتك أكبر من أن يصدر في أرشيف واحد.', 'danger')
+        return redirect(url_for('profile'))
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'private, no-cache',
+        'Content-Disposition': 'attachment; filename="documents-export.zip"',
+        'ETag': f'"{etag}"',
+    }
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    status, start, stop = 200, 0, total
+    byte_range = request.range
+    # An If-Range with another ETag (or a date) means the copy being resumed is stale: send it all
+    if byte_range is not None and ('If-Range' not in request.headers or request.if_range.etag == etag):
+        bounds = byte_range.range_for_length(total)
+        if bounds is not None:
+            status, (start, stop) = 206, bounds
+            headers['Content-Range'] = f"bytes {start}-{stop - 1}/{total}"
+        elif byte_range.units == 'bytes' and len(byte_range.ranges) == 1:
+            headers['Content-Range'] = f"bytes */{total}"
+            return Response(status=416, headers=headers)
+    headers['Content-Length'] = str(stop - start)
+    return Response(stream_zip_range(segments, start, stop, app.config['EXPORT_CHUNK_SIZE']),
+                    status=status, headers=headers, mimetype='application/zip', direct_passthrough=True)
+
+# --- Search ---
+# documents_fts is an FTS5 table kept in sync by triggers on documents. Arabic
+# text is normalized before indexing (harakat and tatweel removed, alef/yaa/
+# taa marbuta variants folded) with the same mapping applied to queries in
+# Python and to indexed columns in SQL, so the triggers need no application
+# code. The owner is indexed as a 'u<id>' token: scoping a search to one user is
+# then a posting-list intersection inside FTS5 instead of a filter over every
+# matching row.
+ARABIC_NORMALIZATION = {
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ى': 'ي', 'ئ': 'ي', 'ؤ': 'و', 'ة': 'ه',
+    # Harakat, superscript alef and tatweel carry no meaning for search
+    **{chr(code): '' for code in range(0x064B, 0x0653)}, '\u0670': '', '\u0640': '',
+}
+_ARABIC_TRANSLATION = str.maketrans(ARABIC_NORMALIZATION)
+SEARCH_COLUMNS = ('name', 'description', 'document_type', 'original_filename')
+
+def normalize_search_text(text):
+    """Applies ARABIC_NORMALIZATION to text."""
+    return (text or '').translate(_ARABIC_TRANSLATION)
+
+def _normalize_search_sql(expression):
+    """Returns an SQL expression applying ARABIC_NORMALIZATION to `expression`."""
+    sql = f"COALESCE({expression}, '')"
+    for source, target in ARABIC_NORMALIZATION.items():
+        sql = f"replace({sql}, '{source}', '{target}')"
+    return sql
+
+def create_search_index(db):
+    """Creates documents_fts with its sync triggers and indexes existing documents."""
+    columns = ', '.join(SEARCH_COLUMNS)
+    db.execute(f"CREATE VIRTUAL TABLE documents_fts USING fts5({columns}, owner, "
+               "tokenize = 'unicode61 remove_diacritics 2')")
+
+    def values(row):
+        return ', '.join([f'{row}.id'] + [_normalize_search_sql(f'{row}.{column}') for column in SEARCH_COLUMNS]
+                         + [f"'u' || {row}.user_id"])
+    insert = f"INSERT INTO documents_fts (rowid, {columns}, owner) VALUES ({values('new')});"
+    db.execute(f"CREATE TRIGGER documents_fts_insert AFTER INSERT ON documents BEGIN {insert} END")
+    db.execute("CREATE TRIGGER documents_fts_delete AFTER DELETE ON documents BEGIN "
+               "DELETE FROM documents_fts WHERE rowid = old.id; END")
+    db.execute(f"CREATE TRIGGER documents_fts_update AFTER UPDATE OF {columns}, user_id ON documents BEGIN "
+               f"DELETE FROM documents_fts WHERE rowid = old.id; {insert} END")
+    db.execute(f"INSERT INTO documents_fts (rowid, {columns}, owner) "
+               f"SELECT {values('documents')} FROM documents")
+
+def build_search_query(user_id, text):
+    """Turns free text into an FTS5 query scoped to a user, or None if it has no terms.
+
+    Every word must match (as a prefix) in one of the searchable columns; quotes
+    are stripped so user input can never be parsed as FTS5 syntax.
+    """
+    terms = [term.replace('"', '') for term in normalize_search_text(text).split()]
+    terms = [f'"{term}"*' for term in terms if term]
+    if not terms:
+        return None
+    return f'owner : "u{user_id}" AND {{{" ".join(SEARCH_COLUMNS)}}} : ({" AND ".join(terms)})'
+
+SNIPPET_WORDS = 12  # Words shown around the first match
+
+def highlight_original(original, highlighted):
+    """Moves the match markers of `highlighted`, an FTS column holding the
+    normalized text, onto the original text. Returns None if they do not align.
+
+    Normalization maps every character to one character or to none, so each
+    normalized position has a matching original position.
+    """
+    positions = [index for index, char in enumerate(original) for _ in normalize_search_text(char)]
+    positions.append(len(original))
+    pieces, start, normalized_index = [], 0, 0
+    for char in highlighted:
+        if char in '\x02\x03':
+            position = positions[min(normalized_index, len(positions) - 1)]
+            pieces.extend((original[start:position], char))
+            start = position
+        else:
+            normalized_index += 1
+    if normalized_index != len(positions) - 1:
+        return None
+    pieces.append(original[start:])
+    return ''.join(pieces)
+
+def build_snippet(marked):
+    """Cuts a marked text down to SNIPPET_WORDS words around its first match, as safe HTML."""
+    words = marked.split()
+    first = next((index for index, word in enumerate(words) if '\x02' in word), 0)
+    start = max(0, min(first - SNIPPET_WORDS // 4, len(words) - SNIPPET_WORDS))
+    text = ' '.join(words[start:start + SNIPPET_WORDS])
+    if text.count('\x02') > text.count('\x03'):
+        text += '\x03'  # A match cut off by the window
+    text = ('…' if start > 0 else '') + text + ('…' if start + SNIPPET_WORDS < len(words) else '')
+    # Escape the stored text, then turn the match markers into <mark> tags
+    return Markup(str(escape(text)).replace('\x02', '<mark>').replace('\x03', '</mark>'))
+
+def search_documents(db, user_id, text, limit):
+    """Returns a user's best matching documents with a highlighted snippet each.
+
+    The index holds normalized text, so the matches FTS5 highlights there are
+    moved onto the stored text: users never see the folded spelling.
+    """
+    query = build_search_query(user_id, text)
+    if query is None:
+        return []
+    highlights = ', '.join(f"highlight(documents_fts, {index}, char(2), char(3)) AS highlight_{column}"
+                           for index, column in enumerate(SEARCH_COLUMNS))
+    originals = ', '.join(f"d.{column} AS original_{column}" for column in SEARCH_COLUMNS)
+    rows = db.execute(
+        f"SELECT d.id, d.name, d.document_type, d.upload_date, {originals}, {highlights} "
+        "FROM documents_fts JOIN documents d ON d.id = documents_fts.rowid "
+        "WHERE documents_fts MATCH ? "
+        "ORDER BY bm25(documents_fts, 10.0, 2.0, 4.0, 1.0, 0.0) LIMIT ?",
+        (query, limit)).fetchall()
+    results = []
+    for row in rows:
+        # The column with the most matches, the name on a tie
+        column = max(SEARCH_COLUMNS, key=lambda column: row[f'highlight_{column}'].count('\x02'))
+        original = row[f'original_{column}'] or ''
+        marked = highlight_original(original, row[f'highlight_{column}'])
+        results.append({'id': row['id'], 'name': row['name'], 'document_type': row['document_type'],
+                        'upload_date': row['upload_date'],
+                        'snippet': build_snippet(original if marked is None else marked)})
+    return results
+
+@app.route('/search')
+def search():
+    """البحث في مستندات المستخدم بالاسم والوصف والنوع واسم الملف."""
+    if 'user_id' not in session:
+        flash('يرجى تسجيل الدخول للبحث في المستندات.', 'warning')
         return redirect(url_for('login'))
-    
-    db = get_db()
-    # Check if filename is the front or back file for the user
-    document_front = db.execute("SELECT * FROM documents WHERE filename = ? AND user_id = ?",
-                                (filename, session['user_id'])).fetchone()
-    document_back = db.execute("SELECT * FROM documents WHERE filename_back = ? AND user_id = ?",
-                               (filename, session['user_id'])).fetchone()
-
-    if not document_front and not document_back:
-        flash('الملف غير موجود أو ليس لديك إذن لتنزيله.', 'danger')
-        return redirect(url_for('dashboard'))
 
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename, as_attachment=True)
+    query = request.args.get('q', '').strip()
+    results = search_documents(get_read_db(), session['user_id'], query,
+                               app.config['SEARCH_RESULTS_LIMIT']) if query else []
+    return render_template('search.html',
+                           query=query,
+                           results=results,
+                           document_types_with_expiry=DOCUMENT_TYPES_WITH_EXPIRY, # These are needed for base.html JS
+                           document_types_with_back_side=DOCUMENT_TYPES_WITH_BACK_SIDE) # These are needed for base.html JS
 
-# Static files (for displaying images in browser)
-@app.route('/uploads/<filename>')
-def uploaded_file(filename):
-    """يعرض الملفات المرفوعة مباشرة في المتصفح."""
-    # This route is for displaying, not downloading directly.
-    # It still needs a security check to ensure only owned files are shown.
+# --- Expiry Tracking ---
+# expiry_date keeps whatever the user entered; expires_on holds the same date
+# as ISO YYYY-MM-DD text (NULL when it cannot be parsed), which sorts correctly
+# and is indexed for the per-user listing and the batch reminder scanner.
+EXPIRY_DATE_FORMATS = ('%Y-%m-%d', '%Y/%m/%d', '%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y')
+_ARABIC_INDIC_DIGITS = str.maketrans('٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹', '01234567890123456789')
+
+def parse_expiry_date(value):
+    """Normalizes a free-form expiry date to 'YYYY-MM-DD', or None if unparseable."""
+    if not value:
+        return None
+    value = value.strip().translate(_ARABIC_INDIC_DIGITS)
+    for date_format in EXPIRY_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+def backfill_expires_on(db):
+    """Fills documents.expires_on from expiry_date for existing rows."""
+    rows = db.execute("SELECT id, expiry_date FROM documents WHERE expiry_date IS NOT NULL").fetchall()
+    db.executemany("UPDATE documents SET expires_on = ? WHERE id = ?",
+                   [(parse_expiry_date(row['expiry_date']), row['id']) for row in rows])
+
+def expiry_window(days):
+    """Returns the ISO (first, last) dates of the next `days` days, today included."""
+    today = datetime.now().date()
+    return today.isoformat(), (today + timedelta(days=days)).isoformat()
+
+@app.route('/expiring')
+def expiring():
+    """عرض مستندات المستخدم التي تنتهي صلاحيتها خلال عدد معين من الأيام."""
     if 'user_id' not in session:
-        return "Unauthorized", 401 # Or redirect to login
+        flash('يرجى تسجيل الدخول لعرض المستندات.', 'warning')
+        return redirect(url_for('login'))
 
-    db = get_db()
-    # Check if filename is the front or back file for the user
-    document_front = db.execute("SELECT * FROM documents WHERE filename = ? AND user_id = ?",
-                                (filename, session['user_id'])).fetchone()
-    document_back = db.execute("SELECT * FROM documents WHERE filename_back = ? AND user_id = ?",
-                               (filename, session['user_id'])).fetchone()
+    days = request.args.get('days', app.config['EXPIRY_WARNING_DAYS'], type=int)
+    days = max(1, min(days, 3650))
+    first, last = expiry_window(days)
+    documents = get_read_db().execute(
+        "SELECT id, name, document_type, expiry_date, expires_on FROM documents "
+        "WHERE user_id = ? AND expires_on BETWEEN ? AND ? ORDER BY expires_on, id",
+        (session['user_id'], first, last)).fetchall()
+    return render_template('expiring.html',
+                           documents=documents,
+                           days=days,
+                           document_types_with_expiry=DOCUMENT_TYPES_WITH_EXPIRY, # These are needed for base.html JS
+                           document_types_with_back_side=DOCUMENT_TYPES_WITH_BACK_SIDE) # These are needed for base.html JS
 
-    if not document_front and not document_back:
-        return "File not found or unauthorized", 404
+@app.cli.command('scan-expiring')
+@click.option('--days', default=None, type=int, help='Look-ahead window (default: EXPIRY_WARNING_DAYS).')
+@click.option('--chunk-size', default=1000, show_default=True, help='Documents processed per transaction.')
+def scan_expiring_command(days, chunk_size):
+    """Records expiry reminders for every user's soon-to-expire documents.
 
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    Walks idx_documents_expiry once in (expires_on, id) order, in keyset chunks,
+    instead of querying user by user. Reminders are unique per document and
+    expiry date, so re-running the scan never duplicates them.
+    """
+    db = get_db()
+    first, last = expiry_window(days or app.config['EXPIRY_WARNING_DAYS'])
+    cursor = (first, 0)
+    scanned = created = 0
+    while True:
+        rows = db.execute(
+            "SELECT id, user_id, expires_on FROM documents "
+            "WHERE expires_on IS NOT NULL AND (expires_on, id) > (?, ?) AND expires_on <= ? "
+            "ORDER BY expires_on, id LIMIT ?",
+            (cursor[0], cursor[1], last, chunk_size)).fetchall()
+        if not rows:
+            break
+        before = db.total_changes
+        db.executemany("INSERT OR IGNORE INTO expiry_reminders (document_id, user_id, expires_on) VALUES (?, ?, ?)",
+                       [(row['id'], row['user_id'], row['expires_on']) for row in rows])
+        db.commit()
+        created += db.total_changes - before
+        scanned += len(rows)
+        cursor = (rows[-1]['expires_on'], rows[-1]['id'])
+    print(f"Scanned {scanned} expiring documents, created {created} reminders.")
 
 # --- User Profile ---
 @app.route('/profile')
@@ -461,6 +3731,237 @@ def profile():
                            document_types_with_expiry=DOCUMENT_TYPES_WITH_EXPIRY, # These are needed for base.html JS
                            document_types_with_back_side=DOCUMENT_TYPES_WITH_BACK_SIDE) # These are needed for base.html JS
 
+# --- Static Assets ---
+# The stylesheet and script shared by every page (BASE_CSS / BASE_JS, next to
+# the templates) are written once per process to ASSET_FOLDER under
+# content-hashed names, together with gzip and, when the optional brotli
+# module is installed, brotli copies. Pages link them through asset_url(), and
+# /assets serves them with immutable caching in the best encoding the client
+# accepts, so pages carry only their markup.
+ASSET_TYPES = {'.css': 'text/css', '.js': 'text/javascript'}
+ASSET_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))  # In order of preference
+asset_names = {}  # Logical name -> fingerprinted name, filled by fingerprinted_assets()
+_assets_lock = threading.Lock()
+
+def write_asset(path, data):
+    """Writes a file atomically, so concurrent processes never serve a partial asset."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.asset-')
+    with os.fdopen(fd, 'wb') as out:
+        out.write(data)
+    os.replace(tmp_path, path)
+
+def build_assets(sources):
+    """Writes fingerprinted, precompressed copies of sources ({name: text}).
+
+    Returns {name: fingerprinted name}. Files already written by an earlier
+    build are kept, so pages rendered before a restart still find theirs.
+    """
+    folder = app.config['ASSET_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    names = {}
+    for name, text in sources.items():
+        data = text.encode('utf-8')
+        stem, extension = os.path.splitext(name)
+        names[name] = f"{stem}.{hashlib.sha256(data).hexdigest()[:16]}{extension}"
+        variants = {'': data, '.gz': gzip.compress(data, 9, mtime=0)}
+        if brotli is not None:
+            variants['.br'] = brotli.compress(data, quality=11)
+        for suffix, content in variants.items():
+            path = os.path.join(folder, names[name] + suffix)
+            if not os.path.exists(path):
+                write_asset(path, content)
+    return names
+
+def fingerprinted_assets():
+    """Returns {name: fingerprinted name}, building the assets on first use."""
+    if not asset_names:
+        with _assets_lock:
+            if not asset_names:
+                asset_names.update(build_assets({'base.css': BASE_CSS, 'base.js': BASE_JS}))
+    return asset_names
+
+@app.template_global()
+def asset_url(name):
+    """URL of the current build of a shared asset, e.g. asset_url('base.css')."""
+    return url_for('asset', filename=fingerprinted_assets()[name])
+
+@app.route('/assets/<filename>')
+def asset(filename):
+    """يخدم ملفات CSS و JavaScript المشتركة مع تخزين مؤقت دائم."""
+    extension = os.path.splitext(filename)[1]
+    folder = os.path.abspath(app.config['ASSET_FOLDER'])
+    if extension not in ASSET_TYPES or not os.path.isfile(os.path.join(folder, filename)):
+        return "Not found", 404
+
+    for encoding, suffix in ASSET_ENCODINGS:
+        if request.accept_encodings[encoding] and os.path.exists(os.path.join(folder, filename + suffix)):
+            break
+    else:
+        encoding, suffix = None, ''
+    response = send_from_directory(folder, filename + suffix, mimetype=ASSET_TYPES[extension],
+                                   max_age=app.config['ASSET_MAX_AGE'])
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.immutable = True  # The name changes with the content
+    return response
+
+# --- Metrics Endpoint ---
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.endpoint or 'unmatched'
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - started, endpoint=endpoint)
+        metrics.inc('http_requests_total', endpoint=endpoint, status=response.status_code)
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """يعرض مقاييس الأداء بصيغة Prometheus لمن يملك رمز الوصول."""
+    token = app.config['METRICS_TOKEN']
+    if not token:
+        return "Not found", 404
+    authorization = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(authorization.encode('utf-8'), f"Bearer {token}".encode('utf-8')):
+        return "Unauthorized", 401, {'WWW-Authenticate': 'Bearer'}
+    response = app.response_class(metrics.render(), mimetype='text/plain')
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.cache_control.no_store = True
+    return response
+
+# --- Response Compression ---
+# Textual responses (the Arabic UTF-8 pages are large) are compressed with
+# brotli when the module is installed and the client accepts it, otherwise
+# with gzip. Bodies of a known length up to COMPRESS_BUFFER_SIZE are
+# compressed in one go. When the body is the same for every user (see
+# shareable()), the result is cached by the digest of the body, so responses
+# such as the error pages are compressed only once; per-user pages are not
+# cached, which would only churn the cache and keep private HTML in memory.
+# Longer or unsized bodies are compressed chunk by chunk as they stream.
+class CompressionMiddleware:
+    """WSGI middleware negotiating gzip / brotli compression per Accept-Encoding.
+
+    Passes through anything it should not touch: types outside
+    COMPRESS_MIMETYPES (JPEG, PNG, PDF and ZIP are already compressed),
+    responses that already have a Content-Encoding, ranges, bodiless responses,
+    Cache-Control: no-transform and bodies shorter than COMPRESS_MIN_SIZE.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.cache = LRUCache(app.config['COMPRESS_CACHE_SIZE'])
+
+    def __call__(self, environ, start_response):
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+
+        app_iter = self.wsgi_app(environ, capture)
+        status, wsgi_headers, exc_info = captured
+        headers = Headers(wsgi_headers)
+        if not self.compressible(environ, status, headers):
+            start_response(status, wsgi_headers, exc_info)
+            return app_iter
+
+        vary = headers.get('Vary')
+        if 'accept-encoding' not in (vary or '').lower():
+            headers['Vary'] = f"{vary}, Accept-Encoding" if vary else 'Accept-Encoding'
+        encoding = self.negotiate(environ)
+        length = headers.get('Content-Length', type=int)
+        if encoding is None or (length is not None and length < app.config['COMPRESS_MIN_SIZE']):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return app_iter
+
+        headers['Content-Encoding'] = encoding
+        etag = headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            headers['ETag'] = 'W/' + etag  # The compressed bytes differ, the content does not
+        if length is None or length > app.config['COMPRESS_BUFFER_SIZE']:
+            headers.remove('Content-Length')
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return self.stream(app_iter, encoding)
+
+        try:
+            body = b''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        if self.shareable(environ, headers):
+            key = (encoding, hashlib.blake2b(body, digest_size=16).digest())
+            compressed = self.cache.get(key)
+            if compressed is None:
+                compressed = self.compress(body, encoding)
+                self.cache.set(key, compressed)
+        else:
+            compressed = self.compress(body, encoding)
+        headers['Content-Length'] = str(len(compressed))
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        return [compressed]
+
+    @staticmethod
+    def compressible(environ, status, headers):
+        mimetype = headers.get('Content-Type', '').split(';')[0].strip().lower()
+        return (environ.get('REQUEST_METHOD') != 'HEAD'
+                and status[:3] not in ('204', '206', '304')
+                and 'Content-Encoding' not in headers
+                and 'Content-Range' not in headers
+                and 'no-transform' not in headers.get('Cache-Control', '')
+                and (mimetype.startswith('text/') or mimetype in app.config['COMPRESS_MIMETYPES']))
+
+    @staticmethod
+    def shareable(environ, headers):
+        """Whether the body is one other users get too, so its compressed copy is worth caching.
+
+        Not when it is private, sets a cookie, or varies by the session cookie
+        the request carries; anonymous requests do share pages that vary by it.
+        """
+        cache_control = headers.get('Cache-Control', '').lower()
+        return ('private' not in cache_control and 'no-store' not in cache_control
+                and 'Set-Cookie' not in headers
+                and ('cookie' not in headers.get('Vary', '').lower() or 'HTTP_COOKIE' not in environ))
+
+    @staticmethod
+    def negotiate(environ):
+        """Returns 'br', 'gzip' or None for the request's Accept-Encoding."""
+        accepted = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+        if brotli is not None and accepted['br']:
+            return 'br'
+        if accepted['gzip']:
+            return 'gzip'
+        return None
+
+    @staticmethod
+    def compress(body, encoding):
+        if encoding == 'br':
+            return brotli.compress(body, quality=app.config['COMPRESS_BROTLI_QUALITY'])
+        return gzip.compress(body, app.config['COMPRESS_LEVEL'], mtime=0)
+
+    @staticmethod
+    def stream(app_iter, encoding):
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=app.config['COMPRESS_BROTLI_QUALITY'])
+            compress, flush = compressor.process, compressor.finish
+        else:
+            compressor = zlib.compressobj(app.config['COMPRESS_LEVEL'], zlib.DEFLATED, 31)  # gzip container
+            compress, flush = compressor.compress, compressor.flush
+        try:
+            for chunk in app_iter:
+                data = compress(chunk)
+                if data:
+                    yield data
+            yield flush()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+app.wsgi_app = CompressionMiddleware(app.wsgi_app)
+
 # --- Error Handlers ---
 @app.errorhandler(404)
 def page_not_found(e):
@@ -471,20 +3972,15 @@ def page_not_found(e):
 
 @app.errorhandler(413) # Payload Too Large
 def too_large(e):
-    flash('حجم الملف كبير جدًا. الحد الأقصى المسموح به هو 5 ميجابايت.', 'danger')
+    if request.path.startswith('/api/'):
+        return api_error('Request body too large.', 413)
+    flash('حجم الملف كبير جدًا للرفع المباشر. يرجى المحاولة من متصفح حديث لرفعه على أجزاء.', 'danger')
     return redirect(request.url)
 
 
-# --- HTML Templates (Embedded) ---
-TEMPLATES = {
-    'base.html': '''
-<!DOCTYPE html>
-<html lang="ar" dir="rtl">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>نظام إدارة المستندات - {% block title %}{% endblock %}</title>
-    <style>
+# --- Static Assets (Embedded) ---
+# Written to ASSET_FOLDER under fingerprinted names on first use; see Static Assets.
+BASE_CSS = '''
 /* General Styles */
 :root {
     --primary-color: #007bff;
@@ -799,6 +4295,57 @@ h2, h3 {
     margin: 0; /* Remove default button margin */
 }
 
+.search-form {
+    display: flex;
+    gap: 10px;
+    margin-bottom: 20px;
+}
+
+.search-form input[type="search"],
+.search-form input[type="number"] {
+    flex: 1;
+    padding: 10px;
+    border: 1px solid var(--border-color);
+    border-radius: 5px;
+    font-size: 1rem;
+}
+
+.search-form .btn {
+    margin-top: 0;
+}
+
+.search-snippet mark {
+    background-color: var(--warning-color);
+    padding: 0 2px;
+    border-radius: 2px;
+}
+
+.import-report {
+    width: 100%;
+    border-collapse: collapse;
+    margin-top: 15px;
+}
+
+.import-report th, .import-report td {
+    border: 1px solid var(--border-color);
+    padding: 8px;
+}
+
+.import-report .import-ok td:last-child {
+    color: var(--success-color);
+}
+
+.import-report .import-error td:last-child {
+    color: var(--danger-color);
+}
+
+.pagination {
+    display: flex;
+    justify-content: center;
+    gap: 10px;
+    margin-top: 25px;
+}
+
 /* Document Detail Page */
 .document-detail-container {
     padding: 30px;
@@ -995,50 +4542,9 @@ footer {
         max-width: 90%; /* Smaller on mobile */
     }
 }
-</style>
-</head>
-<body>
-    <header>
-        <nav>
-            <div class="logo">
-                <a href="{{ url_for('dashboard') }}">نظام إدارة المستندات</a>
-            </div>
-            <ul>
-                {% if 'user_id' in session %}
-                <li><a href="{{ url_for('dashboard') }}">الرئيسية</a></li>
-                <li><a href="{{ url_for('add_document') }}">إضافة مستند</a></li>
-                <li><a href="{{ url_for('profile') }}">الملف الشخصي</a></li>
-                <li><a href="{{ url_for('logout') }}">تسجيل الخروج</a></li>
-                {% else %}
-                <li><a href="{{ url_for('login') }}">تسجيل الدخول</a></li>
-                <li><a href="{{ url_for('register') }}">إنشاء حساب</a></li>
-                {% endif %}
-            </ul>
-        </nav>
-    </header>
-    <main>
-        {% with messages = get_flashed_messages(with_categories=true) %}
-            {% if messages %}
-                <div class="flash-messages">
-                    {% for category, message in messages %}
-                        <div class="alert alert-{{ category }}">{{ message }}</div>
-                    {% endfor %}
-                </div>
-            {% endif %}
-        {% endwith %}
-        {% block content %}{% endblock %}
-    </main>
-    <footer>
-        <p>&copy; 2025 نظام إدارة المستندات. جميع الحقوق محفوظة.</p>
-    </footer>
-
-    <div id="myLightbox" class="lightbox">
-        <span class="lightbox-close">&times;</span>
-        <img class="lightbox-content" id="img01">
-        <div id="caption" class="lightbox-caption"></div>
-    </div>
+'''
 
-    <script>
+BASE_JS = '''
 document.addEventListener('DOMContentLoaded', () => {
     const flashMessages = document.querySelectorAll('.flash-messages .alert');
     if (flashMessages.length > 0) {
@@ -1081,10 +4587,9 @@ document.addEventListener('DOMContentLoaded', () => {
     const issueDateGroup = document.getElementById('issue_date_group');
     const documentFileBackGroup = document.getElementById('document_file_back_group');
 
-    // Make sure these are properly passed from Flask to Jinja as JSON strings
-    // and then parsed back into JavaScript arrays.
-    const documentTypesWithExpiry = JSON.parse('{{ document_types_with_expiry | tojson }}');
-    const documentTypesWithBackSide = JSON.parse('{{ document_types_with_back_side | tojson }}');
+    // Passed by the page as JSON in data attributes of <body>, so this file stays static.
+    const documentTypesWithExpiry = JSON.parse(document.body.dataset.documentTypesWithExpiry || '[]');
+    const documentTypesWithBackSide = JSON.parse(document.body.dataset.documentTypesWithBackSide || '[]');
 
     function toggleFields() {
         const selectedType = documentTypeSelect.value;
@@ -1121,8 +4626,170 @@ document.addEventListener('DOMContentLoaded', () => {
         // Initial call to set correct state on page load
         toggleFields();
     }
+
+    // Resumable uploads (/api/v1/uploads) on the add and edit pages: a file
+    // larger than one chunk is sent in pieces before the form is submitted,
+    // and the form then carries the upload id instead of the file.
+    const uploadForm = document.querySelector('form[data-upload-url]');
+    if (!uploadForm) {
+        return;
+    }
+    const chunkSize = Number(uploadForm.dataset.chunkSize);
+    const sizeLimits = JSON.parse(uploadForm.dataset.sizeLimits);
+    const defaultSizeLimit = Number(uploadForm.dataset.defaultSizeLimit);
+
+    function showSizeLimit() {
+        const limit = sizeLimits[documentTypeSelect.value] || defaultSizeLimit;
+        uploadForm.querySelectorAll('.upload-size-limit').forEach(element => {
+            element.textContent = Math.floor(limit / (1024 * 1024));
+        });
+    }
+    documentTypeSelect.addEventListener('change', showSizeLimit);
+    showSizeLimit();
+
+    async function sha256Base64(blob) {
+        const digest = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+        return btoa(String.fromCharCode(...new Uint8Array(digest)));
+    }
+
+    async function uploadInChunks(file, onProgress) {
+        const created = await fetch(uploadForm.dataset.uploadUrl, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({filename: file.name, size: file.size, document_type: documentTypeSelect.value}),
+        });
+        const upload = await created.json();
+        if (!created.ok) {
+            throw new Error(upload.error);
+        }
+        const url = created.headers.get('Location');
+        let offset = 0;
+        let failures = 0;
+        while (offset < file.size) {
+            const chunk = file.slice(offset, offset + chunkSize);
+            let response = null;
+            try {
+                response = await fetch(url, {method: 'PUT', body: chunk, headers: {
+                    'Content-Range': `bytes ${offset}-${offset + chunk.size - 1}/${file.size}`,
+                    'Content-Digest': `sha-256=:${await sha256Base64(chunk)}:`,
+                }});
+            } catch (networkError) {
+                response = null;
+            }
+            if (response && response.ok) {
+                offset = (await response.json()).offset;
+                failures = 0;
+                onProgress(offset / file.size);
+                continue;
+            }
+            if (response && response.status < 500 && ![409, 422].includes(response.status)) {
+                throw new Error((await response.json()).error);
+            }
+            if (++failures > 5) {
+                throw new Error('تعذر إكمال رفع الملف. يرجى المحاولة لاحقاً.');
+            }
+            // Connection lost or chunk rejected: wait, then resume from the server's offset.
+            await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** failures));
+            try {
+                offset = (await (await fetch(url)).json()).offset;
+            } catch (networkError) {
+                // Still offline; the next attempt resends the same chunk.
+            }
+        }
+        const finalized = await fetch(`${url}/finalize`, {method: 'POST'});
+        const result = await finalized.json();
+        if (!finalized.ok) {
+            throw new Error(result.error);
+        }
+        return result.id;
+    }
+
+    uploadForm.addEventListener('submit', async event => {
+        const largeFiles = [...uploadForm.querySelectorAll('input[type=file][data-upload-field]')]
+            .filter(input => input.files.length && input.files[0].size > chunkSize);
+        if (!largeFiles.length || !(window.crypto && crypto.subtle)) {
+            return;  // Sent with the form as usual
+        }
+        event.preventDefault();
+        const button = uploadForm.querySelector('button[type=submit]');
+        const label = button.textContent;
+        button.disabled = true;
+        try {
+            for (const input of largeFiles) {
+                const file = input.files[0];
+                const uploadId = await uploadInChunks(file, progress => {
+                    button.textContent = `جارٍ رفع ${file.name}: ${Math.round(progress * 100)}%`;
+                });
+                uploadForm.elements[input.dataset.uploadField].value = uploadId;
+                input.disabled = true;  // Not sent again with the form
+            }
+            uploadForm.submit();
+        } catch (error) {
+            largeFiles.forEach(input => { input.disabled = false; });
+            button.disabled = false;
+            button.textContent = label;
+            alert(error.message);
+        }
+    });
 });
-</script>
+'''
+
+# --- HTML Templates (Embedded) ---
+TEMPLATES = {
+    'base.html': '''
+<!DOCTYPE html>
+<html lang="ar" dir="rtl">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>نظام إدارة المستندات - {% block title %}{% endblock %}</title>
+    <link rel="stylesheet" href="{{ asset_url('base.css') }}">
+</head>
+<body data-document-types-with-expiry='{{ document_types_with_expiry | default([]) | tojson }}'
+      data-document-types-with-back-side='{{ document_types_with_back_side | default([]) | tojson }}'>
+    <header>
+        <nav>
+            <div class="logo">
+                <a href="{{ url_for('dashboard') }}">نظام إدارة المستندات</a>
+            </div>
+            <ul>
+                {% if 'user_id' in session %}
+                <li><a href="{{ url_for('dashboard') }}">الرئيسية</a></li>
+                <li><a href="{{ url_for('add_document') }}">إضافة مستند</a></li>
+                <li><a href="{{ url_for('import_documents') }}">استيراد</a></li>
+                <li><a href="{{ url_for('expiring') }}">تنتهي قريباً</a></li>
+                <li><a href="{{ url_for('profile') }}">الملف الشخصي</a></li>
+                <li><a href="{{ url_for('logout') }}">تسجيل الخروج</a></li>
+                {% else %}
+                <li><a href="{{ url_for('login') }}">تسجيل الدخول</a></li>
+                <li><a href="{{ url_for('register') }}">إنشاء حساب</a></li>
+                {% endif %}
+            </ul>
+        </nav>
+    </header>
+    <main>
+        {% with messages = get_flashed_messages(with_categories=true) %}
+            {% if messages %}
+                <div class="flash-messages">
+                    {% for category, message in messages %}
+                        <div class="alert alert-{{ category }}">{{ message }}</div>
+                    {% endfor %}
+                </div>
+            {% endif %}
+        {% endwith %}
+        {% block content %}{% endblock %}
+    </main>
+    <footer>
+        <p>&copy; 2025 نظام إدارة المستندات. جميع الحقوق محفوظة.</p>
+    </footer>
+
+    <div id="myLightbox" class="lightbox">
+        <span class="lightbox-close">&times;</span>
+        <img class="lightbox-content" id="img01">
+        <div id="caption" class="lightbox-caption"></div>
+    </div>
+
+    <script src="{{ asset_url('base.js') }}" defer></script>
 </body>
 </html>
 '''
@@ -1178,6 +4845,10 @@ document.addEventListener('DOMContentLoaded', () => {
 <div class="dashboard-container">
     <h2>أهلاً بك، {{ session['username'] }}!</h2>
     <h3>مستنداتي</h3>
+    <form action="{{ url_for('search') }}" method="GET" class="search-form">
+        <input type="search" name="q" placeholder="ابحث في مستنداتك..." required>
+        <button type="submit" class="btn btn-primary">بحث</button>
+    </form>
     {% if documents %}
     <div class="document-list">
         {% for doc in documents %}
@@ -1205,6 +4876,16 @@ document.addEventListener('DOMContentLoaded', () => {
         </div>
         {% endfor %}
     </div>
+    {% if prev_cursor or next_cursor %}
+    <div class="pagination">
+        {% if prev_cursor %}
+        <a href="{{ url_for('dashboard', before=prev_cursor, per_page=request.args.get('per_page')) }}" class="btn btn-secondary">&rarr; الأحدث</a>
+        {% endif %}
+        {% if next_cursor %}
+        <a href="{{ url_for('dashboard', after=next_cursor, per_page=request.args.get('per_page')) }}" class="btn btn-secondary">الأقدم &larr;</a>
+        {% endif %}
+    </div>
+    {% endif %}
     {% else %}
     <p>لا توجد مستندات بعد. <a href="{{ url_for('add_document') }}">أضف مستنداً جديداً</a>.</p>
     {% endif %}
@@ -1218,7 +4899,9 @@ document.addEventListener('DOMContentLoaded', () => {
 {% block content %}
 <div class="form-container">
     <h2>إضافة مستند جديد</h2>
-    <form method="POST" enctype="multipart/form-data">
+    <form method="POST" enctype="multipart/form-data" data-upload-url="{{ url_for('api_uploads') }}"
+          data-chunk-size="{{ config.UPLOAD_CHUNK_SIZE }}" data-size-limits='{{ config.UPLOAD_SIZE_LIMITS | tojson }}'
+          data-default-size-limit="{{ config.UPLOAD_DEFAULT_SIZE_LIMIT }}">
         <div class="form-group">
             <label for="name">اسم المستند:</label>
             <input type="text" id="name" name="name" required>
@@ -1245,14 +4928,16 @@ document.addEventListener('DOMContentLoaded', () => {
 
         <div class="form-group">
             <label for="document_file_front">ملف المستند (الوجه الأمامي):</label>
-            <input type="file" id="document_file_front" name="document_file_front" accept="image/*,.pdf" required>
-            <small>الأنواع المدعومة: صور (JPG, PNG) و PDF. الحد الأقصى: 5 ميجابايت.</small>
+            <input type="file" id="document_file_front" name="document_file_front" accept="image/*,.pdf" required data-upload-field="upload_front">
+            <input type="hidden" name="upload_front">
+            <small>الأنواع المدعومة: صور (JPG, PNG) و PDF. الحد الأقصى: <span class="upload-size-limit">{{ config.UPLOAD_DEFAULT_SIZE_LIMIT // 1048576 }}</span> ميجابايت.</small>
         </div>
         
         <div class="form-group" id="document_file_back_group" style="display: none;">
             <label for="document_file_back">ملف المستند (الوجه الخلفي - اختياري):</label>
-            <input type="file" id="document_file_back" name="document_file_back" accept="image/*,.pdf">
-            <small>يستخدم للبطاقات القومية وما شابه. الأنواع المدعومة: صور (JPG, PNG) و PDF. الحد الأقصى: 5 ميجابايت.</small>
+            <input type="file" id="document_file_back" name="document_file_back" accept="image/*,.pdf" data-upload-field="upload_back">
+            <input type="hidden" name="upload_back">
+            <small>يستخدم للبطاقات القومية وما شابه. الأنواع المدعومة: صور (JPG, PNG) و PDF. الحد الأقصى: <span class="upload-size-limit">{{ config.UPLOAD_DEFAULT_SIZE_LIMIT // 1048576 }}</span> ميجابايت.</small>
         </div>
         
         <div class="form-group">
@@ -1285,7 +4970,8 @@ document.addEventListener('DOMContentLoaded', () => {
     <div class="document-images">
         {% if is_front_image %}
         <div class="document-image-wrapper">
-            <img src="{{ url_for('uploaded_file', filename=document.filename) }}" alt="الوجه الأمامي: {{ document.original_filename }}">
+            <img src="{{ url_for('uploaded_file', filename=document.filename) }}"
+                 srcset="{{ image_srcset(document.filename, document.width_front) }}" sizes="(max-width: 768px) 90vw, 250px" alt="الوجه الأمامي: {{ document.original_filename }}">
             <p>الوجه الأمامي</p>
             <a href="{{ url_for('download_file', filename=document.filename) }}" class="btn btn-download">تحميل</a>
         </div>
@@ -1299,7 +4985,8 @@ document.addEventListener('DOMContentLoaded', () => {
         {% if show_back_side %} {# Only show back side if document type supports it and file exists #}
             {% if is_back_image %}
             <div class="document-image-wrapper">
-                <img src="{{ url_for('uploaded_file', filename=document.filename_back) }}" alt="الوجه الخلفي: {{ document.original_filename_back }}">
+                <img src="{{ url_for('uploaded_file', filename=document.filename_back) }}"
+                     srcset="{{ image_srcset(document.filename_back, document.width_back) }}" sizes="(max-width: 768px) 90vw, 250px" alt="الوجه الخلفي: {{ document.original_filename_back }}">
                 <p>الوجه الخلفي</p>
                 <a href="{{ url_for('download_file', filename=document.filename_back) }}" class="btn btn-download">تحميل</a>
             </div>
@@ -1314,7 +5001,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
     <h3>رمز الاستجابة السريعة (QR Code)</h3>
     <div class="qr-code-display">
-        <img src="data:image/png;base64,{{ qr_img_str }}" alt="QR Code for {{ document.name }}">
+        <img src="{{ url_for('document_qr', doc_id=document.id, v=qr_version) }}" alt="QR Code for {{ document.name }}">
     </div>
 
     <div class="document-actions-bottom">
@@ -1334,7 +5021,9 @@ document.addEventListener('DOMContentLoaded', () => {
 {% block content %}
 <div class="form-container">
     <h2>تعديل المستند: {{ document.name }}</h2>
-    <form method="POST" enctype="multipart/form-data">
+    <form method="POST" enctype="multipart/form-data" data-upload-url="{{ url_for('api_uploads') }}"
+          data-chunk-size="{{ config.UPLOAD_CHUNK_SIZE }}" data-size-limits='{{ config.UPLOAD_SIZE_LIMITS | tojson }}'
+          data-default-size-limit="{{ config.UPLOAD_DEFAULT_SIZE_LIMIT }}">
         <div class="form-group">
             <label for="name">اسم المستند:</label>
             <input type="text" id="name" name="name" value="{{ document.name }}" required>
@@ -1360,21 +5049,23 @@ document.addEventListener('DOMContentLoaded', () => {
 
         <div class="form-group">
             <label for="document_file_front">تعديل ملف المستند (الوجه الأمامي):</label>
-            <input type="file" id="document_file_front" name="document_file_front" accept="image/*,.pdf">
+            <input type="file" id="document_file_front" name="document_file_front" accept="image/*,.pdf" data-upload-field="upload_front">
+            <input type="hidden" name="upload_front">
             <small>الملف الحالي: {{ document.original_filename }}</small><br>
-            <small>الأنواع المدعومة: صور (JPG, PNG) و PDF. الحد الأقصى: 5 ميجابايت.</small>
+            <small>الأنواع المدعومة: صور (JPG, PNG) و PDF. الحد الأقصى: <span class="upload-size-limit">{{ config.UPLOAD_DEFAULT_SIZE_LIMIT // 1048576 }}</span> ميجابايت.</small>
         </div>
         
         <div class="form-group" id="document_file_back_group" style="display: none;">
             <label for="document_file_back">تعديل ملف المستند (الوجه الخلفي - اختياري):</label>
-            <input type="file" id="document_file_back" name="document_file_back" accept="image/*,.pdf">
+            <input type="file" id="document_file_back" name="document_file_back" accept="image/*,.pdf" data-upload-field="upload_back">
+            <input type="hidden" name="upload_back">
             {% if document.original_filename_back %}
             <small>الملف الحالي: {{ document.original_filename_back }}</small><br>
             <input type="checkbox" id="clear_back_file" name="clear_back_file"> <label for="clear_back_file">مسح ملف الوجه الخلفي</label>
             {% else %}
             <small>لا يوجد ملف وجه خلفي حالياً.</small>
             {% endif %}
-            <br><small>يستخدم للبطاقات القومية وما شابه. الأنواع المدعومة: صور (JPG, PNG) و PDF. الحد الأقصى: 5 ميجابايت.</small>
+            <br><small>يستخدم للبطاقات القومية وما شابه. الأنواع المدعومة: صور (JPG, PNG) و PDF. الحد الأقصى: <span class="upload-size-limit">{{ config.UPLOAD_DEFAULT_SIZE_LIMIT // 1048576 }}</span> ميجابايت.</small>
         </div>
         
         <div class="form-group">
@@ -1396,6 +5087,113 @@ document.addEventListener('DOMContentLoaded', () => {
     <h2>ملفك الشخصي</h2>
     <p><strong>اسم المستخدم:</strong> {{ username }}</p>
     <p>هنا يمكنك عرض أو تعديل معلومات ملفك الشخصي.</p>
+    <p><a href="{{ url_for('export_documents') }}" class="btn btn-primary">تصدير جميع المستندات (ZIP)</a></p>
+    <a href="{{ url_for('dashboard') }}" class="btn btn-secondary">العودة إلى لوحة التحكم</a>
+</div>
+{% endblock %}
+'''
+,
+    'import_documents.html': '''
+{% extends 'base.html' %}
+{% block title %}استيراد مستندات{% endblock %}
+{% block content %}
+<div class="form-container">
+    <h2>استيراد عدة مستندات</h2>
+    <form method="POST" enctype="multipart/form-data">
+        <div class="form-group">
+            <label for="archive">أرشيف ZIP:</label>
+            <input type="file" id="archive" name="archive" accept=".zip">
+            <small>يمكن أن يحتوي الأرشيف على ملف manifest.csv أو manifest.json.</small>
+        </div>
+        <div class="form-group">
+            <label for="files">أو ملفات المستندات:</label>
+            <input type="file" id="files" name="files" accept="image/*,.pdf" multiple>
+        </div>
+        <div class="form-group">
+            <label for="manifest">ملف البيانات (CSV أو JSON - اختياري):</label>
+            <input type="file" id="manifest" name="manifest" accept=".csv,.json">
+            <small>الأعمدة: file, name, document_type, description, issue_date, expiry_date, file_back. بدون ملف بيانات يُستخدم اسم الملف كاسم للمستند.</small>
+        </div>
+        <button type="submit" class="btn btn-primary">استيراد</button>
+    </form>
+
+    {% if results %}
+    <h3>نتيجة الاستيراد</h3>
+    <table class="import-report">
+        <tr><th>#</th><th>الملف</th><th>الاسم</th><th>النتيجة</th></tr>
+        {% for result in results %}
+        <tr class="import-{{ result.status }}">
+            <td>{{ result.row }}</td>
+            <td>{{ result.file }}</td>
+            <td>
+                {% if result.id %}<a href="{{ url_for('view_document', doc_id=result.id) }}">{{ result.name }}</a>{% else %}{{ result.name }}{% endif %}
+            </td>
+            <td>{{ 'تم' if result.status == 'ok' else result.message }}</td>
+        </tr>
+        {% endfor %}
+    </table>
+    {% endif %}
+</div>
+{% endblock %}
+'''
+,
+    'expiring.html': '''
+{% extends 'base.html' %}
+{% block title %}مستندات تنتهي قريباً{% endblock %}
+{% block content %}
+<div class="dashboard-container">
+    <h2>مستندات تنتهي خلال {{ days }} يوماً</h2>
+    <form action="{{ url_for('expiring') }}" method="GET" class="search-form">
+        <input type="number" name="days" value="{{ days }}" min="1" max="3650">
+        <button type="submit" class="btn btn-primary">عرض</button>
+    </form>
+    {% if documents %}
+    <div class="document-list">
+        {% for doc in documents %}
+        <div class="document-item">
+            <h4><a href="{{ url_for('view_document', doc_id=doc.id) }}">{{ doc.name }}</a></h4>
+            <p><strong>النوع:</strong> {{ doc.document_type }}</p>
+            <p><strong>تاريخ الانتهاء:</strong> {{ doc.expires_on }}</p>
+            <div class="document-actions">
+                <a href="{{ url_for('edit_document', doc_id=doc.id) }}" class="btn btn-info">تعديل</a>
+            </div>
+        </div>
+        {% endfor %}
+    </div>
+    {% else %}
+    <p>لا توجد مستندات تنتهي صلاحيتها خلال هذه الفترة.</p>
+    {% endif %}
+    <a href="{{ url_for('dashboard') }}" class="btn btn-secondary">العودة إلى لوحة التحكم</a>
+</div>
+{% endblock %}
+'''
+,
+    'search.html': '''
+{% extends 'base.html' %}
+{% block title %}البحث{% endblock %}
+{% block content %}
+<div class="dashboard-container">
+    <h2>البحث في المستندات</h2>
+    <form action="{{ url_for('search') }}" method="GET" class="search-form">
+        <input type="search" name="q" value="{{ query }}" placeholder="ابحث في مستنداتك..." required>
+        <button type="submit" class="btn btn-primary">بحث</button>
+    </form>
+    {% if query %}
+        {% if results %}
+        <div class="document-list">
+            {% for doc in results %}
+            <div class="document-item">
+                <h4><a href="{{ url_for('view_document', doc_id=doc.id) }}">{{ doc.name }}</a></h4>
+                <p><strong>النوع:</strong> {{ doc.document_type }}</p>
+                <p class="search-snippet">{{ doc.snippet }}</p>
+                <p><strong>تاريخ الرفع:</strong> {{ doc.upload_date }}</p>
+            </div>
+            {% endfor %}
+        </div>
+        {% else %}
+        <p>لا توجد نتائج مطابقة لـ "{{ query }}".</p>
+        {% endif %}
+    {% endif %}
     <a href="{{ url_for('dashboard') }}" class="btn btn-secondary">العودة إلى لوحة التحكم</a>
 </div>
 {% endblock %}
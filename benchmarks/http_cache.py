@@ -0,0 +1,113 @@
+"""Measures the bandwidth saved by HTTP caching of stored files.
+
+Seeds a throwaway database with one user and a document (a JPEG front side
+and a PDF back side), then replays repeated visits to view_document through a
+small model of a browser cache:
+
+  no-store    every visit downloads every image again
+  browser     honours Cache-Control, ETag and Last-Modified the way browsers do
+
+It also compares loading the first block of the PDF with a Range request
+against downloading all of it.
+
+    python benchmarks/http_cache.py --views 20
+"""
+import argparse
+import io
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+class BrowserCache:
+    """Keeps responses the way a private browser cache would (simplified)."""
+
+    def __init__(self, client, enabled=True):
+        self.client = client
+        self.enabled = enabled
+        self.entries = {}  # url -> (stored_at, max_age, no_cache, etag, last_modified)
+        self.requests = 0
+        self.bytes = 0
+
+    def get(self, url):
+        entry = self.entries.get(url) if self.enabled else None
+        headers = {}
+        if entry is not None:
+            stored_at, max_age, no_cache, etag, last_modified = entry
+            if not no_cache and max_age is not None and time.time() - stored_at < max_age:
+                return  # Fresh: served from the cache without a request
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        response = self.client.get(url, headers=headers)
+        self.requests += 1
+        self.bytes += len(response.get_data())
+        if response.status_code == 200 and self.enabled:
+            cache_control = response.cache_control
+            self.entries[url] = (time.time(), cache_control.max_age, cache_control.no_cache,
+                                 response.headers.get('ETag'), response.headers.get('Last-Modified'))
+
+
+def seed(app_module, client, image_size):
+    from PIL import Image
+    client.post('/register', data={'username': 'bench', 'password': 'bench'})
+    client.post('/login', data={'username': 'bench', 'password': 'bench'})
+    # Noise compresses badly, like a photographed document
+    image = Image.frombytes('RGB', (image_size, image_size), os.urandom(image_size * image_size * 3))
+    front = io.BytesIO()
+    image.save(front, 'JPEG', quality=90)
+    back = b'%PDF-1.4\n' + os.urandom(2 * 1024 * 1024) + b'\n%%EOF\n'
+    client.post('/add_document', data={
+        'name': 'Benchmark', 'document_type': 'رخصة قيادة', 'description': '', 'expiry_date': '2030-01-01',
+        'document_file_front': (io.BytesIO(front.getvalue()), 'front.jpg'),
+        'document_file_back': (io.BytesIO(back), 'back.pdf'),
+    }, content_type='multipart/form-data')
+    db = app_module.get_db()
+    return db.execute("SELECT id, filename_back FROM documents").fetchone()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--views', type=int, default=20, help='Visits to the document page.')
+    parser.add_argument('--image-size', type=int, default=800, help='Width and height of the JPEG in pixels.')
+    parser.add_argument('--range-size', type=int, default=64 * 1024, help='Bytes fetched by the Range request.')
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='http-cache-bench-'))
+    import app as app_module
+    app = app_module.app
+    app.config['JOB_WORKERS'] = 0
+    app.config['UPLOAD_FOLDER'] = os.path.abspath('uploads')
+    app.config['DERIVATIVE_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], '_derivatives')
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    app_module.init_db()
+
+    with app.app_context():
+        client = app.test_client()
+        document = seed(app_module, client, args.image_size)
+        page = f"/document/{document['id']}"
+
+        print(f"{args.views} views of {page}")
+        print(f"{'client':<10} {'requests':>9} {'bytes':>12}")
+        for label, enabled in (('no-store', False), ('browser', True)):
+            cache = BrowserCache(client, enabled)
+            for _ in range(args.views):
+                html = client.get(page).get_data(as_text=True)
+                for url in re.findall(r'<img src="([^"]+)"', html):
+                    cache.get(url.replace('&amp;', '&'))
+            print(f"{label:<10} {cache.requests:>9} {cache.bytes:>12,}")
+
+        pdf_url = f"/uploads/{document['filename_back']}"
+        full = len(client.get(pdf_url).get_data())
+        partial = client.get(pdf_url, headers={'Range': f"bytes=0-{args.range_size - 1}"})
+        print(f"\nPDF: full {full:,} bytes, first block {len(partial.get_data()):,} bytes "
+              f"(status {partial.status_code}, {partial.headers.get('Content-Range')})")
+
+
+if __name__ == '__main__':
+    main()
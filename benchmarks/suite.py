@@ -0,0 +1,345 @@
+"""Reproducible load test of the main document routes.
+
+Seeds a throwaway database with --users users owning --documents documents
+each (synthetic JPEG scans and PDFs from a fixed random seed), then drives
+
+  dashboard, view_document, uploaded_file, download_file,
+  add_document, edit_document, delete_document
+
+first in-process through Flask's test client, then over HTTP against a real
+local server with --concurrency client threads. For every route it reports
+p50/p95/p99 latency, throughput and the peak RSS of the process.
+
+Results can be stored as a baseline and later runs compared against it; any
+route whose p95 latency grows, or whose throughput drops, by more than
+--tolerance fails the run with exit status 1.
+
+    python benchmarks/suite.py --save-baseline benchmarks/baseline.json
+    python benchmarks/suite.py --baseline benchmarks/baseline.json
+"""
+import argparse
+import http.client
+import io
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+ROUTES = ('dashboard', 'view_document', 'uploaded_file', 'download_file',
+          'add_document', 'edit_document', 'delete_document')
+DOCUMENT_TYPE = 'رخصة قيادة'  # Has an expiry date and a back side
+
+
+# --- Synthetic data ---
+def synthetic_jpeg(rng, size):
+    from PIL import Image
+    image = Image.frombytes('RGB', (size, size), rng.randbytes(size * size * 3))
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=85)
+    return out.getvalue()
+
+
+def synthetic_pdf(rng, size):
+    return b'%PDF-1.4\n' + rng.randbytes(size) + b'\n%%EOF\n'
+
+
+def document_form(rng, index, image_size, pdf_size):
+    """Form fields of one synthetic document; files are (bytes, filename)."""
+    return {
+        'name': f'bench-{index}',
+        'document_type': DOCUMENT_TYPE,
+        'description': f'Synthetic document {index}',
+        'issue_date': '2020-01-01',
+        'expiry_date': f'20{30 + index % 10}-06-30',
+        'document_file_front': (synthetic_jpeg(rng, image_size), f'front-{index}.jpg'),
+        'document_file_back': (synthetic_pdf(rng, pdf_size), f'back-{index}.pdf'),
+    }
+
+
+# --- Transports ---
+class TestClientTransport:
+    """Sends requests in-process through Flask's test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, form=None):
+        data = None
+        if form is not None:
+            data = {key: (io.BytesIO(value[0]), value[1]) if isinstance(value, tuple) else value
+                    for key, value in form.items()}
+        response = self.client.open(path, method=method, data=data,
+                                    content_type='multipart/form-data' if form is not None else None)
+        body = response.get_data()
+        return response.status_code, body
+
+
+class HttpTransport:
+    """Sends requests to a local HTTP server, one connection per request."""
+
+    def __init__(self, port):
+        self.port = port
+        self.cookie = None
+
+    def request(self, method, path, form=None):
+        from werkzeug.datastructures import FileStorage
+        from werkzeug.test import encode_multipart
+        headers, body = {}, None
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        if form is not None:
+            values = {key: FileStorage(io.BytesIO(value[0]), filename=value[1]) if isinstance(value, tuple) else value
+                      for key, value in form.items()}
+            boundary, body = encode_multipart(values)
+            headers['Content-Type'] = f'multipart/form-data; boundary={boundary}'
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+            set_cookie = response.getheader('Set-Cookie')
+            if set_cookie and set_cookie.startswith('session='):
+                self.cookie = set_cookie.split(';', 1)[0]
+            return response.status, data
+        finally:
+            connection.close()
+
+
+def logged_in(transport, username):
+    status, _ = transport.request('POST', '/login', {'username': username, 'password': username})
+    if status != 302:
+        raise RuntimeError(f'login as {username} failed with {status}')
+    return transport
+
+
+# --- Measurement ---
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def measure(requests, concurrency):
+    """Runs `requests` (callables returning a status) and returns the route statistics."""
+    latencies = []
+    lock = threading.Lock()
+
+    def run(send):
+        start = time.perf_counter()
+        status = send()
+        elapsed = time.perf_counter() - start
+        if status >= 400:
+            raise RuntimeError(f'unexpected status {status}')
+        with lock:
+            latencies.append(elapsed)
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as pool:
+            for future in [pool.submit(run, send) for send in requests]:
+                future.result()
+    else:
+        for send in requests:
+            run(send)
+    wall = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'throughput_rps': len(latencies) / wall if wall else 0.0,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+# --- Scenarios ---
+class Workload:
+    """The seeded users and documents, and the request builders for each route."""
+
+    def __init__(self, app_module, args):
+        self.app_module = app_module
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.users = [f'bench{i}' for i in range(args.users)]
+        self.added = 0
+
+    def seed(self):
+        client = self.app_module.app.test_client()
+        index = 0
+        for username in self.users:
+            client.post('/register', data={'username': username, 'password': username})
+            transport = logged_in(TestClientTransport(self.app_module.app), username)
+            for _ in range(self.args.documents):
+                transport.request('POST', '/add_document', self.form(index))
+                index += 1
+        with self.app_module.app.app_context():
+            self.app_module.run_pending_jobs(self.app_module.get_db())  # Derivatives, like a settled system
+
+    def form(self, index):
+        return document_form(self.rng, index, self.args.image_size, self.args.pdf_size)
+
+    def documents(self, username, prefix='bench-'):
+        with self.app_module.app.app_context():
+            return self.app_module.get_db().execute(
+                "SELECT d.id, d.filename FROM documents d JOIN users u ON u.id = d.user_id "
+                "WHERE u.username = ? AND d.name LIKE ? ORDER BY d.id", (username, prefix + '%')).fetchall()
+
+    def requests(self, route, transports, iterations):
+        """Returns `iterations` zero-argument callables sending requests for route."""
+        calls = []
+        documents_by_user = {username: self.documents(username) for username in self.users}
+        for i in range(iterations):
+            username = self.users[i % len(self.users)]
+            transport = transports[username]
+            if route == 'add_document':
+                form = self.form(10_000 + self.added)
+                form['name'] = f'added-{self.added}'
+                self.added += 1
+                calls.append(lambda t=transport, f=form: t.request('POST', '/add_document', f)[0])
+                continue
+            if route == 'delete_document':
+                continue  # Built below from the documents add_document created
+            documents = documents_by_user[username]
+            document = documents[(i // len(self.users)) % len(documents)]
+            if route == 'dashboard':
+                path, method, form = '/dashboard', 'GET', None
+            elif route == 'view_document':
+                path, method, form = f"/document/{document['id']}", 'GET', None
+            elif route == 'uploaded_file':
+                path, method, form = f"/uploads/{document['filename']}", 'GET', None
+            elif route == 'download_file':
+                path, method, form = f"/download/{document['filename']}", 'GET', None
+            elif route == 'edit_document':
+                path, method = f"/edit_document/{document['id']}", 'POST'
+                form = {'name': f'bench-{document["id"]}', 'document_type': DOCUMENT_TYPE,
+                        'description': f'Edited {i}', 'issue_date': '2020-01-01', 'expiry_date': '2031-01-01'}
+            calls.append(lambda t=transport, m=method, p=path, f=form: t.request(m, p, f)[0])
+        if route == 'delete_document':
+            for username in self.users:
+                for document in self.documents(username, prefix='added-'):
+                    calls.append(lambda t=transports[username], d=document['id']:
+                                 t.request('POST', f'/delete_document/{d}')[0])
+            calls = calls[:iterations]
+        return calls
+
+
+def run_routes(workload, transports, args, concurrency):
+    results = {}
+    for route in ROUTES:
+        if args.warmup and route not in ('add_document', 'delete_document'):
+            for send in workload.requests(route, transports, args.warmup):
+                send()
+        results[route] = measure(workload.requests(route, transports, args.iterations), concurrency)
+    return results
+
+
+# --- Reporting ---
+def print_results(title, results):
+    print(f"\n{title}")
+    print(f"{'route':<16} {'n':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9} {'RSS MB':>8}")
+    for route, stats in results.items():
+        print(f"{route:<16} {stats['requests']:>5} {stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} "
+              f"{stats['p99_ms']:>9.2f} {stats['throughput_rps']:>9.1f} {stats['peak_rss_mb']:>8.1f}")
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of regressions of `results` against `baseline`."""
+    regressions = []
+    for mode, routes in baseline.get('results', {}).items():
+        for route, before in routes.items():
+            after = results.get(mode, {}).get(route)
+            if after is None:
+                continue
+            if after['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+                regressions.append(f"{mode}/{route}: p95 {before['p95_ms']:.2f} -> {after['p95_ms']:.2f} ms")
+            if after['throughput_rps'] < before['throughput_rps'] * (1 - tolerance):
+                regressions.append(f"{mode}/{route}: throughput {before['throughput_rps']:.1f} -> "
+                                   f"{after['throughput_rps']:.1f} req/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--documents', type=int, default=20, help='Documents seeded per user.')
+    parser.add_argument('--iterations', type=int, default=100, help='Measured requests per route.')
+    parser.add_argument('--warmup', type=int, default=10, help='Unmeasured requests per read-only route.')
+    parser.add_argument('--concurrency', type=int, default=8, help='Client threads against the HTTP server.')
+    parser.add_argument('--image-size', type=int, default=600, help='Width and height of the JPEG scans.')
+    parser.add_argument('--pdf-size', type=int, default=200 * 1024, help='Bytes of each synthetic PDF.')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--mode', choices=('all', 'testclient', 'http'), default='all')
+    parser.add_argument('--baseline', help='Compare against this results file.')
+    parser.add_argument('--save-baseline', help='Write the results to this file.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative regression.')
+    args = parser.parse_args()
+
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    save_path = os.path.abspath(args.save_baseline) if args.save_baseline else None
+    os.chdir(tempfile.mkdtemp(prefix='bench-suite-'))
+    import app as app_module
+    app = app_module.app
+    app.config.update(
+        UPLOAD_FOLDER=os.path.abspath('uploads'),
+        DERIVATIVE_FOLDER=os.path.abspath(os.path.join('uploads', '_derivatives')),
+        JOB_WORKERS=0,  # Jobs run only when the suite drains them, keeping timings comparable
+        AUTH_IP_BURST=10 ** 6,  # Every benchmark user logs in from 127.0.0.1
+    )
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    app_module.init_db()
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    workload = Workload(app_module, args)
+    started = time.perf_counter()
+    workload.seed()
+    print(f"Seeded {args.users} users x {args.documents} documents in {time.perf_counter() - started:.1f}s")
+
+    results = {}
+    if args.mode in ('all', 'testclient'):
+        transports = {username: logged_in(TestClientTransport(app), username) for username in workload.users}
+        results['testclient'] = run_routes(workload, transports, args, concurrency=1)
+        print_results('Flask test client (sequential)', results['testclient'])
+    if args.mode in ('all', 'http'):
+        from werkzeug.serving import make_server
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            transports = {username: logged_in(HttpTransport(server.server_port), username)
+                          for username in workload.users}
+            results['http'] = run_routes(workload, transports, args, concurrency=args.concurrency)
+        finally:
+            server.shutdown()
+        print_results(f'Local HTTP server ({args.concurrency} client threads)', results['http'])
+
+    report = {'args': vars(args), 'python': sys.version.split()[0], 'results': results}
+    if save_path:
+        with open(save_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline written to {save_path}")
+    if baseline_path:
+        with open(baseline_path) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\nREGRESSIONS (tolerance {args.tolerance:.0%}):")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nNo regressions against {baseline_path} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as app_module  # noqa: E402
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = app_module.app.config
+    monkeypatch.setitem(config, 'DATABASE', str(tmp_path / 'documents.db'))
+    for key, folder in (('UPLOAD_FOLDER', 'uploads'), ('DERIVATIVE_FOLDER', 'uploads/_derivatives'),
+                        ('QUARANTINE_FOLDER', 'uploads/_quarantine'), ('ASSET_FOLDER', 'assets')):
+        monkeypatch.setitem(config, key, str(tmp_path / folder))
+    monkeypatch.setitem(config, 'JOB_WORKERS', 0)
+    monkeypatch.setitem(config, 'PASSWORD_HASH_WORKERS', 0)
+    os.makedirs(config['UPLOAD_FOLDER'])
+    app_module.init_db()
+    client = app_module.app.test_client()
+    client.post('/register', data={'username': 'user', 'password': 'secret'})
+    client.post('/login', data={'username': 'user', 'password': 'secret'})
+    return client
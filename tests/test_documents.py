@@ -0,0 +1,152 @@
+import hashlib
+import io
+import os
+import random
+
+import pytest
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+import app as app_module
+
+
+def add_document(client, name, content):
+    return client.post('/add_document', data={
+        'name': name, 'document_type': 'أخرى',
+        'document_file_front': (io.BytesIO(content), 'scan.pdf'),
+    }, content_type='multipart/form-data')
+
+
+def blob_name(content):
+    return f"{hashlib.sha256(content).hexdigest()}.pdf"
+
+
+def refcounts(db):
+    return {row['name']: row['refcount'] for row in db.execute("SELECT name, refcount FROM blobs")}
+
+
+def test_repeated_delete_releases_a_shared_blob_once(client):
+    content = b'%PDF-1.4 shared scan'
+    add_document(client, 'first', content)
+    add_document(client, 'second', content)
+
+    with app_module.app.test_request_context():
+        db = app_module.get_db()
+        stale = db.execute("SELECT * FROM documents WHERE name = 'first'").fetchone()
+        app_module.remove_document(stale)
+        app_module.remove_document(stale)  # Double-submitted form or retried API DELETE
+
+        assert refcounts(db) == {blob_name(content): 1}
+        assert db.execute("SELECT COUNT(*) FROM jobs WHERE kind = 'unlink_blobs'").fetchone()[0] == 0
+        assert app_module.blob_storage().exists(blob_name(content))
+
+
+def test_concurrent_updates_release_each_replaced_blob_once(client):
+    add_document(client, 'scan', b'%PDF-1.4 original')
+
+    with app_module.app.test_request_context():
+        db = app_module.get_db()
+        stale = db.execute("SELECT * FROM documents").fetchone()
+        for content in (b'%PDF-1.4 first edit', b'%PDF-1.4 second edit'):
+            app_module.update_document(stale, {}, FileStorage(io.BytesIO(content), 'scan.pdf'))
+
+        assert refcounts(db) == {blob_name(b'%PDF-1.4 second edit'): 1}
+        assert db.execute("SELECT blob FROM documents").fetchone()[0] == blob_name(b'%PDF-1.4 second edit')
+
+
+def stored_image(client, monkeypatch, content, filename):
+    monkeypatch.setitem(app_module.app.config, 'IMAGE_NORMALIZATION', 'optimize')
+    client.post('/add_document', data={
+        'name': 'photo', 'document_type': 'أخرى',
+        'document_file_front': (io.BytesIO(content), filename),
+    }, content_type='multipart/form-data')
+    with app_module.app.app_context():
+        blob = app_module.get_db().execute("SELECT blob FROM documents").fetchone()[0]
+        with app_module.blob_storage().open(blob) as f:
+            return f.read()
+
+
+def noisy_jpeg(**kwargs):
+    """A JPEG that re-encoding at IMAGE_JPEG_QUALITY only makes larger."""
+    image = Image.frombytes('RGB', (64, 64), random.Random(0).randbytes(64 * 64 * 3))
+    buffered = io.BytesIO()
+    image.save(buffered, 'JPEG', quality=10, **kwargs)
+    return buffered.getvalue()
+
+
+def test_normalization_keeps_no_metadata_from_an_image_it_cannot_shrink(client, monkeypatch):
+    exif = Image.Exif()
+    exif[0x010F] = 'Camera maker'  # Make
+    exif[0x0110] = 'Camera model'  # Model
+    stored = stored_image(client, monkeypatch, noisy_jpeg(exif=exif), 'photo.jpg')
+    with Image.open(io.BytesIO(stored)) as image:
+        assert not image.getexif()
+    assert b'Camera model' not in stored
+
+
+def test_normalization_keeps_an_image_without_metadata_it_cannot_shrink(client, monkeypatch):
+    content = noisy_jpeg()
+    assert stored_image(client, monkeypatch, content, 'photo.jpg') == content
+
+
+class CountingStream(io.BytesIO):
+    def __init__(self, content):
+        super().__init__(content)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        chunk = super().read(size)
+        self.bytes_read += len(chunk)
+        return chunk
+
+
+def test_upload_over_its_type_limit_is_rejected_while_streaming(client, monkeypatch):
+    config = app_module.app.config
+    monkeypatch.setitem(config, 'UPLOAD_DEFAULT_SIZE_LIMIT', 4096)
+    monkeypatch.setitem(config, 'BLOB_CHUNK_SIZE', 1024)
+    stream = CountingStream(b'%PDF-1.4 ' + b'x' * 1024 * 1024)
+
+    with app_module.app.test_request_context():
+        with pytest.raises(app_module.DocumentError, match='الحد المسموح'):
+            app_module.create_document(1, {'name': 'visa', 'document_type': 'فيزا'},
+                                       FileStorage(stream, 'visa.pdf'))
+        assert stream.bytes_read <= 4096 + 1024
+        assert app_module.get_db().execute("SELECT COUNT(*) FROM documents").fetchone()[0] == 0
+    assert not [name for name in os.listdir(config['UPLOAD_FOLDER']) if name.endswith('.tmp')]
+
+
+def test_upload_within_its_type_limit_is_stored(client, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'UPLOAD_DEFAULT_SIZE_LIMIT', 4096)
+    client.post('/add_document', data={
+        'name': 'visa', 'document_type': 'فيزا',
+        'document_file_front': (io.BytesIO(b'%PDF-1.4 small'), 'visa.pdf'),
+    }, content_type='multipart/form-data')
+
+    with app_module.app.app_context():
+        assert app_module.get_db().execute("SELECT name FROM documents").fetchone()[0] == 'visa'
+
+
+def test_dashboard_of_a_deleted_account_logs_the_session_out(client):
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        db.execute("DELETE FROM users")
+        db.commit()
+
+    response = client.get('/dashboard')
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/login')
+    with client.session_transaction() as session:
+        assert 'user_id' not in session
+
+
+def test_file_of_a_document_deleted_by_another_worker_is_not_served(client):
+    add_document(client, 'scan', b'%PDF-1.4 scan')
+    with app_module.app.app_context():
+        filename = app_module.get_db().execute("SELECT filename FROM documents").fetchone()[0]
+    assert client.get(f'/uploads/{filename}').status_code == 200  # Caches the owner
+
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        db.execute("DELETE FROM documents")  # Without this worker's invalidate_file_owners()
+        db.commit()
+    assert client.get(f'/uploads/{filename}').status_code == 404
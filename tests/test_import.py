@@ -0,0 +1,24 @@
+import hashlib
+import io
+
+import app as app_module
+
+
+def test_multipart_rows_sharing_a_file_store_its_full_content(client):
+    content = b'%PDF-1.4 shared scan'
+    manifest = 'file,name,document_type\na.pdf,first,أخرى\na.pdf,second,أخرى\n'
+    response = client.post('/import', headers={'Accept': 'application/json'}, data={
+        'files': [(io.BytesIO(content), 'a.pdf')],
+        'manifest': (io.BytesIO(manifest.encode('utf-8')), 'manifest.csv'),
+    }, content_type='multipart/form-data')
+
+    results = response.get_json()['results']
+    assert [result['status'] for result in results] == ['ok', 'ok']
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        blobs = [row['blob'] for row in db.execute("SELECT blob FROM documents ORDER BY id")]
+        blob = f"{hashlib.sha256(content).hexdigest()}.pdf"
+        assert blobs == [blob, blob]
+        assert db.execute("SELECT refcount FROM blobs WHERE name = ?", (blob,)).fetchone()[0] == 2
+        with app_module.blob_storage().open(blob) as f:
+            assert f.read() == content